@@ -18,11 +18,18 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # Trust X-Forwarded-For/-Proto/-Host from our own reverse proxies only
+    if app.config.get('PROXY_FIX_X_FOR'):
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        hops = app.config['PROXY_FIX_X_FOR']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
     # Initialize extensions
     db.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
-    migrate.init_app(app, db)
+    from app.utils.audit import include_object
+    migrate.init_app(app, db, include_object=include_object)
     moment.init_app(app)
     babel.init_app(app)
 
@@ -54,6 +61,38 @@ def create_app(config_class=Config):
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'])
 
+    # Cache compiled templates and rendered fragments
+    from app.utils import templating
+    templating.init_app(app)
+
+    # Serve fingerprinted static assets
+    from app.utils import assets
+    assets.init_app(app)
+
+    # Start fan-out of work-queue events to SSE subscribers
+    from app.utils.events import broker
+    broker.init_app(app)
+
+    # Shared token buckets for rate-limited views
+    from app.utils import ratelimit
+    ratelimit.init_app(app)
+
+    # Buffer record-access events and write them in the background
+    from app.utils.audit import audit_log
+    audit_log.init_app(app)
+
+    # Queue kiosk check-ins and apply them in the background
+    from app.utils.checkin import checkin_queue
+    checkin_queue.init_app(app)
+
+    # Profile sampled requests when PROFILE_ENABLED; nothing is hooked otherwise
+    from app.utils.profiling import profiler
+    profiler.init_app(app)
+
+    # Register CLI commands
+    from app import cli
+    cli.register(app)
+
     # Register error handlers
     from app.errors import init_error_handlers
     init_error_handlers(app)
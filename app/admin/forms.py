@@ -32,6 +32,10 @@ class UserEditForm(FlaskForm):
         ('pharmacist', 'Pharmacist'),
         ('lab_technician', 'Lab Technician')
     ], validators=[DataRequired()])
+    department = StringField('Department', validators=[
+        Optional(),
+        Length(max=64)
+    ])
     is_active = BooleanField('Active')
 
     def __init__(self, original_email=None, *args, **kwargs):
@@ -1,9 +1,11 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify
+from flask import render_template, redirect, url_for, flash, request, jsonify, current_app, abort, Response
 from flask_login import login_required, current_user
 from app import db
 from app.admin import bp
 from app.admin.forms import UserEditForm, SystemSettingsForm
-from app.models import User, Patient, Appointment, Bill
+from app.models import User, Patient, Appointment, Bill, ArchivedAppointment, DuplicateCandidate
+from app.utils.archive import combined
+from app.utils.audit import audit_access, query_access_log
 from app.utils.decorators import admin_required
 from datetime import datetime, timedelta
 
@@ -13,7 +15,7 @@ from datetime import datetime, timedelta
 def dashboard():
     # Get statistics for dashboard
     total_patients = Patient.query.count()
-    total_appointments = Appointment.query.count()
+    total_appointments = Appointment.query.count() + ArchivedAppointment.query.count()
     total_doctors = User.query.filter_by(role='doctor').count()
     
     # Get today's appointments
@@ -64,6 +66,7 @@ def edit_user(user_id):
         user.first_name = form.first_name.data
         user.last_name = form.last_name.data
         user.role = form.role.data
+        user.department = form.department.data or None
         user.is_active = form.is_active.data
         
         if form.password.data:
@@ -106,6 +109,205 @@ def system_settings():
                          title='System Settings',
                          form=form)
 
+@bp.route('/audit')
+@login_required
+@admin_required
+def audit_log():
+    end_date = request.args.get('end_date', datetime.now().strftime('%Y-%m-%d'))
+    start_date = request.args.get('start_date',
+                                (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d'))
+    filters = {
+        'patient_id': request.args.get('patient_id', type=int),
+        'user_id': request.args.get('user_id', type=int),
+        'object_type': request.args.get('object_type') or None
+    }
+    try:
+        start, end = _date_range(start_date, end_date)
+    except ValueError:
+        flash('Invalid date range.', 'warning')
+        return redirect(url_for('admin.audit_log'))
+    page = query_access_log(start, end, cursor=request.args.get('cursor'), **filters)
+    
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({
+            'entries': [dict(entry, accessed_at=entry['accessed_at'].isoformat())
+                        for entry in page['entries']],
+            'next_cursor': page['next_cursor']
+        })
+    
+    return render_template('admin/audit_log.html',
+                         title='Access Log',
+                         start_date=start_date,
+                         end_date=end_date,
+                         filters=filters,
+                         page=page)
+
+@bp.route('/duplicates')
+@login_required
+@admin_required
+def duplicates():
+    page = request.args.get('page', 1, type=int)
+    candidates = DuplicateCandidate.query.filter_by(status='open')\
+        .order_by(DuplicateCandidate.score.desc(), DuplicateCandidate.id)\
+        .paginate(page=page, per_page=50, error_out=False)
+    patient_ids = {id for candidate in candidates.items
+                   for id in (candidate.patient_id, candidate.duplicate_id)}
+    patients = {patient.id: patient
+                for patient in Patient.query.filter(Patient.id.in_(patient_ids)).all()}
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        def describe(patient):
+            return {'id': patient.id,
+                    'name': f'{patient.first_name} {patient.last_name}',
+                    'date_of_birth': patient.date_of_birth.isoformat(),
+                    'phone': patient.phone,
+                    'email': patient.email}
+        return jsonify({
+            'candidates': [{'id': candidate.id,
+                            'score': candidate.score,
+                            'matched_on': candidate.matched_on,
+                            'patient': describe(patients[candidate.patient_id]),
+                            'duplicate': describe(patients[candidate.duplicate_id])}
+                           for candidate in candidates.items],
+            'total': candidates.total
+        })
+
+    return render_template('admin/duplicates.html',
+                         title='Duplicate Patients',
+                         candidates=candidates,
+                         patients=patients)
+
+@bp.route('/duplicates/<int:candidate_id>/merge', methods=['POST'])
+@login_required
+@admin_required
+def merge_duplicate(candidate_id):
+    from app.utils.dedup import merge_patients
+    candidate = DuplicateCandidate.query.get_or_404(candidate_id)
+    keep_id = request.form.get('keep_id', type=int)
+    if keep_id not in (candidate.patient_id, candidate.duplicate_id):
+        flash('Choose which record to keep.', 'warning')
+        return redirect(url_for('admin.duplicates'))
+    duplicate_id = candidate.duplicate_id if keep_id == candidate.patient_id else candidate.patient_id
+    try:
+        merge_patients(keep_id, duplicate_id, merged_by=current_user.id)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f'Patient merge failed: {str(e)}')
+        flash('The records could not be merged.', 'danger')
+        return redirect(url_for('admin.duplicates'))
+    audit_access('patient', duplicate_id, keep_id, action='merge')
+    flash(f'Patient {duplicate_id} merged into patient {keep_id}.', 'success')
+    return redirect(url_for('admin.duplicates'))
+
+@bp.route('/duplicates/<int:candidate_id>/dismiss', methods=['POST'])
+@login_required
+@admin_required
+def dismiss_duplicate(candidate_id):
+    candidate = DuplicateCandidate.query.get_or_404(candidate_id)
+    candidate.status = 'dismissed'
+    candidate.reviewed_by = current_user.id
+    db.session.commit()
+    flash('Marked as different patients.', 'success')
+    return redirect(url_for('admin.duplicates'))
+
+@bp.route('/forecast')
+@login_required
+@admin_required
+def forecast():
+    from app.utils.forecast import load_forecast
+    result = load_forecast()
+    weeks = max(4, min(request.args.get('weeks', 8, type=int), result['horizon_days'] // 7))
+    doctor_id = request.args.get('doctor_id', type=int)
+    department = request.args.get('department')
+
+    def trim(series):
+        return dict(series, daily=series['daily'][:weeks * 7], weekly=series['weekly'][:weeks])
+
+    return jsonify(dict(
+        result,
+        doctors=[trim(row) for row in result['doctors']
+                 if (doctor_id is None or row['doctor_id'] == doctor_id) and
+                 (department is None or row['department'] == department)],
+        departments=[trim(row) for row in result['departments']
+                     if department is None or row['department'] == department]
+    ))
+
+@bp.route('/profiles')
+@login_required
+@admin_required
+def profiles():
+    from app.utils import profiling
+    hours = max(1, min(request.args.get('hours', 24, type=int), current_app.config['PROFILE_KEEP_HOURS']))
+    summary = profiling.endpoints(profiling.profile_folder(), hours)
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'hours': hours, 'endpoints': summary})
+
+    return render_template('admin/profiles.html',
+                         title='Request Profiles',
+                         enabled=current_app.config['PROFILE_ENABLED'],
+                         hours=hours,
+                         endpoints=summary)
+
+@bp.route('/profiles/token', methods=['POST'])
+@login_required
+@admin_required
+def issue_profile_token():
+    from app.utils.profiling import profile_token, TOKEN_HEADER
+    if not current_app.config['PROFILE_ENABLED']:
+        flash('Request profiling is off (PROFILE_ENABLED).', 'warning')
+        return redirect(url_for('admin.profiles'))
+    token = profile_token(current_user.id)
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'header': TOKEN_HEADER, 'token': token,
+                        'expires_in': current_app.config['PROFILE_TOKEN_MAX_AGE']})
+    flash(f'Send {TOKEN_HEADER}: {token} to profile your requests.', 'info')
+    return redirect(url_for('admin.profiles'))
+
+@bp.route('/profiles/<endpoint>')
+@login_required
+@admin_required
+def profile(endpoint):
+    from app.utils import profiling
+    folder = profiling.profile_folder()
+    hours = max(1, min(request.args.get('hours', 24, type=int), current_app.config['PROFILE_KEEP_HOURS']))
+    stacks = profiling.collapsed(folder, endpoint, hours)
+    stats = profiling.merged_stats(folder, endpoint, hours)
+    data = {'endpoint': endpoint,
+            'hours': hours,
+            'samples': sum(stacks.values()),
+            'functions': profiling.hot_functions(stacks),
+            'top_stacks': [{'stack': stack.split(';'), 'samples': count}
+                           for stack, count in stacks.most_common(20)],
+            'calls': profiling.top_calls(stats) if stats else [],
+            'slowest': profiling.requests_log(folder, endpoint, hours)}
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(data)
+
+    return render_template('admin/profile.html', title=f'Profile: {endpoint}', **data)
+
+@bp.route('/profiles/<endpoint>/download')
+@login_required
+@admin_required
+def download_profile(endpoint):
+    from app.utils import profiling
+    folder = profiling.profile_folder()
+    hours = max(1, min(request.args.get('hours', 24, type=int), current_app.config['PROFILE_KEEP_HOURS']))
+    name = profiling.endpoint_file(endpoint)
+    if request.args.get('format') == 'pstats':
+        stats = profiling.merged_stats(folder, endpoint, hours)
+        if stats is None:
+            abort(404)
+        return Response(profiling.dump_stats(stats), mimetype='application/octet-stream', headers={
+            'Content-Disposition': f'attachment; filename={name}.pstats'})
+    stacks = profiling.collapsed(folder, endpoint, hours)
+    if not stacks:
+        abort(404)
+    return Response(''.join(f'{stack} {count}\n' for stack, count in stacks.items()),
+                    mimetype='text/plain', headers={
+                        'Content-Disposition': f'attachment; filename={name}.collapsed'})
+
 @bp.route('/reports')
 @login_required
 @admin_required
@@ -116,11 +318,17 @@ def reports():
     end_date = request.args.get('end_date', datetime.now().strftime('%Y-%m-%d'))
     
     # Generate report based on type
-    if report_type == 'revenue':
-        data = generate_revenue_report(start_date, end_date)
-    elif report_type == 'appointments':
-        data = generate_appointment_report(start_date, end_date)
-    else:
+    try:
+        if report_type == 'revenue':
+            data = generate_revenue_report(start_date, end_date)
+        elif report_type == 'appointments':
+            data = generate_appointment_report(start_date, end_date)
+        elif report_type in POPULATION_REPORTS:
+            data = generate_population_report(report_type, start_date, end_date)
+        else:
+            data = {}
+    except ValueError:
+        flash('Invalid date range.', 'warning')
         data = {}
     
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -133,10 +341,68 @@ def reports():
                          end_date=end_date,
                          data=data)
 
+def _date_range(start_date, end_date):
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+    return start, end
+
+# Population reports read the analytics snapshot, not the live tables
+POPULATION_REPORTS = ('demographics', 'retention', 'throughput', 'monthly_revenue')
+
+def generate_population_report(report_type, start_date, end_date):
+    from app.utils import population
+    from app.utils.snapshot import open_snapshot
+    snapshot = open_snapshot()
+    if snapshot is None:
+        flash('The analytics snapshot has not been built yet (flask analytics snapshot).', 'warning')
+        return {}
+    start, end = _date_range(start_date, end_date)
+    if report_type == 'demographics':
+        data = population.demographics(snapshot, end.date() - timedelta(days=1),
+                                       bands=current_app.config['ANALYTICS_AGE_BANDS'])
+    elif report_type == 'retention':
+        data = population.cohort_retention(snapshot, start.date(), end.date(),
+                                           months=current_app.config['ANALYTICS_RETENTION_MONTHS'])
+    elif report_type == 'throughput':
+        data = population.doctor_throughput(snapshot, start.date(), end.date())
+    else:
+        data = population.revenue_by_month(snapshot, start.date(), end.date())
+    data['snapshot_built_at'] = snapshot.built_at.isoformat()
+    return data
+
+# Reports cover archived history too, so they read hot and archive tables
+
 def generate_revenue_report(start_date, end_date):
-    # TODO: Implement revenue report generation
-    return {}
+    start, end = _date_range(start_date, end_date)
+    bills = combined(Bill, 'bill_date', 'total_amount', 'payment_status')
+    day = db.func.date(bills.c.bill_date)
+    rows = db.session.query(day, db.func.sum(bills.c.total_amount), db.func.count())\
+        .filter(bills.c.bill_date >= start,
+                bills.c.bill_date < end,
+                bills.c.payment_status == 'paid')\
+        .group_by(day).order_by(day).all()
+    return {
+        'total': sum(amount for _, amount, _ in rows),
+        'bills': sum(count for _, _, count in rows),
+        'daily': [{'date': str(date), 'amount': amount, 'bills': count}
+                  for date, amount, count in rows]
+    }
 
 def generate_appointment_report(start_date, end_date):
-    # TODO: Implement appointment report generation
-    return {}
\ No newline at end of file
+    start, end = _date_range(start_date, end_date)
+    appointments = combined(Appointment, 'appointment_date', 'status')
+    day = db.func.date(appointments.c.appointment_date)
+    rows = db.session.query(day, appointments.c.status, db.func.count())\
+        .filter(appointments.c.appointment_date >= start,
+                appointments.c.appointment_date < end)\
+        .group_by(day, appointments.c.status).order_by(day).all()
+    by_status = {}
+    daily = {}
+    for date, status, count in rows:
+        by_status[status] = by_status.get(status, 0) + count
+        daily[str(date)] = daily.get(str(date), 0) + count
+    return {
+        'total': sum(by_status.values()),
+        'by_status': by_status,
+        'daily': [{'date': date, 'appointments': count} for date, count in daily.items()]
+    }
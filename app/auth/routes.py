@@ -5,8 +5,11 @@ from app import db
 from app.auth import bp
 from app.auth.forms import LoginForm, RegistrationForm
 from app.models import User
+from app.utils.ratelimit import rate_limit
 
 @bp.route('/login', methods=['GET', 'POST'])
+@rate_limit('10/minute', per='ip', methods=('POST',), field='email')
+@rate_limit('100/minute', per='ip', methods=('POST',))
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
@@ -0,0 +1,202 @@
+import click
+
+
+def register(app):
+    @app.cli.group()
+    def assets():
+        """Static asset commands."""
+        pass
+
+    @assets.command()
+    def build():
+        """Fingerprint and gzip the static files."""
+        from app.utils.assets import build_assets
+        manifest = build_assets(app.static_folder)
+        click.echo(f'Built {len(manifest)} assets.')
+
+    @app.cli.group()
+    def billing():
+        """Billing commands."""
+        pass
+
+    @billing.command()
+    @click.option('--full', is_flag=True, help='Ignore the watermark and scan all history.')
+    def run(full):
+        """Generate bills for completed encounters."""
+        from app.utils.billing import run_billing
+        billing_run = run_billing(full=full)
+        click.echo(f'Billing run {billing_run.id}: {billing_run.bills_created} bills, '
+                   f'{billing_run.items_created} items.')
+
+    @app.cli.group()
+    def reminders():
+        """Appointment reminder commands."""
+        pass
+
+    @reminders.command()
+    @click.option('--dry-run', is_flag=True, help='Count due reminders without sending them.')
+    def send(dry_run):
+        """Email reminders for tomorrow's and next hour's appointments."""
+        from app.utils.reminders import send_reminders
+        sent, failed = send_reminders(dry_run=dry_run)
+        if dry_run:
+            click.echo(f'{sent} reminders due.')
+        else:
+            click.echo(f'Sent {sent} reminders, {failed} failed.')
+
+    @app.cli.group()
+    def archive():
+        """Archival of closed clinical records."""
+        pass
+
+    @archive.command('run')
+    @click.option('--kind', 'kinds', multiple=True,
+                  type=click.Choice(['appointment', 'prescription', 'lab_test', 'bill']))
+    def archive_run(kinds):
+        """Move closed records past the horizon to the archive tables."""
+        from app.utils.archive import run_archive
+        for kind, count in run_archive(kinds).items():
+            click.echo(f'{kind}: {count} archived')
+
+    @archive.command('restore')
+    @click.argument('kind', type=click.Choice(['appointment', 'prescription', 'lab_test', 'bill']))
+    @click.option('--id', 'ids', type=int, multiple=True, help='Record id; may be repeated.')
+    @click.option('--patient', 'patient_id', type=int, help='Restore all of a patient\'s records.')
+    def archive_restore(kind, ids, patient_id):
+        """Move archived records back to the hot tables."""
+        from app.utils.archive import restore
+        if not ids and patient_id is None:
+            raise click.UsageError('Give --id or --patient.')
+        restored = restore(kind, ids=ids, patient_id=patient_id)
+        click.echo(f'Restored {len(restored)} {kind} records.')
+
+    @app.cli.group()
+    def audit():
+        """Record-access audit log commands."""
+        pass
+
+    @audit.command()
+    @click.option('--keep-days', type=int, default=None,
+                  help='Defaults to AUDIT_RETENTION_DAYS.')
+    def prune(keep_days):
+        """Drop monthly access-log partitions past the retention period."""
+        from datetime import datetime, timedelta
+        from app.utils.audit import drop_partitions_before
+        keep_days = keep_days or app.config['AUDIT_RETENTION_DAYS']
+        dropped = drop_partitions_before(datetime.utcnow() - timedelta(days=keep_days))
+        click.echo(f'Dropped {len(dropped)} partitions.')
+
+    @app.cli.group()
+    def interactions():
+        """Drug-interaction commands."""
+        pass
+
+    @interactions.command('import')
+    @click.argument('path', type=click.File('r', encoding='utf-8-sig'))
+    @click.option('--replace', is_flag=True, help='Delete the existing table first.')
+    def interactions_import(path, replace):
+        """Load interactions from a CSV with drug_a, drug_b, severity, description columns."""
+        from app.utils.interactions import import_interactions
+        pairs, skipped = import_interactions(path, replace=replace)
+        click.echo(f'Imported {pairs} medication pairs.')
+        if skipped:
+            click.echo(f'Skipped {len(skipped)} rows (unknown medication or severity): '
+                       f'lines {", ".join(map(str, skipped[:20]))}'
+                       f'{" ..." if len(skipped) > 20 else ""}')
+
+    @interactions.command('scan')
+    @click.option('--min-severity', default='moderate',
+                  type=click.Choice(['minor', 'moderate', 'major', 'contraindicated']))
+    @click.option('--output', type=click.File('w'), default='-', help='CSV file; defaults to stdout.')
+    def interactions_scan(min_severity, output):
+        """Check every patient's active prescriptions against each other."""
+        import csv
+        from app.utils.interactions import scan_active_prescriptions
+        writer = csv.writer(output)
+        writer.writerow(['patient_id', 'severity', 'medication_id', 'prescription_id',
+                         'interacting_medication_id', 'interacting_prescription_id', 'description'])
+        found = 0
+        for patient_id, warning in scan_active_prescriptions(min_severity=min_severity):
+            writer.writerow([patient_id, warning['severity'], warning['medication_id'],
+                             warning['prescription_id'], warning['interacting_medication_id'],
+                             warning['interacting_prescription_id'], warning['description']])
+            found += 1
+        click.echo(f'{found} interactions found.', err=True)
+
+    @app.cli.group()
+    def analytics():
+        """Analytics snapshot commands."""
+        pass
+
+    @analytics.command('snapshot')
+    @click.option('--full', is_flag=True, help='Rebuild from scratch instead of refreshing.')
+    def analytics_snapshot(full):
+        """Export patient, appointment and bill facts for population reports."""
+        from app.utils.snapshot import build_snapshot
+        manifest = build_snapshot(full=full)
+        for name, table in manifest['tables'].items():
+            click.echo(f'{name}: {table["rows"]} rows, {table["changed"]} changed')
+
+    @app.cli.group()
+    def forecast():
+        """Appointment volume forecast commands."""
+        pass
+
+    @forecast.command('run')
+    def forecast_run():
+        """Refit and cache appointment forecasts for every doctor and department."""
+        from app.utils.forecast import run_forecast, save_forecast
+        result = run_forecast()
+        save_forecast(result)
+        click.echo(f'Forecast {len(result["doctors"])} doctors and '
+                   f'{len(result["departments"])} departments for {result["horizon_days"]} days.')
+        for scope, backtest in result['backtest'].items():
+            if backtest:
+                click.echo(f'Backtest ({scope}, {backtest["origins"]} origins): '
+                           f'weekly WAPE {backtest["weekly_wape"]} '
+                           f'(last-week naive {backtest["naive_weekly_wape"]}), '
+                           f'daily WAPE {backtest["daily_wape"]} '
+                           f'(naive {backtest["naive_daily_wape"]})')
+
+    @app.cli.group()
+    def reorder():
+        """Medication reorder commands."""
+        pass
+
+    @reorder.command('run')
+    def reorder_run():
+        """Work out demand and cover for every medication and save the purchase order."""
+        from app.utils.reorder import run_reorder, save_reorder
+        result = run_reorder()
+        save_reorder(result)
+        click.echo(f'{len(result["lines"])} of {result["medications"]} medications to order, '
+                   f'estimated cost {result["total_cost"]:.2f}; '
+                   f'{result["stockouts_before_delivery"]} will run out before a delivery.')
+
+    @app.cli.group()
+    def dedup():
+        """Duplicate patient commands."""
+        pass
+
+    @dedup.command('run')
+    def dedup_run():
+        """Scan every patient for likely duplicates and queue them for review."""
+        from app.utils.dedup import find_duplicates
+        summary = find_duplicates()
+        click.echo(f'Compared {summary["pairs_compared"]} pairs in {summary["blocks"]} blocks '
+                   f'in {summary["seconds"]}s: {summary["new_candidates"]} new candidates.')
+        if summary['oversized_blocks']:
+            click.echo(f'Skipped {summary["oversized_blocks"]} blocks larger than '
+                       f'{app.config["DEDUP_MAX_BLOCK"]} patients.')
+
+    @dedup.command('merge')
+    @click.argument('keep_id', type=int)
+    @click.argument('duplicate_id', type=int)
+    def dedup_merge(keep_id, duplicate_id):
+        """Merge DUPLICATE_ID into KEEP_ID and delete it."""
+        from app.utils.dedup import merge_patients
+        try:
+            merge = merge_patients(keep_id, duplicate_id)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(f'Merged patient {duplicate_id} into {keep_id}: {merge.moved}')
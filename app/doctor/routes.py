@@ -1,10 +1,17 @@
-from flask import render_template, redirect, url_for, flash, request, current_app
+from flask import render_template, redirect, url_for, flash, request, current_app, jsonify, abort
 from flask_login import login_required, current_user
 from app import db
 from app.doctor import bp
 from app.doctor.forms import PrescriptionForm, DiagnosisForm
-from app.models import Appointment, Patient, Prescription, PrescriptionMedication, Medication
+from app.models import Appointment, Patient, Prescription, PrescriptionMedication, Medication, LabTest
+from app.utils.audit import audit_access
 from app.utils.decorators import doctor_required
+from app.utils.events import appointment_change
+from app.utils.interactions import check_prescription, CONFIRM_SEVERITIES
+from app.utils.previews import send_preview
+from app.utils.storage import send_stored_file
+from app.utils.timeline import patient_timeline
+from app.utils.waiting_room import waiting_room
 from datetime import datetime, timedelta
 
 @bp.route('/dashboard')
@@ -35,10 +42,61 @@ def dashboard():
     return render_template('doctor/dashboard.html',
                          title='Doctor Dashboard',
                          today_appointments=today_appointments,
+                         queue=waiting_room.queue(current_user.id),
                          recent_prescriptions=recent_prescriptions,
                          recent_lab_results=recent_lab_results,
                          stats=stats)
 
+@bp.route('/queue')
+@login_required
+@doctor_required
+def queue():
+    return jsonify(waiting_room.queue(current_user.id))
+
+@bp.route('/queue/next', methods=['POST'])
+@login_required
+@doctor_required
+def call_next():
+    # The queue can trail other workers' commits by a poll interval
+    for _ in range(5):
+        appointment_id = waiting_room.next_appointment_id(current_user.id)
+        if appointment_id is None:
+            break
+        appointment = db.session.get(Appointment, appointment_id)
+        if appointment is not None and appointment.status == 'checked_in':
+            appointment.status = 'in_consultation'
+            db.session.commit()
+            return redirect(url_for('doctor.view_appointment', appointment_id=appointment.id))
+        if appointment is not None:
+            waiting_room.apply(appointment_change(appointment))
+    flash('No patients are waiting.', 'info')
+    return redirect(url_for('doctor.dashboard'))
+
+@bp.route('/queue/<int:appointment_id>/priority', methods=['POST'])
+@login_required
+@doctor_required
+def set_queue_priority(appointment_id):
+    appointment = Appointment.query.get_or_404(appointment_id)
+    if appointment.doctor_id != current_user.id:
+        abort(403)
+    appointment.queue_priority = max(0, min(request.form.get('priority', 0, type=int), 9))
+    db.session.commit()
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(waiting_room.queue(current_user.id))
+    return redirect(url_for('doctor.dashboard'))
+
+@bp.route('/appointment/<int:id>/start', methods=['POST'])
+@login_required
+@doctor_required
+def start_consultation(id):
+    appointment = Appointment.query.get_or_404(id)
+    if appointment.doctor_id != current_user.id:
+        abort(403)
+    if appointment.status in ('scheduled', 'checked_in'):
+        appointment.status = 'in_consultation'
+        db.session.commit()
+    return redirect(url_for('doctor.view_appointment', appointment_id=appointment.id))
+
 @bp.route('/appointments')
 @login_required
 @doctor_required
@@ -67,17 +125,36 @@ def view_appointment(appointment_id):
     if appointment.doctor_id != current_user.id:
         flash('You do not have permission to view this appointment.', 'danger')
         return redirect(url_for('doctor.appointments'))
+    audit_access('appointment', appointment.id, appointment.patient_id)
     
     diagnosis_form = DiagnosisForm()
     prescription_form = PrescriptionForm()
     
+    interactions = []
     if diagnosis_form.validate_on_submit() and prescription_form.validate_on_submit():
+        # Check interactions before anything is saved or reaches the pharmacy
+        if prescription_form.medications.data:
+            interactions = check_prescription(appointment.patient_id,
+                                              [med['medication_id'] for med in prescription_form.medications.data])
+        if any(warning['severity'] in CONFIRM_SEVERITIES for warning in interactions) \
+                and not request.form.get('confirm_interactions'):
+            flash('This prescription has serious interactions. Review them below, '
+                  'and change the medications or confirm to prescribe anyway.', 'danger')
+            return render_template('doctor/view_appointment.html',
+                                 title='Appointment Details',
+                                 appointment=appointment,
+                                 diagnosis_form=diagnosis_form,
+                                 prescription_form=prescription_form,
+                                 interactions=interactions,
+                                 timeline=_history(appointment))
+
         # Update appointment status and diagnosis
         appointment.status = 'completed'
         appointment.diagnosis = diagnosis_form.diagnosis.data
         appointment.notes = diagnosis_form.notes.data
         
         # Create prescription if medications are provided
+        prescription = None
         if prescription_form.medications.data:
             prescription = Prescription(
                 patient_id=appointment.patient_id,
@@ -110,26 +187,48 @@ def view_appointment(appointment_id):
         
         db.session.commit()
         flash('Consultation completed successfully.', 'success')
+        for warning in interactions:
+            flash(_interaction_message(warning),
+                  'danger' if warning['severity'] in CONFIRM_SEVERITIES else 'warning')
         return redirect(url_for('doctor.dashboard'))
     
-    # Get patient history
-    previous_appointments = Appointment.query.filter(
-        Appointment.patient_id == appointment.patient_id,
-        Appointment.id != appointment.id,
-        Appointment.status == 'completed'
-    ).order_by(Appointment.appointment_date.desc()).all()
-    
-    previous_prescriptions = Prescription.query.filter(
-        Prescription.patient_id == appointment.patient_id
-    ).order_by(Prescription.prescription_date.desc()).all()
+    # Get patient history, one page at a time
+    timeline = _history(appointment, cursor=request.args.get('cursor'))
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(timeline)
     
     return render_template('doctor/view_appointment.html',
                          title='Appointment Details',
                          appointment=appointment,
                          diagnosis_form=diagnosis_form,
                          prescription_form=prescription_form,
-                         previous_appointments=previous_appointments,
-                         previous_prescriptions=previous_prescriptions)
+                         interactions=interactions,
+                         timeline=timeline)
+
+def _history(appointment, cursor=None):
+    # Previous completed appointments and the patient's prescriptions
+    return patient_timeline(
+        appointment.patient_id, kinds=('appointment', 'prescription'), cursor=cursor,
+        filters={'appointment': lambda model: db.and_(model.status == 'completed',
+                                                       model.id != appointment.id)})
+
+def _interaction_message(warning):
+    message = (f"{warning['severity'].capitalize()} interaction: {warning['medication']} "
+               f"with {warning['interacting_medication']}")
+    if warning['prescription_id']:
+        message += f" (prescription #{warning['prescription_id']})"
+    if warning['description']:
+        message += f". {warning['description']}"
+    return message
+
+@bp.route('/patient/<int:patient_id>/interactions')
+@login_required
+@doctor_required
+def check_interactions(patient_id):
+    """Warnings for the medications being prescribed, checked as the form is filled in."""
+    Patient.query.get_or_404(patient_id)
+    medication_ids = request.args.getlist('medication_id', type=int)
+    return jsonify(check_prescription(patient_id, medication_ids))
 
 @bp.route('/prescriptions')
 @login_required
@@ -152,6 +251,26 @@ def view_prescription(prescription_id):
     if prescription.doctor_id != current_user.id:
         flash('You do not have permission to view this prescription.', 'danger')
         return redirect(url_for('doctor.prescriptions'))
+    audit_access('prescription', prescription.id, prescription.patient_id)
     return render_template('doctor/view_prescription.html',
                          title='Prescription Details',
-                         prescription=prescription)
\ No newline at end of file
+                         prescription=prescription)
+
+@bp.route('/lab-test/<int:id>/report/file')
+@login_required
+@doctor_required
+def lab_report_file(id):
+    test = LabTest.query.get_or_404(id)
+    if test.doctor_id != current_user.id or test.stored_report is None:
+        abort(404)
+    audit_access('lab_report', test.id, test.patient_id)
+    return send_stored_file(test.stored_report)
+
+@bp.route('/lab-test/<int:id>/report/<any(thumb, preview):size>')
+@login_required
+@doctor_required
+def lab_report_preview(id, size):
+    test = LabTest.query.get_or_404(id)
+    if test.doctor_id != current_user.id:
+        abort(404)
+    return send_preview(test.stored_report, size)
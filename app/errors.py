@@ -1,4 +1,4 @@
-from flask import render_template
+from flask import render_template, request, jsonify
 from app import db
 
 def init_error_handlers(app):
@@ -13,4 +13,13 @@ def init_error_handlers(app):
 
     @app.errorhandler(403)
     def forbidden_error(error):
-        return render_template('errors/403.html'), 403
\ No newline at end of file
+        return render_template('errors/403.html'), 403
+
+    @app.errorhandler(429)
+    def too_many_requests_error(error):
+        headers = {}
+        if getattr(error, 'retry_after', None):
+            headers['Retry-After'] = str(error.retry_after)
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'error': 'Too many requests', 'retry_after': error.retry_after}), 429, headers
+        return render_template('errors/429.html', retry_after=error.retry_after), 429, headers
\ No newline at end of file
@@ -36,8 +36,9 @@ class LabTestForm(FlaskForm):
     ], default='no')
 
 class TestResultForm(FlaskForm):
+    # Optional when numeric values are entered; they are summarised into it
     results = TextAreaField('Test Results', validators=[
-        DataRequired(),
+        Optional(),
         Length(max=1000)
     ])
     normal_range = StringField('Normal Range', validators=[
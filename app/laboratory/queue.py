@@ -0,0 +1,162 @@
+"""Lab test work queue with priority ordering and claim leases.
+
+Tests are handed out emergency first, then urgent, then routine, oldest
+first within a priority. Claiming is a compare-and-set UPDATE: candidate
+rows are picked, then stamped with a fresh claim token only if they are
+still claimable, so two technicians polling at the same moment can never
+both win a test. A claim holds a lease; tests whose lease runs out without
+being renewed or completed go back to the queue: ``claimable`` treats them
+as pending, so the next claim picks them up without a sweep.
+"""
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.models import LabTest
+from app.utils.events import record_status_changes
+
+PRIORITY_ORDER = {'emergency': 0, 'urgent': 1, 'routine': 2}
+
+priority_rank = db.case(PRIORITY_ORDER, value=LabTest.priority, else_=len(PRIORITY_ORDER))
+
+
+def _lease_seconds():
+    return current_app.config['LAB_QUEUE_LEASE_SECONDS']
+
+
+def claimable(now):
+    """Filter for tests that are pending or whose lease has expired."""
+    return db.or_(
+        LabTest.status == 'pending',
+        db.and_(LabTest.status == 'in_progress', LabTest.lease_expires_at < now)
+    )
+
+
+def queue_order():
+    return (priority_rank, LabTest.created_at, LabTest.id)
+
+
+def pending_query():
+    """Pending and abandoned tests in the order they will be handed out."""
+    return LabTest.query.filter(claimable(datetime.utcnow())).order_by(*queue_order())
+
+
+def claim_next(user_id, count=1, attempts=3):
+    """Atomically claim up to ``count`` tests for ``user_id``.
+
+    Returns the claimed tests and the claim token that must accompany
+    renewals. Losing a race for a candidate row just means another pass
+    over the queue, up to ``attempts`` times.
+    """
+    count = min(count, current_app.config['LAB_QUEUE_MAX_CLAIM'])
+    token = uuid.uuid4().hex
+    claimed = 0
+    for _ in range(attempts):
+        now = datetime.utcnow()
+        candidates = db.session.query(LabTest.id)\
+            .filter(claimable(now))\
+            .order_by(*queue_order())\
+            .limit(count - claimed)
+        if db.engine.dialect.name == 'postgresql':
+            candidates = candidates.with_for_update(skip_locked=True)
+        ids = [row.id for row in candidates]
+        if not ids:
+            break
+        won = LabTest.query.filter(LabTest.id.in_(ids), claimable(now))\
+            .update({
+                LabTest.status: 'in_progress',
+                LabTest.claimed_by: user_id,
+                LabTest.claim_token: token,
+                LabTest.lease_expires_at: now + timedelta(seconds=_lease_seconds())
+            }, synchronize_session=False)
+        if won:
+            record_status_changes(LabTest, [row.id for row in db.session.query(LabTest.id)
+                                            .filter(LabTest.id.in_(ids), LabTest.claim_token == token)])
+        db.session.commit()
+        claimed += won
+        if claimed >= count:
+            break
+    tests = LabTest.query.filter_by(claim_token=token).order_by(*queue_order()).all()
+    return tests, token
+
+
+def renew(user_id, token, test_ids=None):
+    """Extend the lease on tests still held under ``token``; returns the count."""
+    now = datetime.utcnow()
+    query = LabTest.query.filter(
+        LabTest.claim_token == token,
+        LabTest.claimed_by == user_id,
+        LabTest.status == 'in_progress',
+        LabTest.lease_expires_at >= now
+    )
+    if test_ids:
+        query = query.filter(LabTest.id.in_(test_ids))
+    renewed = query.update({
+        LabTest.lease_expires_at: now + timedelta(seconds=_lease_seconds())
+    }, synchronize_session=False)
+    db.session.commit()
+    return renewed
+
+
+def _held_by(test_id, user_id):
+    # A lapsed lease still counts as held until someone else claims the test
+    return LabTest.query.filter(
+        LabTest.id == test_id,
+        LabTest.claimed_by == user_id,
+        LabTest.status == 'in_progress'
+    )
+
+
+def complete(test_id, user_id, results, values=None):
+    """Record results for a test claimed by ``user_id``; None if not held.
+
+    ``values`` are structured result rows (see ``app.utils.lab_results``),
+    summarised into ``results`` when that is empty. Returns the saved rows
+    with their flags.
+    """
+    prepared = []
+    if values:
+        from app.utils.lab_results import prepare, store, summary
+        prepared = prepare(values)
+        results = results or summary(prepared)
+    done = _held_by(test_id, user_id).update({
+        LabTest.status: 'completed',
+        LabTest.results: results,
+        LabTest.lease_expires_at: None
+    }, synchronize_session=False)
+    if not done:
+        db.session.rollback()
+        return None
+    if prepared:
+        test = db.session.query(LabTest.patient_id, LabTest.test_date)\
+            .filter(LabTest.id == test_id).one()
+        store(test_id, test.patient_id, test.test_date, prepared)
+    record_status_changes(LabTest, [test_id])
+    db.session.commit()
+    return prepared
+
+
+def release(test_id, user_id):
+    """Hand a claimed test back to the queue; False if not held."""
+    released = _held_by(test_id, user_id).update({
+        LabTest.status: 'pending',
+        LabTest.claimed_by: None,
+        LabTest.claim_token: None,
+        LabTest.lease_expires_at: None
+    }, synchronize_session=False)
+    if released:
+        record_status_changes(LabTest, [test_id])
+    db.session.commit()
+    return bool(released)
+
+
+def test_to_dict(test):
+    return {
+        'id': test.id,
+        'patient_id': test.patient_id,
+        'test_type': test.test_type,
+        'priority': test.priority,
+        'status': test.status,
+        'created_at': test.created_at.isoformat() if test.created_at else None,
+        'lease_expires_at': test.lease_expires_at.isoformat() if test.lease_expires_at else None
+    }
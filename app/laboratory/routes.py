@@ -1,12 +1,19 @@
-from flask import render_template, redirect, url_for, flash, request, current_app, send_file
+from flask import render_template, redirect, url_for, flash, request, current_app, jsonify, abort
 from flask_login import login_required, current_user
 from app import db
 from app.laboratory import bp
+from app.laboratory import queue
 from app.laboratory.forms import LabTestForm, TestResultForm
 from app.models import LabTest, Patient
-from app.utils.decorators import lab_technician_required
+from app.utils.audit import audit_access
+from app.utils.decorators import lab_technician_required, roles_required
+from app.utils.events import sse_response, LABORATORY_CHANNEL
 from app.utils.helpers import generate_lab_report_pdf
-from datetime import datetime
+from app.utils.previews import schedule_previews, send_preview
+from app.utils.storage import save_stream, save_upload, send_stored_file
+from app.utils.timeline import patient_timeline
+from datetime import datetime, timedelta
+from werkzeug.utils import secure_filename
 
 @bp.route('/dashboard')
 @login_required
@@ -33,6 +40,12 @@ def dashboard():
                          completed_today=completed_today,
                          recent_results=recent_results)
 
+@bp.route('/events')
+@login_required
+@lab_technician_required
+def events():
+    return sse_response(LABORATORY_CHANNEL)
+
 @bp.route('/tests')
 @login_required
 @lab_technician_required
@@ -40,11 +53,15 @@ def tests():
     page = request.args.get('page', 1, type=int)
     status = request.args.get('status', 'pending')
     
-    query = LabTest.query
-    if status != 'all':
-        query = query.filter_by(status=status)
+    if status == 'pending':
+        query = queue.pending_query()
+    else:
+        query = LabTest.query
+        if status != 'all':
+            query = query.filter_by(status=status)
+        query = query.order_by(LabTest.requested_date.desc())
     
-    tests = query.order_by(LabTest.requested_date.desc()).paginate(
+    tests = query.paginate(
         page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
     
     return render_template('laboratory/tests.html',
@@ -52,6 +69,63 @@ def tests():
                          tests=tests,
                          status=status)
 
+@bp.route('/queue')
+@login_required
+@lab_technician_required
+def work_queue():
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    tests = queue.pending_query().limit(limit).all()
+    return jsonify({'tests': [queue.test_to_dict(t) for t in tests]})
+
+@bp.route('/queue/claim', methods=['POST'])
+@login_required
+@lab_technician_required
+def claim_tests():
+    data = request.get_json(silent=True) or {}
+    try:
+        count = max(int(data.get('count', 1)), 1)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'count must be a number'}), 400
+    tests, token = queue.claim_next(current_user.id, count)
+    return jsonify({
+        'token': token,
+        'tests': [queue.test_to_dict(t) for t in tests]
+    })
+
+@bp.route('/queue/renew', methods=['POST'])
+@login_required
+@lab_technician_required
+def renew_claim():
+    data = request.get_json(silent=True) or {}
+    if not data.get('token'):
+        return jsonify({'error': 'token is required'}), 400
+    renewed = queue.renew(current_user.id, data['token'], data.get('test_ids'))
+    return jsonify({'renewed': renewed})
+
+@bp.route('/queue/<int:id>/complete', methods=['POST'])
+@login_required
+@lab_technician_required
+def complete_claimed_test(id):
+    data = request.get_json(silent=True) or {}
+    if not data.get('results') and not data.get('values'):
+        return jsonify({'error': 'results or values are required'}), 400
+    from app.utils.lab_results import InvalidResult, critical
+    try:
+        saved = queue.complete(id, current_user.id, data.get('results'), data.get('values'))
+    except InvalidResult as e:
+        return jsonify({'error': str(e)}), 400
+    if saved is None:
+        return jsonify({'error': 'Test is not claimed by you.'}), 409
+    return jsonify({'completed': id, 'values': saved, 'critical': critical(saved)})
+
+@bp.route('/queue/<int:id>/release', methods=['POST'])
+@login_required
+@lab_technician_required
+def release_claimed_test(id):
+    if not queue.release(id, current_user.id):
+        return jsonify({'error': 'Test is not claimed by you.'}), 409
+    return jsonify({'released': id})
+
 @bp.route('/test/new', methods=['GET', 'POST'])
 @login_required
 @lab_technician_required
@@ -62,6 +136,7 @@ def new_test():
                       test_type=form.test_type.data,
                       doctor_id=form.doctor_id.data,
                       notes=form.notes.data,
+                      priority=form.priority.data,
                       requested_by=current_user.id,
                       status='pending')
         db.session.add(test)
@@ -77,24 +152,52 @@ def new_test():
 @lab_technician_required
 def view_test(id):
     test = LabTest.query.get_or_404(id)
+    audit_access('lab_test', test.id, test.patient_id)
     form = TestResultForm(obj=test)
     
+    from app.utils.lab_results import InvalidResult, critical, for_test, save_results, summary
     if form.validate_on_submit():
-        test.results = form.results.data
+        # Values are replaced only when the form carried the value rows
+        values_posted = 'analyte[]' in request.form
+        values = [dict(zip(('analyte', 'value', 'unit', 'reference_low', 'reference_high'), row))
+                  for row in zip(*(request.form.getlist(f'{field}[]') for field in
+                                   ('analyte', 'value', 'unit', 'reference_low', 'reference_high')))
+                  if row[0].strip() or row[1].strip()]
+        if not values and not form.results.data:
+            flash('Enter the results or at least one value.', 'warning')
+            return render_template('laboratory/view_test.html', title='View Test', test=test, form=form,
+                                   values=for_test(test.id))
+        saved = []
+        if values_posted:
+            try:
+                saved = save_results(test.id, test.patient_id, test.test_date, values)
+            except InvalidResult as e:
+                db.session.rollback()
+                flash(str(e), 'danger')
+                return render_template('laboratory/view_test.html', title='View Test', test=test,
+                                       form=form, values=values)
+        test.results = form.results.data or summary(saved)
         test.normal_range = form.normal_range.data
         test.status = 'completed'
         test.completed_date = datetime.now()
         test.completed_by = current_user.id
         test.remarks = form.remarks.data
+        # A generated report is now stale; uploaded ones are kept
+        if test.stored_report is not None and test.stored_report.uploaded_by is None:
+            test.report_file_id = None
         
         db.session.commit()
         flash('Test results updated successfully.', 'success')
+        for row in critical(saved):
+            flash(f'Critical value: {row["analyte"]} {row["value"]:g} {row["unit"] or ""}'.rstrip()
+                  + '. Notify the requesting doctor.', 'danger')
         return redirect(url_for('laboratory.tests'))
     
     return render_template('laboratory/view_test.html',
                          title='View Test',
                          test=test,
-                         form=form)
+                         form=form,
+                         values=for_test(test.id))
 
 @bp.route('/test/<int:id>/report')
 @login_required
@@ -105,21 +208,108 @@ def generate_report(id):
         flash('Cannot generate report for incomplete test.', 'warning')
         return redirect(url_for('laboratory.view_test', id=id))
     
-    # Generate PDF report
-    filename = generate_lab_report_pdf(test)
-    return send_file(filename,
-                     as_attachment=True,
-                     download_name=f'lab_report_{test.id}.pdf')
+    # Generate the PDF once and serve the stored copy afterwards
+    if test.stored_report is None:
+        test.stored_report = generate_lab_report_pdf(test)
+        db.session.commit()
+    return send_stored_file(test.stored_report,
+                            as_attachment=True,
+                            download_name=f'lab_report_{test.id}.pdf')
+
+@bp.route('/test/<int:id>/report/upload', methods=['POST'])
+@login_required
+@lab_technician_required
+def upload_report(id):
+    test = LabTest.query.get_or_404(id)
+    file = request.files.get('file')
+    if file is not None and file.filename:
+        stored = save_upload(file, uploaded_by=current_user.id)
+    elif request.content_length and not request.form:
+        # Raw body (e.g. from a scanner); streamed, never held in memory
+        filename = secure_filename(request.headers.get('X-Filename', '')) or f'lab_report_{test.id}'
+        stored = save_stream(request.stream, filename, uploaded_by=current_user.id)
+    else:
+        abort(400)
+    test.stored_report = stored
+    db.session.commit()
+    schedule_previews(stored)
+    
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'id': stored.id, 'sha256': stored.sha256, 'size': stored.size,
+                        'url': url_for('laboratory.report_file', id=test.id)})
+    flash('Report uploaded successfully.', 'success')
+    return redirect(url_for('laboratory.view_test', id=id))
+
+@bp.route('/test/<int:id>/report/file')
+@login_required
+@lab_technician_required
+def report_file(id):
+    test = LabTest.query.get_or_404(id)
+    if test.stored_report is None:
+        abort(404)
+    audit_access('lab_report', test.id, test.patient_id)
+    return send_stored_file(test.stored_report)
+
+@bp.route('/test/<int:id>/report/<any(thumb, preview):size>')
+@login_required
+@lab_technician_required
+def report_preview(id, size):
+    test = LabTest.query.get_or_404(id)
+    return send_preview(test.stored_report, size)
 
 @bp.route('/patient/<int:patient_id>/history')
 @login_required
 @lab_technician_required
 def patient_history(patient_id):
     patient = Patient.query.get_or_404(patient_id)
-    tests = LabTest.query.filter_by(patient_id=patient_id).order_by(
-        LabTest.requested_date.desc()).all()
+    timeline = patient_timeline(patient_id, kinds=('lab_test',),
+                                cursor=request.args.get('cursor'))
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(timeline)
     
     return render_template('laboratory/patient_history.html',
                          title='Patient Test History',
                          patient=patient,
-                         tests=tests)
\ No newline at end of file
+                         timeline=timeline)
+
+def _date_arg(name, default=None):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+@bp.route('/patient/<int:patient_id>/trend')
+@login_required
+@roles_required('doctor', 'lab_technician', 'admin')
+def result_trend(patient_id):
+    from app.utils.lab_results import trend
+    analytes = [name for name in request.args.get('analyte', '').split(',') if name.strip()]
+    if not analytes:
+        return jsonify({'error': 'analyte is required'}), 400
+    patient = Patient.query.get_or_404(patient_id)
+    audit_access('lab_results', patient.id, patient.id)
+    start, end = _date_arg('from'), _date_arg('to')
+    return jsonify({'patient_id': patient.id,
+                    'trends': {name.strip(): trend(patient.id, name, start, end)
+                               for name in analytes}})
+
+@bp.route('/results/cohort')
+@login_required
+@roles_required('doctor', 'lab_technician', 'admin')
+def result_cohort():
+    from app.utils.lab_results import cohort, ABNORMAL_FLAGS, CRITICAL_FLAGS
+    if not request.args.get('analyte'):
+        return jsonify({'error': 'analyte is required'}), 400
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    start = _date_arg('from', today)
+    end = _date_arg('to', start + timedelta(days=1))
+    flags = {'abnormal': ABNORMAL_FLAGS, 'critical': CRITICAL_FLAGS}.get(request.args.get('flag'))
+    return jsonify(cohort(request.args['analyte'], start, end,
+                          above=request.args.get('above', type=float),
+                          below=request.args.get('below', type=float),
+                          flags=flags,
+                          cursor=request.args.get('cursor'),
+                          limit=max(request.args.get('limit', 100, type=int), 1)))
@@ -1,10 +1,21 @@
-from flask import render_template, redirect, url_for, flash, request, current_app
+from flask import render_template, redirect, url_for, flash, request, current_app, jsonify, Response, abort
 from flask_login import current_user, login_required
 from app import db
 from app.main import bp
 from app.models import User, Patient, Appointment
 from app.main.forms import PatientRegistrationForm, AppointmentForm
+from app.utils.audit import audit_access
+from app.utils.checkin import check_in, checkin_token, qr_png, InvalidCheckIn
+from app.utils.dashboard import load_dashboard
+from app.utils.decorators import roles_required
+from app.utils.dedup import find_matches
+from app.utils.ratelimit import rate_limit
+from app.utils.timeline import patient_timeline
+from app.utils.helpers import send_appointment_confirmation
+from app.utils.typeahead import medication_index
+from app.utils.waiting_room import waiting_room
 from datetime import datetime
+import hmac
 
 @bp.route('/')
 @bp.route('/index')
@@ -16,104 +27,30 @@ def index():
 @bp.route('/dashboard')
 @login_required
 def dashboard():
-    stats = get_user_stats()
-    recent_activities = get_recent_activities()
-    upcoming_events = get_upcoming_events()
+    data = load_dashboard(current_user)
     return render_template('main/dashboard.html',
                          title='Dashboard',
-                         stats=stats,
-                         recent_activities=recent_activities,
-                         upcoming_events=upcoming_events)
+                         stats=data['stats'],
+                         recent_activities=data['activities'],
+                         upcoming_events=data['events'])
 
 @bp.route('/dashboard/data')
 @login_required
 def dashboard_data():
-    return {
-        'stats': get_user_stats(),
-        'activities': get_recent_activities(),
-        'events': get_upcoming_events()
-    }
-
-def get_user_stats():
-    stats = {}
-    if current_user.role == 'admin':
-        stats['total_patients'] = Patient.query.count()
-    
-    if current_user.role in ['admin', 'doctor', 'receptionist']:
-        today = datetime.now().date()
-        stats['today_appointments'] = Appointment.query.filter(
-            Appointment.appointment_date.cast(db.Date) == today
-        ).count()
-    
-    if current_user.role == 'pharmacist':
-        from app.models import Medication
-        stats['low_stock_items'] = Medication.query.filter(
-            Medication.quantity <= Medication.reorder_level
-        ).count()
-    
-    if current_user.role == 'lab_technician':
-        from app.models import LabTest
-        stats['pending_tests'] = LabTest.query.filter_by(status='pending').count()
-    
-    return stats
-
-def get_recent_activities():
-    activities = []
-    if current_user.role == 'admin':
-        # Get recent patient registrations
-        recent_patients = Patient.query.order_by(Patient.created_at.desc()).limit(5).all()
-        for patient in recent_patients:
-            activities.append({
-                'title': 'New Patient Registration',
-                'description': f'{patient.first_name} {patient.last_name}',
-                'time': patient.created_at.strftime('%Y-%m-%d %H:%M'),
-                'user': 'System'
-            })
-    
-    # Get recent appointments
-    recent_appointments = Appointment.query
-    if current_user.role == 'doctor':
-        recent_appointments = recent_appointments.filter_by(doctor_id=current_user.id)
-    recent_appointments = recent_appointments.order_by(Appointment.created_at.desc()).limit(5).all()
-    
-    for appointment in recent_appointments:
-        activities.append({
-            'title': 'New Appointment',
-            'description': f'Appointment scheduled for {appointment.patient.first_name} {appointment.patient.last_name}',
-            'time': appointment.created_at.strftime('%Y-%m-%d %H:%M'),
-            'user': f'Dr. {appointment.doctor.first_name} {appointment.doctor.last_name}'
-        })
-    
-    return activities
-
-def get_upcoming_events():
-    events = []
-    today = datetime.now().date()
-    
-    # Get upcoming appointments
-    upcoming_appointments = Appointment.query
-    if current_user.role == 'doctor':
-        upcoming_appointments = upcoming_appointments.filter_by(doctor_id=current_user.id)
-    upcoming_appointments = upcoming_appointments.filter(
-        Appointment.appointment_date > datetime.now()
-    ).order_by(Appointment.appointment_date).limit(5).all()
-    
-    for appointment in upcoming_appointments:
-        events.append({
-            'title': 'Appointment',
-            'description': f'Patient: {appointment.patient.first_name} {appointment.patient.last_name}',
-            'date': appointment.appointment_date.strftime('%Y-%m-%d'),
-            'time': appointment.appointment_date.strftime('%H:%M')
-        })
-    
-    return events
-
+    return load_dashboard(current_user)
 
 @bp.route('/register_patient', methods=['GET', 'POST'])
 @login_required
 def register_patient():
     form = PatientRegistrationForm()
     if form.validate_on_submit():
+        duplicates = find_matches(form.first_name.data, form.last_name.data,
+                                  form.date_of_birth.data, form.phone.data, form.email.data)
+        if duplicates and not request.form.get('confirm_new'):
+            flash('This patient may already be registered. Check the matches below, '
+                  'or confirm to register a new patient.', 'warning')
+            return render_template('main/register_patient.html', title='Register Patient',
+                                   form=form, duplicates=duplicates)
         patient = Patient(
             first_name=form.first_name.data,
             last_name=form.last_name.data,
@@ -130,12 +67,35 @@ def register_patient():
         return redirect(url_for('main.view_patient', patient_id=patient.id))
     return render_template('main/register_patient.html', title='Register Patient', form=form)
 
+@bp.route('/patients/duplicates')
+@login_required
+@roles_required('receptionist', 'admin')
+def check_duplicates():
+    """Possible existing records for a patient being registered, for the inline warning."""
+    try:
+        date_of_birth = datetime.strptime(request.args.get('date_of_birth', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_of_birth = None
+    matches = find_matches(request.args.get('first_name', ''), request.args.get('last_name', ''),
+                           date_of_birth, request.args.get('phone', ''), request.args.get('email'),
+                           exclude_id=request.args.get('exclude_id', type=int))
+    return jsonify([{'id': patient.id,
+                     'name': f'{patient.first_name} {patient.last_name}',
+                     'date_of_birth': patient.date_of_birth.isoformat(),
+                     'phone': patient.phone,
+                     'score': value,
+                     'url': url_for('main.view_patient', patient_id=patient.id)}
+                    for value, patient in matches])
+
 @bp.route('/patient/<int:patient_id>')
 @login_required
 def view_patient(patient_id):
     patient = Patient.query.get_or_404(patient_id)
-    appointments = Appointment.query.filter_by(patient_id=patient_id).order_by(Appointment.appointment_date.desc()).all()
-    return render_template('main/view_patient.html', title='Patient Details', patient=patient, appointments=appointments)
+    audit_access('patient', patient.id, patient.id)
+    timeline = patient_timeline(patient_id, cursor=request.args.get('cursor'))
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(timeline)
+    return render_template('main/view_patient.html', title='Patient Details', patient=patient, timeline=timeline)
 
 @bp.route('/schedule_appointment/<int:patient_id>', methods=['GET', 'POST'])
 @login_required
@@ -157,7 +117,8 @@ def schedule_appointment(patient_id):
         db.session.add(appointment)
         db.session.commit()
         
-        # TODO: Send email notification
+        if patient.email:
+            send_appointment_confirmation(appointment)
         
         flash('Appointment scheduled successfully!', 'success')
         return redirect(url_for('main.view_patient', patient_id=patient.id))
@@ -169,6 +130,7 @@ def schedule_appointment(patient_id):
 
 @bp.route('/search_patients')
 @login_required
+@rate_limit('30/minute', per='user')
 def search_patients():
     query = request.args.get('query', '')
     if query:
@@ -182,4 +144,74 @@ def search_patients():
     return render_template('main/search_patients.html', 
                          title='Search Patients',
                          patients=patients,
-                         query=query)
\ No newline at end of file
+                         query=query)
+
+@bp.route('/medications/typeahead')
+@login_required
+def medication_typeahead():
+    if current_user.role not in ('doctor', 'pharmacist'):
+        return jsonify([]), 403
+    return jsonify(medication_index.search(request.args.get('q', ''),
+                                           limit=min(request.args.get('limit', 10, type=int), 50)))
+
+@bp.route('/appointment/<int:appointment_id>/slip')
+@login_required
+def appointment_slip(appointment_id):
+    appointment = Appointment.query.get_or_404(appointment_id)
+    return render_template('main/appointment_slip.html',
+                         title='Appointment Slip',
+                         appointment=appointment)
+
+@bp.route('/appointment/<int:appointment_id>/checkin.png')
+@login_required
+def appointment_checkin_qr(appointment_id):
+    appointment = Appointment.query.get_or_404(appointment_id)
+    response = Response(qr_png(checkin_token(appointment)), mimetype='image/png')
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    return response
+
+@bp.route('/appointment/<int:appointment_id>/check_in', methods=['POST'])
+@login_required
+def check_in_appointment(appointment_id):
+    """Front-desk check-in, for patients without their code."""
+    appointment = Appointment.query.get_or_404(appointment_id)
+    if appointment.status == 'scheduled':
+        appointment.status = 'checked_in'
+        appointment.checked_in_at = datetime.utcnow()
+        db.session.commit()
+        flash('Patient checked in.', 'success')
+    else:
+        flash(f'This appointment is {appointment.status.replace("_", " ")}.', 'warning')
+    return redirect(url_for('main.view_patient', patient_id=appointment.patient_id))
+
+def _kiosk_allowed():
+    """Signed-in staff, or a kiosk sending the configured key; closed when no key is set."""
+    if current_user.is_authenticated:
+        return True
+    kiosk_key = current_app.config['CHECKIN_KIOSK_KEY']
+    return bool(kiosk_key) and hmac.compare_digest(request.headers.get('X-Kiosk-Key', ''), kiosk_key)
+
+@bp.route('/waiting-room')
+def waiting_room_display():
+    """Queues for a waiting-room screen, read from memory."""
+    if not _kiosk_allowed():
+        abort(403)
+    doctor_ids = set(request.args.getlist('doctor_id', type=int)) or None
+    return jsonify({'doctors': waiting_room.display(doctor_ids)})
+
+@bp.route('/kiosk/checkin', methods=['POST'])
+def kiosk_checkin():
+    """Check in from a scanned QR code; verifies the token without a query."""
+    if not _kiosk_allowed():
+        abort(403)
+    data = request.get_json(silent=True) if request.is_json else request.form
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object with a token.'}), 400
+    try:
+        claims = check_in(data.get('token', ''))
+    except InvalidCheckIn as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'status': 'checked_in',
+                    'appointment_id': claims['apt'],
+                    'appointment_time': datetime.fromtimestamp(claims['at']).strftime('%H:%M')})
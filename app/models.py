@@ -10,6 +10,7 @@ class User(UserMixin, db.Model):
     first_name = db.Column(db.String(64))
     last_name = db.Column(db.String(64))
     role = db.Column(db.String(20), nullable=False)
+    department = db.Column(db.String(64))  # doctors' clinic, for staffing forecasts
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -36,19 +37,38 @@ class Patient(db.Model):
     phone = db.Column(db.String(20), nullable=False)
     email = db.Column(db.String(120))
     address = db.Column(db.String(200))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Duplicate-detection blocking keys, kept up to date by app/utils/dedup.py
+    phone_key = db.Column(db.String(20), index=True)
+    name_key = db.Column(db.String(4))  # soundex of last_name
+    first_name_key = db.Column(db.String(4))  # soundex of first_name
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     appointments = db.relationship('Appointment', backref='patient', lazy=True)
     prescriptions = db.relationship('Prescription', backref='patient', lazy=True)
     lab_tests = db.relationship('LabTest', backref='patient', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_patient_birth_name_key', 'date_of_birth', 'name_key'),
+        db.Index('ix_patient_birth_first_name_key', 'date_of_birth', 'first_name_key'),
+    )
+
 class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    appointment_date = db.Column(db.DateTime, nullable=False)
-    status = db.Column(db.String(20), default='scheduled')  # scheduled, completed, cancelled
+    appointment_date = db.Column(db.DateTime, nullable=False, index=True)
+    status = db.Column(db.String(20), default='scheduled')  # scheduled, checked_in, in_consultation, completed, cancelled
     notes = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    checked_in_at = db.Column(db.DateTime)
+    queue_priority = db.Column(db.Integer, default=0)  # waiting-room order: higher is seen first
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    doctor = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_appointment_patient_date', 'patient_id', 'appointment_date'),
+        db.Index('ix_appointment_status_date', 'status', 'appointment_date'),
+    )
 
 class Prescription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -56,15 +76,26 @@ class Prescription(db.Model):
     doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     diagnosis = db.Column(db.Text, nullable=False)
     prescription_date = db.Column(db.DateTime, default=datetime.utcnow)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, dispensed, cancelled
+    dispensed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    dispensed_at = db.Column(db.DateTime, index=True)
+    dispensing_notes = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     medications = db.relationship('PrescriptionMedication', backref='prescription', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_prescription_patient_date', 'patient_id', 'prescription_date'),
+    )
+
 class PrescriptionMedication(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    prescription_id = db.Column(db.Integer, db.ForeignKey('prescription.id'), nullable=False)
+    prescription_id = db.Column(db.Integer, db.ForeignKey('prescription.id'), nullable=False, index=True)
     medication_id = db.Column(db.Integer, db.ForeignKey('medication.id'), nullable=False)
     dosage = db.Column(db.String(50), nullable=False)
     frequency = db.Column(db.String(50), nullable=False)
     duration = db.Column(db.String(50), nullable=False)
+    quantity = db.Column(db.Integer, default=1, nullable=False)
+    medication = db.relationship('Medication')
 
 class Medication(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -72,8 +103,11 @@ class Medication(db.Model):
     description = db.Column(db.Text)
     unit = db.Column(db.String(20))
     quantity_in_stock = db.Column(db.Integer, default=0)
+    stock_quantity = db.synonym('quantity_in_stock')
     price = db.Column(db.Float, nullable=False)
+    lead_time_days = db.Column(db.Integer)  # supplier delivery time; REORDER_LEAD_TIME_DAYS if unset
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class LabTest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -81,10 +115,41 @@ class LabTest(db.Model):
     doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     test_type = db.Column(db.String(100), nullable=False)
     test_date = db.Column(db.DateTime, nullable=False)
-    status = db.Column(db.String(20), default='pending')  # pending, completed, cancelled
+    status = db.Column(db.String(20), default='pending')  # pending, in_progress, completed, cancelled
+    priority = db.Column(db.String(20), default='routine')  # routine, urgent, emergency
     results = db.Column(db.Text)
     report_file = db.Column(db.String(200))
+    report_file_id = db.Column(db.Integer, db.ForeignKey('stored_file.id'))
+    stored_report = db.relationship('StoredFile')
+    claimed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    claim_token = db.Column(db.String(32), index=True)
+    lease_expires_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_lab_test_queue', 'status', 'lease_expires_at'),
+        db.Index('ix_lab_test_patient_date', 'patient_id', 'test_date'),
+    )
+
+class LabResult(db.Model):
+    """One numeric result value of a lab test (see app/utils/lab_results.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    lab_test_id = db.Column(db.Integer, db.ForeignKey('lab_test.id'), nullable=False, index=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    analyte = db.Column(db.String(32), nullable=False)  # code, e.g. potassium, hba1c
+    value = db.Column(db.Float, nullable=False)
+    unit = db.Column(db.String(20))
+    reference_low = db.Column(db.Float)
+    reference_high = db.Column(db.Float)
+    flag = db.Column(db.String(2))  # LL, L, N, H, HH; None without a reference range
+    observed_at = db.Column(db.DateTime, nullable=False)  # the test's test_date
+
+    __table_args__ = (
+        db.Index('ix_lab_result_patient_analyte_time', 'patient_id', 'analyte', 'observed_at'),
+        # value included so cohort filters are answered from the index
+        db.Index('ix_lab_result_analyte_time', 'analyte', 'observed_at', 'value'),
+    )
 
 class Bill(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -93,14 +158,160 @@ class Bill(db.Model):
     total_amount = db.Column(db.Float, nullable=False)
     payment_status = db.Column(db.String(20), default='pending')  # pending, paid, cancelled
     payment_method = db.Column(db.String(50))
+    billing_run_id = db.Column(db.Integer, db.ForeignKey('billing_run.id'), index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     items = db.relationship('BillItem', backref='bill', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_bill_patient_date', 'patient_id', 'bill_date'),
+    )
+
 class BillItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    bill_id = db.Column(db.Integer, db.ForeignKey('bill.id'), nullable=False)
+    bill_id = db.Column(db.Integer, db.ForeignKey('bill.id'), nullable=False, index=True)
     item_type = db.Column(db.String(50), nullable=False)  # consultation, medication, lab_test
-    item_id = db.Column(db.Integer, nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)  # appointment, prescription_medication or lab_test id
     description = db.Column(db.String(200), nullable=False)
     quantity = db.Column(db.Integer, default=1)
     unit_price = db.Column(db.Float, nullable=False)
-    total_price = db.Column(db.Float, nullable=False)
\ No newline at end of file
+    total_price = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        # An encounter is billed at most once
+        db.Index('ix_bill_item_source', 'item_type', 'item_id', unique=True),
+    )
+
+class BillingRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    watermark = db.Column(db.DateTime)  # encounters updated before this were considered
+    bills_created = db.Column(db.Integer, default=0)
+    items_created = db.Column(db.Integer, default=0)
+
+class StoredFile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)  # blob name in the store
+    size = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    content_type = db.Column(db.String(100), nullable=False)
+    uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ReminderLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # day, hour
+    appointment_date = db.Column(db.DateTime, nullable=False)  # a rescheduled visit is reminded again
+    sent_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_reminder_log_sent', 'appointment_id', 'kind', 'appointment_date', unique=True),
+    )
+
+class QueueEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(20), nullable=False)  # pharmacy, laboratory, waiting_room
+    event_type = db.Column(db.String(50), nullable=False)  # new_prescription, new_lab_test, status_changed, appointment_changed
+    payload = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class DrugInteraction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # One row per unordered pair, stored with medication_id < interacting_medication_id
+    medication_id = db.Column(db.Integer, db.ForeignKey('medication.id'), nullable=False)
+    interacting_medication_id = db.Column(db.Integer, db.ForeignKey('medication.id'), nullable=False)
+    severity = db.Column(db.String(20), nullable=False)  # minor, moderate, major, contraindicated
+    description = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_drug_interaction_pair', 'medication_id', 'interacting_medication_id', unique=True),
+    )
+
+class DuplicateCandidate(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # One row per pair, stored with patient_id < duplicate_id
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id', ondelete='CASCADE'), nullable=False)
+    duplicate_id = db.Column(db.Integer, db.ForeignKey('patient.id', ondelete='CASCADE'), nullable=False,
+                             index=True)
+    score = db.Column(db.Float, nullable=False)
+    matched_on = db.Column(db.String(50))  # blocking keys the pair shares: phone, birth_name
+    status = db.Column(db.String(20), default='open', index=True)  # open, dismissed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    reviewed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    __table_args__ = (
+        db.Index('ix_duplicate_candidate_pair', 'patient_id', 'duplicate_id', unique=True),
+    )
+
+class PatientMerge(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kept_id = db.Column(db.Integer, nullable=False, index=True)
+    merged_id = db.Column(db.Integer, nullable=False, index=True)
+    merged_record = db.Column(db.Text, nullable=False)  # JSON of the removed patient row
+    moved = db.Column(db.Text)  # JSON: rows re-pointed per table
+    merged_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    merged_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Archive tables hold closed clinical rows past ARCHIVE_AFTER_DAYS (see
+# app/utils/archive.py). They mirror the hot tables' columns and ids but
+# carry no foreign keys, so rows can move in either direction in batches.
+
+def _archive_table(model, *indexes):
+    columns = [db.Column(column.name, column.type, primary_key=column.primary_key,
+                         autoincrement=False, nullable=column.nullable)
+               for column in model.__table__.columns]
+    return db.Table(f'archive_{model.__tablename__}', *columns,
+                    db.Column('archived_at', db.DateTime, nullable=False),
+                    *indexes)
+
+class ArchivedAppointment(db.Model):
+    __table__ = _archive_table(
+        Appointment,
+        db.Index('ix_archive_appointment_patient_date', 'patient_id', 'appointment_date'),
+        db.Index('ix_archive_appointment_date', 'appointment_date'))
+
+class ArchivedPrescription(db.Model):
+    __table__ = _archive_table(
+        Prescription,
+        db.Index('ix_archive_prescription_patient_date', 'patient_id', 'prescription_date'))
+    medications = db.relationship(
+        'ArchivedPrescriptionMedication', viewonly=True,
+        primaryjoin='foreign(ArchivedPrescriptionMedication.prescription_id) == ArchivedPrescription.id')
+
+class ArchivedPrescriptionMedication(db.Model):
+    __table__ = _archive_table(
+        PrescriptionMedication,
+        db.Index('ix_archive_prescription_medication_prescription', 'prescription_id'))
+    medication = db.relationship(
+        'Medication', viewonly=True,
+        primaryjoin='foreign(ArchivedPrescriptionMedication.medication_id) == Medication.id')
+
+class ArchivedLabTest(db.Model):
+    __table__ = _archive_table(
+        LabTest,
+        db.Index('ix_archive_lab_test_patient_date', 'patient_id', 'test_date'))
+
+class ArchivedLabResult(db.Model):
+    __table__ = _archive_table(
+        LabResult,
+        db.Index('ix_archive_lab_result_test', 'lab_test_id'),
+        db.Index('ix_archive_lab_result_patient_analyte_time', 'patient_id', 'analyte', 'observed_at'),
+        db.Index('ix_archive_lab_result_analyte_time', 'analyte', 'observed_at', 'value'))
+
+class ArchivedBill(db.Model):
+    __table__ = _archive_table(
+        Bill,
+        db.Index('ix_archive_bill_patient_date', 'patient_id', 'bill_date'),
+        db.Index('ix_archive_bill_date', 'bill_date'))
+    items = db.relationship(
+        'ArchivedBillItem', viewonly=True,
+        primaryjoin='foreign(ArchivedBillItem.bill_id) == ArchivedBill.id')
+
+class ArchivedBillItem(db.Model):
+    __table__ = _archive_table(
+        BillItem,
+        db.Index('ix_archive_bill_item_bill', 'bill_id'),
+        db.Index('ix_archive_bill_item_source', 'item_type', 'item_id'))
@@ -0,0 +1,134 @@
+"""Set-based prescription dispensing.
+
+All lines of the requested prescriptions are read with their medications in
+one joined query, stock is checked for the whole batch in Python, and the
+decrements are applied with a single guarded UPDATE. If stock moved between
+the read and the write the guard matches fewer rows, the transaction is
+rolled back and the batch is re-planned.
+"""
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app
+from app import db
+from app.models import Medication, Prescription, PrescriptionMedication
+from app.utils.events import record_status_changes
+
+
+class StockConflict(Exception):
+    """Stock or prescription status changed while a batch was being dispensed."""
+
+
+def _load_lines(prescription_ids):
+    return db.session.query(
+        PrescriptionMedication.prescription_id,
+        PrescriptionMedication.medication_id,
+        PrescriptionMedication.quantity,
+        Medication.name,
+        Medication.quantity_in_stock
+    ).join(Medication, Medication.id == PrescriptionMedication.medication_id)\
+     .join(Prescription, Prescription.id == PrescriptionMedication.prescription_id)\
+     .filter(PrescriptionMedication.prescription_id.in_(prescription_ids),
+             Prescription.status == 'pending')\
+     .all()
+
+
+def _pending(prescription_ids):
+    return {row.id for row in db.session.query(Prescription.id).filter(
+        Prescription.id.in_(prescription_ids), Prescription.status == 'pending')}
+
+
+def plan_dispense(prescription_ids):
+    """Split prescriptions into those that can be filled and those that cannot.
+
+    Prescriptions are allocated in the order given, so on a ward round the
+    earlier ones win when two compete for the last units of a medication.
+    A pending prescription without lines has nothing to take from stock and
+    is always fillable, so it can still be cleared from the queue.
+    """
+    lines = defaultdict(list)
+    stock, names = {}, {}
+    for row in _load_lines(prescription_ids):
+        lines[row.prescription_id].append(row)
+        stock[row.medication_id] = row.quantity_in_stock or 0
+        names[row.medication_id] = row.name
+
+    # Only pending prescriptions without lines need a second look
+    pending = _pending([pid for pid in prescription_ids if pid not in lines]) \
+        if len(lines) < len(prescription_ids) else set()
+
+    fillable, shortages = [], {}
+    demand = defaultdict(int)
+    for prescription_id in prescription_ids:
+        if prescription_id not in lines:
+            if prescription_id in pending:
+                fillable.append(prescription_id)
+            continue
+        needed = defaultdict(int)
+        for row in lines[prescription_id]:
+            needed[row.medication_id] += row.quantity
+        short = [
+            {'medication': names[medication_id], 'needed': quantity,
+             'available': stock[medication_id] - demand[medication_id]}
+            for medication_id, quantity in needed.items()
+            if demand[medication_id] + quantity > stock[medication_id]
+        ]
+        if short:
+            shortages[prescription_id] = short
+            continue
+        for medication_id, quantity in needed.items():
+            demand[medication_id] += quantity
+        fillable.append(prescription_id)
+    return fillable, shortages, dict(demand)
+
+
+def _apply(fillable, demand, user_id, notes):
+    if demand:
+        decrement = db.case(demand, value=Medication.id)
+        updated = Medication.query.filter(
+            Medication.id.in_(demand.keys()),
+            Medication.quantity_in_stock >= decrement
+        ).update({Medication.quantity_in_stock: Medication.quantity_in_stock - decrement},
+                 synchronize_session=False)
+        if updated != len(demand):
+            raise StockConflict()
+    dispensed = Prescription.query.filter(
+        Prescription.id.in_(fillable),
+        Prescription.status == 'pending'
+    ).update({
+        Prescription.status: 'dispensed',
+        Prescription.dispensed_by: user_id,
+        Prescription.dispensed_at: datetime.now(),
+        Prescription.dispensing_notes: notes
+    }, synchronize_session=False)
+    if dispensed != len(fillable):
+        raise StockConflict()
+    record_status_changes(Prescription, fillable)
+
+
+def dispense(prescription_ids, user_id, notes=None, attempts=3):
+    """Dispense a batch of prescriptions.
+
+    Returns a dict with the ``dispensed`` ids, ``shortages`` per prescription
+    that could not be filled, and ``skipped`` ids that were not pending.
+    """
+    prescription_ids = list(dict.fromkeys(prescription_ids))
+    limit = current_app.config['PHARMACY_MAX_BATCH_DISPENSE']
+    if len(prescription_ids) > limit:
+        raise ValueError(f'Cannot dispense more than {limit} prescriptions at once.')
+    for attempt in range(attempts):
+        fillable, shortages, demand = plan_dispense(prescription_ids)
+        try:
+            if fillable:
+                _apply(fillable, demand, user_id, notes)
+            db.session.commit()
+            break
+        except StockConflict:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+    handled = set(fillable) | set(shortages)
+    return {
+        'dispensed': fillable,
+        'shortages': shortages,
+        'skipped': [pid for pid in prescription_ids if pid not in handled]
+    }
@@ -38,6 +38,10 @@ class MedicationForm(FlaskForm):
         Optional(),
         NumberRange(min=0)
     ])
+    lead_time_days = IntegerField('Lead Time (days)', validators=[
+        Optional(),
+        NumberRange(min=0)
+    ])
     storage_location = StringField('Storage Location', validators=[
         Optional(),
         Length(max=50)
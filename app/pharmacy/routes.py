@@ -1,11 +1,13 @@
-from flask import render_template, redirect, url_for, flash, request, current_app
+from flask import render_template, redirect, url_for, flash, request, current_app, jsonify, Response
 from flask_login import login_required, current_user
 from app import db
 from app.pharmacy import bp
+from app.pharmacy.dispensing import dispense, StockConflict
 from app.pharmacy.forms import MedicationForm, DispenseMedicationForm, StockUpdateForm
 from app.models import Medication, Prescription, PrescriptionMedication
 from app.utils.decorators import pharmacist_required
-from datetime import datetime
+from app.utils.events import sse_response, PHARMACY_CHANNEL
+from app.utils.typeahead import medication_index
 
 @bp.route('/dashboard')
 @login_required
@@ -22,11 +24,41 @@ def dashboard():
     recent_dispensed = Prescription.query.filter_by(status='dispensed').order_by(
         Prescription.updated_at.desc()).limit(5).all()
     
+    # Tonight's consumption-based purchase order, most urgent first
+    from app.utils.reorder import load_reorder
+    reorder = load_reorder()
+    
     return render_template('pharmacy/dashboard.html',
                          title='Pharmacy Dashboard',
                          low_stock=low_stock,
                          pending_prescriptions=pending_prescriptions,
-                         recent_dispensed=recent_dispensed)
+                         recent_dispensed=recent_dispensed,
+                         reorder=dict(reorder, lines=reorder['lines'][:10]))
+
+@bp.route('/reorder')
+@login_required
+@pharmacist_required
+def reorder():
+    from app.utils.reorder import load_reorder
+    result = load_reorder()
+    if request.args.get('format') != 'csv':
+        return jsonify(result)
+    import csv
+    from io import StringIO
+    columns = ['medication_id', 'name', 'unit', 'stock', 'daily_demand', 'days_of_cover',
+               'runs_out', 'lead_time_days', 'reorder_point', 'order_quantity', 'estimated_cost']
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=columns)
+    writer.writeheader()
+    writer.writerows(result['lines'])
+    return Response(output.getvalue(), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename=purchase-order-{result["start"] or "pending"}.csv'})
+
+@bp.route('/events')
+@login_required
+@pharmacist_required
+def events():
+    return sse_response(PHARMACY_CHANNEL)
 
 @bp.route('/medications')
 @login_required
@@ -58,9 +90,11 @@ def add_medication():
                               unit_price=form.unit_price.data,
                               stock_quantity=form.stock_quantity.data,
                               category=form.category.data,
-                              manufacturer=form.manufacturer.data)
+                              manufacturer=form.manufacturer.data,
+                              lead_time_days=form.lead_time_days.data)
         db.session.add(medication)
         db.session.commit()
+        medication_index.upsert(medication)
         flash('Medication added successfully.', 'success')
         return redirect(url_for('pharmacy.medications'))
     return render_template('pharmacy/add_medication.html',
@@ -80,7 +114,9 @@ def edit_medication(id):
         medication.stock_quantity = form.stock_quantity.data
         medication.category = form.category.data
         medication.manufacturer = form.manufacturer.data
+        medication.lead_time_days = form.lead_time_days.data
         db.session.commit()
+        medication_index.upsert(medication)
         flash('Medication updated successfully.', 'success')
         return redirect(url_for('pharmacy.medications'))
     return render_template('pharmacy/edit_medication.html',
@@ -119,20 +155,21 @@ def dispense_prescription(id):
     form = DispenseMedicationForm()
     
     if form.validate_on_submit():
-        # Update medication stock and mark prescription as dispensed
-        for med in prescription.medications:
-            medication = med.medication
-            if medication.stock_quantity < med.quantity:
-                flash(f'Insufficient stock for {medication.name}', 'danger')
-                return redirect(url_for('pharmacy.dispense_prescription', id=id))
-            medication.stock_quantity -= med.quantity
+        # Check and decrement stock for all lines in one pass
+        try:
+            result = dispense([id], current_user.id, form.notes.data)
+        except StockConflict:
+            flash('Stock changed while dispensing. Please try again.', 'warning')
+            return redirect(url_for('pharmacy.dispense_prescription', id=id))
+        if id in result['shortages']:
+            for short in result['shortages'][id]:
+                flash(f"Insufficient stock for {short['medication']}", 'danger')
+            return redirect(url_for('pharmacy.dispense_prescription', id=id))
+        if id not in result['dispensed']:
+            # Dispensed or cancelled by someone else since the page was loaded
+            flash(f'Prescription #{id} is no longer pending and was not dispensed.', 'warning')
+            return redirect(url_for('pharmacy.prescriptions'))
         
-        prescription.status = 'dispensed'
-        prescription.dispensed_by = current_user.id
-        prescription.dispensed_at = datetime.now()
-        prescription.dispensing_notes = form.notes.data
-        
-        db.session.commit()
         flash('Prescription dispensed successfully.', 'success')
         return redirect(url_for('pharmacy.prescriptions'))
     
@@ -141,6 +178,50 @@ def dispense_prescription(id):
                          prescription=prescription,
                          form=form)
 
+@bp.route('/prescriptions/dispense', methods=['POST'])
+@login_required
+@pharmacist_required
+def dispense_batch():
+    if request.is_json:
+        data = request.get_json(silent=True)
+        prescription_ids = data.get('prescription_ids', []) if isinstance(data, dict) else None
+        if not isinstance(prescription_ids, list) or \
+                not all(isinstance(pid, int) and not isinstance(pid, bool) for pid in prescription_ids):
+            return jsonify({'error': 'prescription_ids must be a list of ids'}), 400
+        notes = data.get('notes')
+    else:
+        form = DispenseMedicationForm()
+        if not form.validate_on_submit():
+            flash('Invalid dispensing request.', 'danger')
+            return redirect(url_for('pharmacy.prescriptions'))
+        prescription_ids = request.form.getlist('prescription_ids')
+        notes = form.notes.data
+    
+    try:
+        result = dispense([int(pid) for pid in prescription_ids], current_user.id, notes)
+    except ValueError as e:
+        if request.is_json:
+            return jsonify({'error': str(e)}), 400
+        flash(str(e), 'danger')
+        return redirect(url_for('pharmacy.prescriptions'))
+    except StockConflict:
+        if request.is_json:
+            return jsonify({'error': 'Stock changed while dispensing. Please try again.'}), 409
+        flash('Stock changed while dispensing. Please try again.', 'warning')
+        return redirect(url_for('pharmacy.prescriptions'))
+    
+    if request.is_json:
+        return jsonify(result)
+    
+    flash(f"{len(result['dispensed'])} prescriptions dispensed.", 'success')
+    for prescription_id, shortages in result['shortages'].items():
+        names = ', '.join(short['medication'] for short in shortages)
+        flash(f'Prescription #{prescription_id}: insufficient stock for {names}', 'danger')
+    if result['skipped']:
+        skipped = ', '.join(f'#{pid}' for pid in result['skipped'])
+        flash(f'Prescriptions not pending, skipped: {skipped}', 'warning')
+    return redirect(url_for('pharmacy.prescriptions'))
+
 @bp.route('/stock/update', methods=['GET', 'POST'])
 @login_required
 @pharmacist_required
@@ -184,4 +184,64 @@ document.addEventListener('DOMContentLoaded', () => {
 
     const popovers = document.querySelectorAll('[data-bs-toggle="popover"]');
     popovers.forEach(popover => new bootstrap.Popover(popover));
-});
\ No newline at end of file
+});
+// Inline duplicate-patient warning on the registration form
+document.addEventListener('DOMContentLoaded', () => {
+    const warning = document.getElementById('duplicate-warning');
+    const form = warning && warning.closest('form');
+    if (!form) {
+        return;
+    }
+    const fields = ['first_name', 'last_name', 'date_of_birth', 'phone', 'email'];
+    const check = debounce(async () => {
+        const params = new URLSearchParams();
+        fields.forEach(name => {
+            const input = form.elements[name];
+            if (input && input.value) {
+                params.append(name, input.value);
+            }
+        });
+        if (!params.has('last_name') || !(params.has('date_of_birth') || params.has('phone'))) {
+            return;
+        }
+        const response = await fetch(`${warning.dataset.url}?${params}`, {
+            headers: { 'X-Requested-With': 'XMLHttpRequest' }
+        });
+        if (!response.ok) {
+            return;
+        }
+        const matches = await response.json();
+        warning.replaceChildren();
+        if (!matches.length) {
+            return;
+        }
+        const alert = document.createElement('div');
+        alert.className = 'alert alert-warning alert-permanent';
+        const heading = document.createElement('h6');
+        heading.className = 'alert-heading';
+        heading.textContent = 'This patient may already be registered';
+        const list = document.createElement('ul');
+        list.className = 'mb-2';
+        matches.forEach(match => {
+            const item = document.createElement('li');
+            const link = document.createElement('a');
+            link.href = match.url;
+            link.target = '_blank';
+            link.textContent = `#${match.id} ${match.name}`;
+            item.append(link, ` · ${match.date_of_birth} · ${match.phone} (${Math.round(match.score * 100)}% match)`);
+            list.appendChild(item);
+        });
+        const confirm = document.createElement('div');
+        confirm.className = 'form-check';
+        confirm.innerHTML = '<input class="form-check-input" type="checkbox" name="confirm_new" value="1" id="confirm_new">' +
+            '<label class="form-check-label" for="confirm_new">None of these is this patient; register a new record</label>';
+        alert.append(heading, list, confirm);
+        warning.appendChild(alert);
+    }, 400);
+    fields.forEach(name => {
+        const input = form.elements[name];
+        if (input) {
+            input.addEventListener('change', check);
+        }
+    });
+});
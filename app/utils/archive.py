@@ -0,0 +1,162 @@
+"""Hot/cold archival of closed clinical records.
+
+``flask archive run`` moves appointments, prescriptions, lab tests and bills
+that are closed and older than ``ARCHIVE_AFTER_DAYS`` into the matching
+``archive_*`` tables, keeping their ids. Each batch of ``ARCHIVE_BATCH_SIZE``
+rows (with their prescription lines, result values or bill items) is copied and deleted in
+one short transaction, so writers are never blocked for long and a crash
+leaves every row in exactly one place. Rows touched within
+``ARCHIVE_MIN_IDLE_DAYS`` stay hot.
+
+``flask archive restore`` moves rows back, e.g. to amend an old record.
+Restoring bumps ``updated_at``, which keeps the rows hot for the idle
+period.
+
+Readers that need full history (the patient timeline, billing's
+already-billed check, admin reports) read both tables; ``combined`` builds
+the UNION ALL for report queries.
+"""
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, insert, literal, select, union_all, update
+from app import db
+from app.models import (Appointment, Prescription, PrescriptionMedication, LabTest, LabResult, Bill,
+                        BillItem, ReminderLog, ArchivedAppointment, ArchivedPrescription,
+                        ArchivedPrescriptionMedication, ArchivedLabTest, ArchivedLabResult,
+                        ArchivedBill, ArchivedBillItem)
+
+
+class ArchiveSpec:
+    def __init__(self, kind, model, archive, time_column, closed, children=(), dependents=()):
+        self.kind = kind
+        self.model = model
+        self.archive = archive
+        self.time_column = time_column
+        self.closed = closed
+        # (hot child, archive child, foreign key column name), moved with the parent
+        self.children = children
+        # (model, foreign key column name), deleted with the parent
+        self.dependents = dependents
+
+
+SPECS = [
+    ArchiveSpec('appointment', Appointment, ArchivedAppointment, 'appointment_date',
+                ('completed', 'cancelled'),
+                dependents=((ReminderLog, 'appointment_id'),)),
+    ArchiveSpec('prescription', Prescription, ArchivedPrescription, 'prescription_date',
+                ('dispensed', 'cancelled'),
+                children=((PrescriptionMedication, ArchivedPrescriptionMedication,
+                           'prescription_id'),)),
+    ArchiveSpec('lab_test', LabTest, ArchivedLabTest, 'test_date', ('completed', 'cancelled'),
+                children=((LabResult, ArchivedLabResult, 'lab_test_id'),)),
+    ArchiveSpec('bill', Bill, ArchivedBill, 'bill_date', ('paid', 'cancelled'),
+                children=((BillItem, ArchivedBillItem, 'bill_id'),)),
+]
+
+SPECS_BY_KIND = {spec.kind: spec for spec in SPECS}
+
+# Hot model -> archive model, including child tables
+ARCHIVES = {spec.model: spec.archive for spec in SPECS}
+ARCHIVES.update({child: archived_child
+                 for spec in SPECS for child, archived_child, _ in spec.children})
+
+
+def _status_column(model):
+    return model.payment_status if model in (Bill, ArchivedBill) else model.status
+
+
+def _copy(source, target, where, extra=None):
+    """INSERT INTO target SELECT <shared columns> FROM source WHERE ..."""
+    columns = [column.name for column in source.__table__.columns
+               if column.name in target.__table__.columns]
+    values = [source.__table__.c[name] for name in columns]
+    if extra:
+        columns += list(extra)
+        values += [literal(value) for value in extra.values()]
+    db.session.execute(insert(target.__table__).from_select(columns, select(*values).where(where)))
+
+
+def _move(spec, ids, to_archive):
+    """Move ``ids`` of one kind (and their children) between hot and archive."""
+    now = datetime.utcnow()
+    source, target = (spec.model, spec.archive) if to_archive else (spec.archive, spec.model)
+    extra = {'archived_at': now} if to_archive else None
+    for child, archived_child, fk in spec.children:
+        child_source, child_target = (child, archived_child) if to_archive else (archived_child, child)
+        _copy(child_source, child_target, child_source.__table__.c[fk].in_(ids), extra)
+    _copy(source, target, source.__table__.c.id.in_(ids), extra)
+    if to_archive:
+        for model, fk in spec.dependents:
+            db.session.execute(delete(model.__table__).where(model.__table__.c[fk].in_(ids)))
+    else:
+        db.session.execute(update(target.__table__)
+                           .where(target.__table__.c.id.in_(ids))
+                           .values(updated_at=now))
+    for child, archived_child, fk in spec.children:
+        child_source = child if to_archive else archived_child
+        db.session.execute(delete(child_source.__table__).where(child_source.__table__.c[fk].in_(ids)))
+    db.session.execute(delete(source.__table__).where(source.__table__.c.id.in_(ids)))
+
+
+def archive_batch(spec, cutoff, idle_cutoff, batch_size):
+    """Archive one batch of closed rows older than ``cutoff``; returns the count."""
+    model = spec.model
+    ids = db.session.execute(
+        select(model.id).where(
+            _status_column(model).in_(spec.closed),
+            getattr(model, spec.time_column) < cutoff,
+            db.or_(model.updated_at.is_(None), model.updated_at < idle_cutoff)
+        ).limit(batch_size)
+    ).scalars().all()
+    if ids:
+        _move(spec, ids, to_archive=True)
+    db.session.commit()
+    return len(ids)
+
+
+def run_archive(kinds=None, now=None):
+    """Archive every eligible row in batches; returns ``{kind: rows moved}``."""
+    config = current_app.config
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=config['ARCHIVE_AFTER_DAYS'])
+    idle_cutoff = datetime.utcnow() - timedelta(days=config['ARCHIVE_MIN_IDLE_DAYS'])
+    batch_size = config['ARCHIVE_BATCH_SIZE']
+    moved = {}
+    for spec in SPECS:
+        if kinds and spec.kind not in kinds:
+            continue
+        moved[spec.kind] = 0
+        while True:
+            count = archive_batch(spec, cutoff, idle_cutoff, batch_size)
+            moved[spec.kind] += count
+            if count < batch_size:
+                break
+            # Give other writers a turn at the database lock
+            time.sleep(config['ARCHIVE_BATCH_PAUSE'])
+    return moved
+
+
+def restore(kind, ids=None, patient_id=None):
+    """Move archived rows back to the hot table; returns the ids restored."""
+    spec = SPECS_BY_KIND[kind]
+    query = select(spec.archive.id)
+    if ids:
+        query = query.where(spec.archive.id.in_(ids))
+    if patient_id is not None:
+        query = query.where(spec.archive.patient_id == patient_id)
+    restored = db.session.execute(query).scalars().all()
+    batch_size = current_app.config['ARCHIVE_BATCH_SIZE']
+    for start in range(0, len(restored), batch_size):
+        _move(spec, restored[start:start + batch_size], to_archive=False)
+        db.session.commit()
+    return restored
+
+
+def combined(model, *columns):
+    """UNION ALL of the same columns from a hot table and its archive, as a subquery."""
+    archive = ARCHIVES[model]
+    return union_all(
+        select(*[getattr(model, name) for name in columns]),
+        select(*[getattr(archive, name) for name in columns])
+    ).subquery()
@@ -0,0 +1,96 @@
+"""Fingerprinted, pre-compressed static assets.
+
+``flask assets build`` copies every file under ``app/static`` to
+``app/static/build`` with a content hash in its name, writes a gzip copy
+next to each compressible one, and records the mapping in
+``build/manifest.json``. Templates link assets with ``asset_url_for``,
+which takes the same arguments as ``url_for`` and resolves static files to
+their hashed names, so those responses can be cached for a year. Without a
+manifest it falls back to the plain file names.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from flask import current_app, request, send_from_directory, url_for
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map'}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+SKIP_DIRS = {BUILD_DIR, 'uploads'}
+
+
+def _hashed_name(path, digest):
+    root, ext = os.path.splitext(path)
+    return f'{root}.{digest[:12]}{ext}'
+
+
+def build_assets(static_folder):
+    """Write hashed and gzipped copies of the static files; returns the manifest."""
+    build_folder = os.path.join(static_folder, BUILD_DIR)
+    if os.path.exists(build_folder):
+        shutil.rmtree(build_folder)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if dirpath == static_folder:
+            dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            hashed = f'{BUILD_DIR}/' + _hashed_name(logical, hashlib.sha256(data).hexdigest())
+            target = os.path.join(static_folder, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            if os.path.splitext(filename)[1] in COMPRESSIBLE:
+                # mtime=0 keeps the .gz byte-identical across builds
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            manifest[logical] = hashed
+    with open(os.path.join(build_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, BUILD_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def asset_url_for(endpoint, **values):
+    """``url_for`` that resolves static files to their fingerprinted names."""
+    if endpoint == 'static' and 'filename' in values:
+        manifest = current_app.extensions['asset_manifest']
+        values['filename'] = manifest.get(values['filename'], values['filename'])
+    return url_for(endpoint, **values)
+
+
+def send_static(filename):
+    """Static view that serves build output with far-future caching and gzip."""
+    static_folder = current_app.static_folder
+    if not filename.startswith(f'{BUILD_DIR}/'):
+        return send_from_directory(static_folder, filename)
+    if 'gzip' in request.accept_encodings and \
+            os.path.isfile(os.path.join(static_folder, filename + '.gz')):
+        response = send_from_directory(static_folder, filename + '.gz',
+                                       mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(static_folder, filename)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    app.extensions['asset_manifest'] = load_manifest(app.static_folder)
+    app.view_functions['static'] = send_static
+    app.jinja_env.globals['asset_url_for'] = asset_url_for
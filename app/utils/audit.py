@@ -0,0 +1,350 @@
+"""Write-behind audit log of patient record access.
+
+Views call ``audit_access`` which only appends to an in-memory buffer.
+Each worker runs one flusher thread that writes the buffer in a single
+multi-row INSERT when ``AUDIT_FLUSH_SIZE`` events have queued up or every
+``AUDIT_FLUSH_INTERVAL`` seconds, on its own connection, so request
+transactions never wait for it. The buffer is also flushed at interpreter
+exit; if the database cannot be reached then, events are spilled to
+``AUDIT_SPILL_FILE`` and loaded by the next flush, so a clean shutdown
+never loses any.
+
+The log is partitioned by month into ``access_log_YYYYMM`` tables created
+on first use. Old months are dropped as whole tables rather than deleted
+row by row. Triggers on every partition reject UPDATE and DELETE (and
+TRUNCATE on PostgreSQL), so the log is append-only on SQLite, PostgreSQL
+and MySQL. The app refuses to start on any other database, where nothing
+would enforce this. Triggers stop the application, not the tables' owner:
+on a server database run the app as a role that does not own them.
+Queries walk the partitions newest first with a keyset cursor.
+"""
+import atexit
+import base64
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from flask import has_request_context, request
+from flask_login import current_user
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, String, Table,
+                        inspect, select, text)
+from sqlalchemy.engine import make_url
+from app import db
+
+PARTITION_PREFIX = 'access_log_'
+APPEND_ONLY_MESSAGE = 'access log is append-only'
+
+_metadata = MetaData()
+_tables_lock = threading.Lock()
+
+
+def partition_name(when):
+    return f'{PARTITION_PREFIX}{when:%Y%m}'
+
+
+def partition_table(name):
+    """Return the Table for a partition name, defining it on first use."""
+    with _tables_lock:
+        table = _metadata.tables.get(name)
+        if table is None:
+            table = Table(
+                name, _metadata,
+                Column('id', Integer, primary_key=True),
+                Column('accessed_at', DateTime, nullable=False),
+                Column('user_id', Integer),
+                Column('action', String(20), nullable=False),
+                Column('object_type', String(30), nullable=False),
+                Column('object_id', Integer, nullable=False),
+                Column('patient_id', Integer),
+                Column('endpoint', String(100)),
+                Column('ip_address', String(45)),
+                Index(f'ix_{name}_accessed_at', 'accessed_at'),
+                Index(f'ix_{name}_patient', 'patient_id', 'accessed_at'),
+                Index(f'ix_{name}_user', 'user_id', 'accessed_at'),
+            )
+        return table
+
+
+def _sqlite_triggers(name):
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {name}_no_{action} BEFORE {action.upper()} ON {name} "
+        f"BEGIN SELECT RAISE(ABORT, '{APPEND_ONLY_MESSAGE}'); END"
+        for action in ('update', 'delete')
+    ]
+
+
+def _postgresql_triggers(name):
+    return [
+        "CREATE OR REPLACE FUNCTION access_log_append_only() RETURNS trigger AS $$ "
+        f"BEGIN RAISE EXCEPTION '{APPEND_ONLY_MESSAGE}'; END $$ LANGUAGE plpgsql",
+        f"CREATE TRIGGER {name}_no_update BEFORE UPDATE OR DELETE ON {name} "
+        "FOR EACH ROW EXECUTE PROCEDURE access_log_append_only()",
+        f"CREATE TRIGGER {name}_no_truncate BEFORE TRUNCATE ON {name} "
+        "FOR EACH STATEMENT EXECUTE PROCEDURE access_log_append_only()",
+    ]
+
+
+def _mysql_triggers(name):
+    # TRUNCATE fires no triggers on MySQL; it needs the DROP privilege
+    return [
+        f"CREATE TRIGGER {name}_no_{action} BEFORE {action.upper()} ON {name} FOR EACH ROW "
+        f"SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = '{APPEND_ONLY_MESSAGE}'"
+        for action in ('update', 'delete')
+    ]
+
+
+# Dialect -> (statements creating a partition's triggers, query telling whether they exist)
+APPEND_ONLY_TRIGGERS = {
+    'sqlite': (_sqlite_triggers, None),
+    'postgresql': (_postgresql_triggers, 'SELECT 1 FROM pg_trigger WHERE tgname = :trigger'),
+    'mysql': (_mysql_triggers, 'SELECT 1 FROM information_schema.triggers '
+                               'WHERE trigger_schema = DATABASE() AND trigger_name = :trigger'),
+}
+APPEND_ONLY_TRIGGERS['mariadb'] = APPEND_ONLY_TRIGGERS['mysql']
+
+
+def _ensure_append_only(conn, name):
+    statements, exists = APPEND_ONLY_TRIGGERS[conn.dialect.name]
+    if exists is not None and conn.execute(text(exists), {'trigger': f'{name}_no_update'}).first():
+        return
+    for statement in statements(name):
+        conn.execute(text(statement))
+
+
+def check_append_only(database_uri):
+    """Raise RuntimeError when the audit log could not be made append-only."""
+    backend = make_url(database_uri).get_backend_name()
+    if backend not in APPEND_ONLY_TRIGGERS:
+        raise RuntimeError(f'The access log cannot be made append-only on {backend}; '
+                           f'use SQLite, PostgreSQL or MySQL.')
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Alembic filter so autogenerate leaves the partition tables alone."""
+    return not (type_ == 'table' and name.startswith(PARTITION_PREFIX))
+
+
+class AuditLog:
+    """Per-worker buffer of access events with a background flusher."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._buffer = []
+        self._flusher = None
+        self._created = set()
+        self._exiting = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUDIT_FLUSH_SIZE', 200)
+        app.config.setdefault('AUDIT_FLUSH_INTERVAL', 2.0)
+        app.config.setdefault('AUDIT_MAX_BUFFER', 100000)
+        app.config.setdefault('AUDIT_SPILL_FILE', os.path.join(app.instance_path, 'audit-spill.jsonl'))
+        check_append_only(app.config['SQLALCHEMY_DATABASE_URI'])
+        if self.app is None:
+            atexit.register(self._shutdown)
+        self.app = app
+        self._created = set()
+        app.extensions['audit_log'] = self
+
+    def record(self, event):
+        with self._lock:
+            self._buffer.append(event)
+            size = len(self._buffer)
+        if size >= self.app.config['AUDIT_FLUSH_SIZE']:
+            self._wakeup.set()
+        self._ensure_flusher()
+
+    def flush(self):
+        """Write every buffered event; returns how many were written."""
+        with self._flush_lock:
+            with self._lock:
+                events, self._buffer = self._buffer, []
+            events = self._load_spill() + events
+            if not events:
+                return 0
+            try:
+                self._write(events)
+            except Exception as e:
+                self.app.logger.error(f'Audit log flush failed: {str(e)}')
+                self._requeue(events)
+                return 0
+            return len(events)
+
+    def _write(self, events):
+        by_partition = {}
+        for event in events:
+            by_partition.setdefault(partition_name(event['accessed_at']), []).append(event)
+        with self.app.app_context():
+            with db.engine.begin() as conn:
+                for name, rows in by_partition.items():
+                    table = partition_table(name)
+                    if name not in self._created:
+                        table.create(conn, checkfirst=True)
+                        _ensure_append_only(conn, name)
+                        self._created.add(name)
+                    conn.execute(table.insert(), rows)
+
+    def _requeue(self, events):
+        if self._exiting:
+            self._spill(events)
+            return
+        with self._lock:
+            self._buffer[:0] = events
+            overflow = len(self._buffer) - self.app.config['AUDIT_MAX_BUFFER']
+            spill = self._buffer[:overflow] if overflow > 0 else []
+            del self._buffer[:len(spill)]
+        if spill:
+            # Keep memory bounded while the database is unreachable
+            self._spill(spill)
+
+    def _shutdown(self):
+        self._exiting = True
+        self.flush()
+
+    def _spill(self, events):
+        path = self.app.config['AUDIT_SPILL_FILE']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            for event in events:
+                f.write(json.dumps(dict(event, accessed_at=event['accessed_at'].isoformat())) + '\n')
+
+    def _load_spill(self):
+        path = self.app.config['AUDIT_SPILL_FILE']
+        if not os.path.exists(path):
+            return []
+        claimed = f'{path}.{os.getpid()}'
+        try:
+            os.replace(path, claimed)
+        except OSError:
+            return []
+        with open(claimed) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        os.remove(claimed)
+        for event in events:
+            event['accessed_at'] = datetime.fromisoformat(event['accessed_at'])
+        return events
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher,
+                                             name='audit-log-flusher',
+                                             daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            self._wakeup.wait(self.app.config['AUDIT_FLUSH_INTERVAL'])
+            self._wakeup.clear()
+            self.flush()
+
+
+audit_log = AuditLog()
+
+
+def audit_access(object_type, object_id, patient_id=None, action='view'):
+    """Record that the current user accessed a record."""
+    event = {
+        'accessed_at': datetime.utcnow(),
+        'user_id': None,
+        'action': action,
+        'object_type': object_type,
+        'object_id': object_id,
+        'patient_id': patient_id,
+        'endpoint': None,
+        'ip_address': None
+    }
+    if has_request_context():
+        if current_user.is_authenticated:
+            event['user_id'] = current_user.id
+        event['endpoint'] = request.endpoint
+        event['ip_address'] = request.remote_addr
+    audit_log.record(event)
+
+
+def encode_cursor(accessed_at, id):
+    return base64.urlsafe_b64encode(f'{accessed_at.isoformat()}|{id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        accessed_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(accessed_at), int(id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def partitions_between(start, end):
+    """Existing partition names covering [start, end), newest first."""
+    existing = {name for name in inspect(db.engine).get_table_names()
+                if name.startswith(PARTITION_PREFIX)}
+    names = []
+    month = datetime(end.year, end.month, 1)
+    while month >= datetime(start.year, start.month, 1):
+        name = partition_name(month)
+        if name in existing:
+            names.append(name)
+        month = (month - timedelta(days=1)).replace(day=1)
+    return names
+
+
+def query_access_log(start, end, patient_id=None, user_id=None, object_type=None,
+                     cursor=None, limit=50):
+    """Return one page of access events in [start, end), newest first.
+
+    The result has ``entries`` and ``next_cursor``, which is None on the
+    last page.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    entries = []
+    for name in partitions_between(start, end):
+        table = partition_table(name)
+        query = select(table).where(table.c.accessed_at >= start, table.c.accessed_at < end)
+        if patient_id is not None:
+            query = query.where(table.c.patient_id == patient_id)
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        if object_type:
+            query = query.where(table.c.object_type == object_type)
+        if position is not None:
+            accessed_at, id = position
+            if accessed_at < datetime(*partition_month(name), 1):
+                continue
+            query = query.where(db.or_(table.c.accessed_at < accessed_at,
+                                       db.and_(table.c.accessed_at == accessed_at,
+                                               table.c.id < id)))
+        query = query.order_by(table.c.accessed_at.desc(), table.c.id.desc())\
+            .limit(limit + 1 - len(entries))
+        entries.extend(dict(row._mapping) for row in db.session.execute(query))
+        if len(entries) > limit:
+            break
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(entries[-1]['accessed_at'], entries[-1]['id'])
+    return {'entries': entries, 'next_cursor': next_cursor}
+
+
+def partition_month(name):
+    stamp = name[len(PARTITION_PREFIX):]
+    return int(stamp[:4]), int(stamp[4:])
+
+
+def drop_partitions_before(cutoff):
+    """Drop whole months older than ``cutoff``; returns the dropped names."""
+    dropped = []
+    for name in partitions_between(datetime(2000, 1, 1), cutoff):
+        year, month = partition_month(name)
+        if datetime(year, month, 1) < datetime(cutoff.year, cutoff.month, 1):
+            partition_table(name).drop(db.engine)
+            audit_log._created.discard(name)
+            dropped.append(name)
+    return dropped
@@ -0,0 +1,170 @@
+"""Batch billing of completed encounters.
+
+A billing run turns completed appointments, dispensed prescription lines and
+completed lab tests into one pending bill per patient. Everything happens in
+a few INSERT/UPDATE ... SELECT statements, so the cost is a handful of scans
+rather than a query per encounter.
+
+Runs are incremental: only encounters updated since the previous run's
+watermark (less ``BILLING_WATERMARK_OVERLAP``) are considered. They are
+idempotent because candidates are anti-joined against ``bill_item`` (and its
+archive), and the unique ``(item_type, item_id)`` index stops a concurrent
+run from billing the same encounter twice. A run that loses that race is
+rolled back and re-planned, and the encounters the other run billed drop
+out of its candidates.
+"""
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import insert, literal, select, union_all
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import (Appointment, Prescription, PrescriptionMedication, Medication,
+                        LabTest, Bill, BillItem, BillingRun, ArchivedBillItem)
+
+ITEM_COLUMNS = ['patient_id', 'item_type', 'item_id', 'description',
+                'quantity', 'unit_price', 'total_price']
+
+
+def _not_billed(item_type, item_id):
+    # Paid bills may have been archived while the encounter is still hot
+    return db.and_(*[~select(items.id).where(
+        items.item_type == item_type,
+        items.item_id == item_id
+    ).exists() for items in (BillItem, ArchivedBillItem)])
+
+
+def _window(column, since, until):
+    clauses = [column < until]
+    if since is not None:
+        clauses.append(column >= since)
+    return clauses
+
+
+def unbilled_encounters(since, until):
+    """Select priced, not yet billed encounters as rows of ``ITEM_COLUMNS``."""
+    config = current_app.config
+    consultation_fee = literal(float(config['BILLING_CONSULTATION_FEE']))
+    test_fee = db.case(
+        {test_type: float(fee) for test_type, fee in config['BILLING_LAB_TEST_TARIFF'].items()},
+        value=LabTest.test_type,
+        else_=float(config['BILLING_LAB_TEST_DEFAULT_FEE'])
+    )
+
+    consultations = select(
+        Appointment.patient_id,
+        literal('consultation').label('item_type'),
+        Appointment.id.label('item_id'),
+        literal('Consultation').label('description'),
+        literal(1).label('quantity'),
+        consultation_fee.label('unit_price'),
+        consultation_fee.label('total_price')
+    ).where(
+        Appointment.status == 'completed',
+        _not_billed('consultation', Appointment.id),
+        *_window(Appointment.updated_at, since, until)
+    )
+
+    medications = select(
+        Prescription.patient_id,
+        literal('medication').label('item_type'),
+        PrescriptionMedication.id.label('item_id'),
+        Medication.name.label('description'),
+        PrescriptionMedication.quantity,
+        Medication.price.label('unit_price'),
+        (Medication.price * PrescriptionMedication.quantity).label('total_price')
+    ).join(PrescriptionMedication, PrescriptionMedication.prescription_id == Prescription.id)\
+     .join(Medication, Medication.id == PrescriptionMedication.medication_id)\
+     .where(
+        Prescription.status == 'dispensed',
+        _not_billed('medication', PrescriptionMedication.id),
+        *_window(Prescription.updated_at, since, until)
+    )
+
+    lab_tests = select(
+        LabTest.patient_id,
+        literal('lab_test').label('item_type'),
+        LabTest.id.label('item_id'),
+        (literal('Lab test: ') + LabTest.test_type).label('description'),
+        literal(1).label('quantity'),
+        test_fee.label('unit_price'),
+        test_fee.label('total_price')
+    ).where(
+        LabTest.status == 'completed',
+        _not_billed('lab_test', LabTest.id),
+        *_window(LabTest.updated_at, since, until)
+    )
+
+    return union_all(consultations, medications, lab_tests)
+
+
+def run_billing(full=False, attempts=3):
+    """Bill every encounter completed since the last run; returns the BillingRun.
+
+    ``full`` ignores the watermark and scans all history, which is safe
+    because already billed encounters are skipped.
+    """
+    for attempt in range(attempts):
+        try:
+            return _run(full)
+        except IntegrityError:
+            # A concurrent run billed some of the candidates first
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+
+
+def _run(full):
+    previous = BillingRun.query.filter(BillingRun.finished_at.isnot(None))\
+        .order_by(BillingRun.id.desc()).first()
+    since = None
+    if previous is not None and not full:
+        since = previous.watermark - timedelta(
+            seconds=current_app.config['BILLING_WATERMARK_OVERLAP'])
+    run = BillingRun(watermark=datetime.utcnow())
+    db.session.add(run)
+    db.session.flush()
+
+    candidates = unbilled_encounters(since, run.watermark).cte('candidates')
+
+    # One bill per patient; totals are filled in from the inserted items
+    db.session.execute(insert(Bill.__table__).from_select(
+        ['patient_id', 'bill_date', 'total_amount', 'payment_status', 'billing_run_id'],
+        select(
+            candidates.c.patient_id,
+            literal(run.watermark),
+            literal(0.0),
+            literal('pending'),
+            literal(run.id)
+        ).group_by(candidates.c.patient_id)
+    ))
+
+    db.session.execute(insert(BillItem.__table__).from_select(
+        ['bill_id'] + ITEM_COLUMNS[1:],
+        select(Bill.id, *[candidates.c[name] for name in ITEM_COLUMNS[1:]])
+        .join(Bill, db.and_(Bill.patient_id == candidates.c.patient_id,
+                            Bill.billing_run_id == run.id))
+    ))
+
+    db.session.execute(
+        db.update(Bill)
+        .where(Bill.billing_run_id == run.id)
+        .values(total_amount=select(db.func.coalesce(db.func.sum(BillItem.total_price), 0))
+                .where(BillItem.bill_id == Bill.id)
+                .scalar_subquery())
+        .execution_options(synchronize_session=False)
+    )
+
+    # Drop bills whose candidates were billed by a concurrent run in between
+    db.session.execute(
+        db.delete(Bill)
+        .where(Bill.billing_run_id == run.id,
+               ~select(BillItem.id).where(BillItem.bill_id == Bill.id).exists())
+        .execution_options(synchronize_session=False)
+    )
+
+    # Driver rowcounts are unreliable for INSERT ... SELECT with a CTE
+    run.bills_created = Bill.query.filter_by(billing_run_id=run.id).count()
+    run.items_created = BillItem.query.join(Bill).filter(Bill.billing_run_id == run.id).count()
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    return run
@@ -0,0 +1,222 @@
+"""Signed QR check-in tokens for appointments.
+
+A check-in token is a compact HS256 JWT carrying the appointment id, the
+doctor and the appointment time. It is valid from ``CHECKIN_OPENS_BEFORE``
+seconds before the appointment until ``CHECKIN_CLOSES_AFTER`` seconds
+after, so the kiosk checks the signature and the window without reading the
+database. The signing key is ``CHECKIN_SECRET_KEY``, or one derived from
+``SECRET_KEY`` so a check-in token is never valid as anything else.
+
+The same appointment always yields the same token, so its QR code is
+rendered once: PNGs are kept under ``CHECKIN_QR_FOLDER`` named by the
+token's hash (rescheduling changes the token and so the file), with a small
+per-worker cache in front.
+
+Scans are written behind: ``check_in`` only records the appointment in a
+per-worker buffer, and a flusher thread applies the buffer every
+``CHECKIN_FLUSH_INTERVAL`` seconds as guarded UPDATEs in one transaction on
+its own connection, with the waiting-room events for the appointments it
+moved. The guard only moves scheduled appointments, so a token for an
+appointment cancelled since it was issued checks nothing in, and an
+appointment another worker checked in first gets no second event. Repeated
+scans of one token before a flush are written once.
+"""
+import atexit
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from io import BytesIO
+import jwt
+from flask import current_app
+from sqlalchemy import bindparam, select
+from app import db
+from app.models import Appointment, QueueEvent
+from app.utils.events import appointment_change, waiting_room_row
+from app.utils.waiting_room import waiting_room
+
+ALGORITHM = 'HS256'
+QR_CACHE_SIZE = 256  # PNGs kept in memory per worker
+
+
+class InvalidCheckIn(Exception):
+    """The token is forged, malformed or outside its check-in window."""
+
+
+def _key():
+    config = current_app.config
+    if config.get('CHECKIN_SECRET_KEY'):
+        return config['CHECKIN_SECRET_KEY']
+    return hmac.new(config['SECRET_KEY'].encode(), b'appointment-check-in',
+                    hashlib.sha256).hexdigest()
+
+
+def checkin_token(appointment):
+    """The check-in token for an appointment."""
+    config = current_app.config
+    at = int(appointment.appointment_date.timestamp())
+    claims = {'apt': appointment.id, 'doc': appointment.doctor_id, 'at': at,
+              'nbf': at - config['CHECKIN_OPENS_BEFORE'],
+              'exp': at + config['CHECKIN_CLOSES_AFTER']}
+    return jwt.encode(claims, _key(), algorithm=ALGORITHM)
+
+
+def verify_token(token):
+    """Return the claims of a valid token; raises InvalidCheckIn otherwise."""
+    try:
+        claims = jwt.decode(token, _key(), algorithms=[ALGORITHM],
+                            options={'require': ['apt', 'doc', 'at', 'nbf', 'exp']})
+    except jwt.ImmatureSignatureError:
+        raise InvalidCheckIn('Check-in has not opened for this appointment yet.')
+    except jwt.ExpiredSignatureError:
+        raise InvalidCheckIn('Check-in has closed for this appointment.')
+    except jwt.InvalidTokenError:
+        raise InvalidCheckIn('This code is not a valid check-in code.')
+    return claims
+
+
+def qr_folder():
+    return current_app.config['CHECKIN_QR_FOLDER'] or \
+        os.path.join(current_app.instance_path, 'checkin-qr')
+
+
+def render_qr(token):
+    from qrcode import QRCode
+    from qrcode.constants import ERROR_CORRECT_M
+    qr = QRCode(error_correction=ERROR_CORRECT_M, box_size=8, border=2)
+    qr.add_data(token)
+    qr.make(fit=True)
+    buffer = BytesIO()
+    qr.make_image().save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+_qr_lock = threading.Lock()
+_qr_cache = OrderedDict()
+
+
+def qr_png(token):
+    """PNG bytes of the token's QR code, rendered only if no worker has yet."""
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    with _qr_lock:
+        png = _qr_cache.get(digest)
+        if png is not None:
+            _qr_cache.move_to_end(digest)
+            return png
+    path = os.path.join(qr_folder(), f'{digest}.png')
+    try:
+        with open(path, 'rb') as f:
+            png = f.read()
+    except FileNotFoundError:
+        png = render_qr(token)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(temporary, 'wb') as f:
+            f.write(png)
+        os.replace(temporary, path)
+    with _qr_lock:
+        _qr_cache[digest] = png
+        while len(_qr_cache) > QR_CACHE_SIZE:
+            _qr_cache.popitem(last=False)
+    return png
+
+
+class CheckInQueue:
+    """Per-worker buffer of check-ins with a background flusher."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}  # appointment id -> checked-in time
+        self._flusher = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CHECKIN_FLUSH_SIZE', 200)
+        app.config.setdefault('CHECKIN_FLUSH_INTERVAL', 1.0)
+        self.app = app
+        app.extensions['checkin_queue'] = self
+        atexit.register(self.flush)
+
+    def record(self, appointment_id, when=None):
+        with self._lock:
+            self._pending.setdefault(appointment_id, when or datetime.utcnow())
+            size = len(self._pending)
+        if size >= self.app.config['CHECKIN_FLUSH_SIZE']:
+            self._wakeup.set()
+        self._ensure_flusher()
+
+    def flush(self):
+        """Apply every buffered check-in; returns how many appointments moved."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                return self._write(pending)
+            except Exception as e:
+                self.app.logger.error(f'Check-in flush failed: {str(e)}')
+                with self._lock:
+                    for id, when in pending.items():
+                        self._pending.setdefault(id, when)
+                return 0
+
+    def _write(self, pending):
+        table = Appointment.__table__
+        statement = table.update()\
+            .where(table.c.id == bindparam('appointment_id'), table.c.status == 'scheduled')\
+            .values(status='checked_in', checked_in_at=bindparam('when'),
+                    updated_at=bindparam('when'))
+        now = datetime.utcnow()
+        with self.app.app_context():
+            with db.engine.begin() as conn:
+                candidates = conn.execute(select(table).where(table.c.id.in_(list(pending)),
+                                                              table.c.status == 'scheduled')).all()
+                # Another worker may check a row in between; only rows this
+                # UPDATE moved get an event
+                moving = [row for row in candidates
+                          if conn.execute(statement, {'appointment_id': row.id,
+                                                      'when': pending[row.id]}).rowcount]
+                if not moving:
+                    return 0
+                changes = [dict(appointment_change(row), status='checked_in',
+                                checked_in_at=pending[row.id].isoformat(),
+                                updated_at=pending[row.id].isoformat())
+                           for row in moving]
+                conn.execute(QueueEvent.__table__.insert(),
+                             [waiting_room_row(change, now) for change in changes])
+        waiting_room.apply_all(changes)
+        return len(moving)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher,
+                                             name='checkin-flusher',
+                                             daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            self._wakeup.wait(self.app.config['CHECKIN_FLUSH_INTERVAL'])
+            self._wakeup.clear()
+            self.flush()
+
+
+checkin_queue = CheckInQueue()
+
+
+def check_in(token):
+    """Verify a scanned token and queue the check-in; returns the claims."""
+    claims = verify_token(token)
+    checkin_queue.record(claims['apt'])
+    return claims
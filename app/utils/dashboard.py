@@ -0,0 +1,164 @@
+"""Data for the main dashboard.
+
+The stats a role sees come from one SELECT with a scalar ``COUNT``
+subquery per figure, so they cost one round trip however many there are;
+today's appointments are counted over a date range the index on
+``appointment_date`` can serve. The activity and event lists each take one
+query with the patient and doctor names joined in, rather than a query per
+row.
+
+On a server database the statements are independent round trips, so they
+run at the same time on a small per-worker thread pool, each on its own
+pooled connection, and the dashboard waits for the slowest one instead of
+all of them in turn. ``DASHBOARD_PARALLEL`` forces this on or off; by
+default it is on for everything but SQLite, where a query costs no round
+trip and an in-memory database is private to one connection.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+from app import db
+from app.models import Appointment, LabTest, Medication, Patient, User
+
+LOW_STOCK_LEVEL = 10  # same threshold as the pharmacy dashboard
+LIST_SIZE = 5
+ROLE_STATS = {
+    'admin': ('total_patients', 'today_appointments'),
+    'doctor': ('today_appointments',),
+    'receptionist': ('today_appointments',),
+    'pharmacist': ('low_stock_items',),
+    'lab_technician': ('pending_tests',),
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=current_app.config['DASHBOARD_WORKERS'],
+                                       thread_name_prefix='dashboard-query')
+        return _pool
+
+
+def _today():
+    start = datetime.combine(datetime.now().date(), datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def stats_statement(user):
+    """One SELECT returning every stat the user's role sees, or None."""
+    start, end = _today()
+    counts = {
+        'total_patients': (Patient, None),
+        'today_appointments': (Appointment, (Appointment.appointment_date >= start) &
+                               (Appointment.appointment_date < end)),
+        'low_stock_items': (Medication, Medication.quantity_in_stock < LOW_STOCK_LEVEL),
+        'pending_tests': (LabTest, LabTest.status == 'pending'),
+    }
+    columns = []
+    for name in ROLE_STATS.get(user.role, ()):
+        model, condition = counts[name]
+        count = select(func.count(model.id))
+        if condition is not None:
+            count = count.where(condition)
+        columns.append(count.scalar_subquery().label(name))
+    return select(*columns) if columns else None
+
+
+def _appointment_list(user, order_by, *conditions):
+    """The first LIST_SIZE appointments in order, with names; the limit is
+    applied before the joins so only those rows are joined."""
+    picked = select(Appointment.id).where(*conditions)
+    if user.role == 'doctor':
+        picked = picked.where(Appointment.doctor_id == user.id)
+    picked = picked.order_by(order_by).limit(LIST_SIZE).subquery()
+    doctor = aliased(User)
+    return select(Appointment.created_at, Appointment.appointment_date,
+                  Patient.first_name, Patient.last_name,
+                  doctor.first_name.label('doctor_first_name'),
+                  doctor.last_name.label('doctor_last_name'))\
+        .join(picked, picked.c.id == Appointment.id)\
+        .join(Patient, Patient.id == Appointment.patient_id)\
+        .join(doctor, doctor.id == Appointment.doctor_id)\
+        .order_by(order_by)
+
+
+def recent_patients_statement():
+    return select(Patient.first_name, Patient.last_name, Patient.created_at)\
+        .order_by(Patient.created_at.desc()).limit(LIST_SIZE)
+
+
+def recent_appointments_statement(user):
+    return _appointment_list(user, Appointment.created_at.desc())
+
+
+def upcoming_appointments_statement(user):
+    return _appointment_list(user, Appointment.appointment_date,
+                             Appointment.appointment_date > datetime.now())
+
+
+def _statements(user):
+    statements = {'stats': stats_statement(user),
+                  'recent_patients': recent_patients_statement() if user.role == 'admin' else None,
+                  'recent_appointments': recent_appointments_statement(user),
+                  'upcoming_appointments': upcoming_appointments_statement(user)}
+    return {name: statement for name, statement in statements.items() if statement is not None}
+
+
+def _run(engine, statement):
+    with engine.connect() as conn:
+        return conn.execute(statement).all()
+
+
+def parallel_enabled():
+    parallel = current_app.config['DASHBOARD_PARALLEL']
+    if parallel is None:
+        return db.engine.dialect.name != 'sqlite'
+    return parallel
+
+
+def fetch(user, parallel=None):
+    """Run the user's dashboard statements; returns {name: rows}."""
+    statements = _statements(user)
+    if parallel is None:
+        parallel = parallel_enabled()
+    if not parallel or len(statements) < 2:
+        return {name: db.session.execute(statement).all() for name, statement in statements.items()}
+    engine = db.engine
+    futures = {name: _executor().submit(_run, engine, statement)
+               for name, statement in statements.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+def _time(value):
+    return value.strftime('%Y-%m-%d %H:%M')
+
+
+def load_dashboard(user, parallel=None):
+    """Stats, recent activities and upcoming events for the user's dashboard."""
+    results = fetch(user, parallel)
+    stats = {}
+    if results.get('stats'):
+        stats = {name: int(value or 0) for name, value in results['stats'][0]._mapping.items()}
+    activities = [{'title': 'New Patient Registration',
+                   'description': f'{row.first_name} {row.last_name}',
+                   'time': _time(row.created_at),
+                   'user': 'System'}
+                  for row in results.get('recent_patients', [])]
+    activities += [{'title': 'New Appointment',
+                    'description': f'Appointment scheduled for {row.first_name} {row.last_name}',
+                    'time': _time(row.created_at),
+                    'user': f'Dr. {row.doctor_first_name} {row.doctor_last_name}'}
+                   for row in results['recent_appointments']]
+    events = [{'title': 'Appointment',
+               'description': f'Patient: {row.first_name} {row.last_name}',
+               'date': row.appointment_date.strftime('%Y-%m-%d'),
+               'time': row.appointment_date.strftime('%H:%M')}
+              for row in results['upcoming_appointments']]
+    return {'stats': stats, 'activities': activities, 'events': events}
@@ -0,0 +1,311 @@
+"""Duplicate patient detection and merging.
+
+Every patient carries three blocking keys in indexed columns, set whenever
+the row is saved:
+
+* ``phone_key``: the last ten digits of the phone number, so "+1 (555)
+  010-2030" and "555 0102030" agree;
+* ``name_key`` and ``first_name_key``: the Soundex codes of the last and
+  first names. A patient is blocked under its date of birth with each of
+  them, so a typo in one name, or the two names entered the wrong way
+  round, still shares a block.
+
+Two records are only compared when they share a block, so finding
+candidates is a sort of each key rather than a comparison of every pair.
+Blocks larger than ``DEDUP_MAX_BLOCK`` (a clinic's switchboard number
+entered for many patients) are skipped. Pairs are scored from the
+Jaro-Winkler similarity of the names, the date of birth (allowing swapped
+day and month), the phone and the email; pairs scoring at least
+``DEDUP_MIN_SCORE`` are kept as ``DuplicateCandidate`` rows for review.
+
+``flask dedup run`` fills in missing keys and scans every block. Registration
+checks the same blocks for the new record through the indexes. Merging
+re-points the duplicate's appointments, prescriptions, lab tests and bills,
+archived ones included, to the kept record, fills the kept record's blank
+fields, logs the removed row in ``patient_merge`` and deletes it.
+"""
+import json
+import unicodedata
+from datetime import datetime
+from itertools import groupby
+from flask import current_app
+from sqlalchemy import bindparam, delete, event, or_, select, union_all
+from app import db
+from app.models import (Patient, Appointment, Prescription, LabTest, LabResult, Bill,
+                        ArchivedAppointment, ArchivedPrescription, ArchivedLabTest,
+                        ArchivedLabResult, ArchivedBill, DuplicateCandidate, PatientMerge)
+
+CHUNK_ROWS = 10000
+PHONE_DIGITS = 10
+MIN_PHONE_DIGITS = 7
+MATCH_COLUMNS = (Patient.id, Patient.first_name, Patient.last_name, Patient.date_of_birth,
+                 Patient.phone_key, Patient.email)
+MERGED_TABLES = (Appointment, Prescription, LabTest, LabResult, Bill,
+                 ArchivedAppointment, ArchivedPrescription, ArchivedLabTest, ArchivedLabResult,
+                 ArchivedBill)
+FILLED_FIELDS = ('email', 'blood_group', 'address')
+
+SOUNDEX_CODES = {letter: str(code) for code, letters in enumerate(
+    ('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r')) for letter in letters}
+
+
+def normalise_name(name):
+    text = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode()
+    return ''.join(c for c in text.lower() if c.isalpha())
+
+
+def phone_key(phone):
+    """Last ten digits of a phone number, or '' when too short to tell people apart."""
+    digits = ''.join(c for c in phone or '' if c.isdigit())[-PHONE_DIGITS:]
+    if len(digits) < MIN_PHONE_DIGITS or len(set(digits)) == 1:
+        return ''
+    return digits
+
+
+def soundex(name):
+    name = normalise_name(name)
+    if not name:
+        return ''
+    code = name[0].upper()
+    previous = SOUNDEX_CODES[name[0]]
+    for c in name[1:]:
+        digit = SOUNDEX_CODES[c]
+        if digit != '0' and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if c not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+
+def set_keys(patient):
+    patient.phone_key = phone_key(patient.phone)
+    patient.name_key = soundex(patient.last_name)
+    patient.first_name_key = soundex(patient.first_name)
+
+
+def _set_keys(mapper, connection, patient):
+    set_keys(patient)
+
+
+event.listen(Patient, 'before_insert', _set_keys)
+event.listen(Patient, 'before_update', _set_keys)
+
+
+# Scoring
+
+def jaro_winkler(a, b):
+    if a == b:
+        return 1.0 if a else 0.0
+    if not a or not b:
+        return 0.0
+    window = max(len(a), len(b)) // 2 - 1
+    matched_b = [False] * len(b)
+    matches_a = []
+    for i, c in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not matched_b[j] and b[j] == c:
+                matched_b[j] = True
+                matches_a.append(c)
+                break
+    if not matches_a:
+        return 0.0
+    matches_b = [c for c, matched in zip(b, matched_b) if matched]
+    m = len(matches_a)
+    transpositions = sum(x != y for x, y in zip(matches_a, matches_b)) // 2
+    jaro = (m / len(a) + m / len(b) + (m - transpositions) / m) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+def _birth_similarity(a, b):
+    if a == b:
+        return 1.0
+    if a is None or b is None:
+        return 0.0
+    if a.year == b.year and (a.month, a.day) == (b.day, b.month):
+        return 0.8
+    # One of year, month and day mistyped
+    return 0.5 if sum((a.year == b.year, a.month == b.month, a.day == b.day)) == 2 else 0.0
+
+
+def score(a, b):
+    """Similarity in [0, 1] of two records with names, birth date, phone key and email."""
+    first_a, last_a = normalise_name(a.first_name), normalise_name(a.last_name)
+    first_b, last_b = normalise_name(b.first_name), normalise_name(b.last_name)
+    names = max(jaro_winkler(first_a, first_b) + jaro_winkler(last_a, last_b),
+                # First and last name entered the wrong way round
+                jaro_winkler(first_a, last_b) + jaro_winkler(last_a, first_b)) / 2
+    total = 0.6 * names + 0.3 * _birth_similarity(a.date_of_birth, b.date_of_birth)
+    if a.phone_key and a.phone_key == b.phone_key:
+        total += 0.1
+    if a.email and b.email and a.email.strip().lower() == b.email.strip().lower():
+        total += 0.1
+    return round(min(total, 1.0), 4)
+
+
+# Registration check
+
+class Probe:
+    """A not-yet-saved record to check for duplicates."""
+
+    def __init__(self, first_name, last_name, date_of_birth, phone, email=None):
+        self.first_name = first_name
+        self.last_name = last_name
+        self.date_of_birth = date_of_birth
+        self.phone_key = phone_key(phone)
+        self.email = email
+
+
+def find_matches(first_name, last_name, date_of_birth, phone, email=None, exclude_id=None,
+                 limit=5):
+    """Existing patients that look like this record, as (score, patient), best first."""
+    probe = Probe(first_name, last_name, date_of_birth, phone, email)
+    conditions = []
+    if probe.phone_key:
+        conditions.append(Patient.phone_key == probe.phone_key)
+    codes = [code for code in (soundex(last_name), soundex(first_name)) if code]
+    if date_of_birth is not None and codes:
+        conditions += [(Patient.date_of_birth == date_of_birth) & key.in_(codes)
+                       for key in (Patient.name_key, Patient.first_name_key)]
+    if not conditions:
+        return []
+    query = Patient.query.filter(or_(*conditions))
+    if exclude_id is not None:
+        query = query.filter(Patient.id != exclude_id)
+    threshold = current_app.config['DEDUP_MIN_SCORE']
+    matches = [(score(probe, patient), patient)
+               for patient in query.limit(current_app.config['DEDUP_MAX_BLOCK']).all()]
+    matches = [match for match in matches if match[0] >= threshold]
+    matches.sort(key=lambda match: -match[0])
+    return matches[:limit]
+
+
+# Batch run
+
+def refresh_keys():
+    """Set the blocking keys of patients saved without them; returns how many."""
+    table = Patient.__table__
+    # Core UPDATE keeps updated_at: the record itself did not change
+    statement = table.update().where(table.c.id == bindparam('patient_id'))\
+        .values(phone_key=bindparam('b_phone_key'), name_key=bindparam('b_name_key'),
+                first_name_key=bindparam('b_first_name_key'), updated_at=table.c.updated_at)
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Patient.id, Patient.first_name, Patient.last_name, Patient.phone)
+            .where(or_(Patient.phone_key.is_(None), Patient.name_key.is_(None),
+                       Patient.first_name_key.is_(None)), Patient.id > last_id)
+            .order_by(Patient.id).limit(CHUNK_ROWS)).all()
+        if not rows:
+            return updated
+        db.session.execute(statement, [{'patient_id': row.id,
+                                        'b_phone_key': phone_key(row.phone),
+                                        'b_name_key': soundex(row.last_name),
+                                        'b_first_name_key': soundex(row.first_name)}
+                                       for row in rows])
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1].id
+
+
+def _ordered(query, *keys):
+    return db.session.execute(query.order_by(*keys).execution_options(yield_per=CHUNK_ROWS))
+
+
+def blocks():
+    """Yield (block name, rows) for every block of two or more patients."""
+    phones = _ordered(select(*MATCH_COLUMNS).where(Patient.phone_key != ''),
+                      Patient.phone_key, Patient.id)
+    codes = union_all(*(select(*MATCH_COLUMNS, key.label('code'))
+                        .where(Patient.date_of_birth.isnot(None), key != '')
+                        for key in (Patient.name_key, Patient.first_name_key))).subquery()
+    births = _ordered(select(codes), codes.c.date_of_birth, codes.c.code, codes.c.id)
+    for name, rows, block_key in (
+            ('phone', phones, lambda row: row.phone_key),
+            ('birth_name', births, lambda row: (row.date_of_birth, row.code))):
+        for _, block in groupby(rows, key=block_key):
+            # A patient whose two names share a code is in the block twice
+            block = list({row.id: row for row in block}.values())
+            if len(block) > 1:
+                yield name, block
+
+
+def find_duplicates():
+    """Scan every block and store new candidate pairs; returns a summary."""
+    config = current_app.config
+    threshold, max_block = config['DEDUP_MIN_SCORE'], config['DEDUP_MAX_BLOCK']
+    started = datetime.utcnow()
+    keys_updated = refresh_keys()
+    scored = {}
+    matched_on = {}
+    scanned = oversized = compared = 0
+    for name, block in blocks():
+        if len(block) > max_block:
+            oversized += 1
+            continue
+        scanned += 1
+        for i, a in enumerate(block):
+            for b in block[i + 1:]:
+                pair = (a.id, b.id)
+                names = matched_on.setdefault(pair, [])
+                if name not in names:
+                    names.append(name)
+                if pair not in scored:
+                    compared += 1
+                    scored[pair] = score(a, b)
+    existing = set(db.session.execute(
+        select(DuplicateCandidate.patient_id, DuplicateCandidate.duplicate_id)).all())
+    new = [{'patient_id': a, 'duplicate_id': b, 'score': value,
+            'matched_on': ','.join(matched_on[(a, b)]), 'status': 'open', 'created_at': started}
+           for (a, b), value in scored.items() if value >= threshold and (a, b) not in existing]
+    for start in range(0, len(new), CHUNK_ROWS):
+        db.session.execute(DuplicateCandidate.__table__.insert(), new[start:start + CHUNK_ROWS])
+    db.session.commit()
+    return {'keys_updated': keys_updated, 'blocks': scanned, 'oversized_blocks': oversized,
+            'pairs_compared': compared, 'new_candidates': len(new),
+            'seconds': round((datetime.utcnow() - started).total_seconds(), 1)}
+
+
+# Merging
+
+def merge_patients(keep_id, duplicate_id, merged_by=None):
+    """Move everything of ``duplicate_id`` to ``keep_id`` and delete it; returns the PatientMerge."""
+    if keep_id == duplicate_id:
+        raise ValueError('A patient cannot be merged into itself.')
+    keep = db.session.get(Patient, keep_id)
+    duplicate = db.session.get(Patient, duplicate_id)
+    if keep is None or duplicate is None:
+        raise ValueError('Patient not found.')
+    moved = {}
+    now = datetime.utcnow()
+    for model in MERGED_TABLES:
+        table = model.__table__
+        values = {'patient_id': keep_id}
+        if 'updated_at' in table.c:
+            # So incremental readers (the analytics snapshot) see the move
+            values['updated_at'] = now
+        result = db.session.execute(table.update().where(table.c.patient_id == duplicate_id)
+                                    .values(**values))
+        moved[table.name] = result.rowcount
+    for field in FILLED_FIELDS:
+        if not getattr(keep, field) and getattr(duplicate, field):
+            setattr(keep, field, getattr(duplicate, field))
+    record = {column.name: getattr(duplicate, column.key) for column in Patient.__table__.columns}
+    merge = PatientMerge(kept_id=keep_id, merged_id=duplicate_id,
+                         merged_record=json.dumps(record, default=str),
+                         moved=json.dumps(moved), merged_by=merged_by)
+    db.session.add(merge)
+    db.session.execute(delete(DuplicateCandidate).where(or_(
+        DuplicateCandidate.patient_id == duplicate_id, DuplicateCandidate.duplicate_id == duplicate_id)))
+    # A Core DELETE: the ORM would try to null out the children it just lost
+    db.session.expunge(duplicate)
+    db.session.execute(delete(Patient).where(Patient.id == duplicate_id))
+    db.session.commit()
+    return merge
@@ -0,0 +1,347 @@
+"""Work-queue events for the pharmacy and laboratory live views.
+
+Commits that create prescriptions or lab tests, or change their status, write
+a row to the ``queue_event`` outbox table inside the same transaction. Each
+worker runs a single notifier thread that polls the outbox and fans new rows
+out to its in-process subscribers, so one cheap indexed query per interval
+replaces every open dashboard reloading the work lists.
+
+Appointment changes that concern a waiting room (to or from ``checked_in``
+or ``in_consultation``) go to the ``waiting_room`` channel, which the
+per-worker queues in ``app.utils.waiting_room`` listen to. The changes are
+also left in ``session.info`` for the committing worker to apply at once.
+
+Streams hold no database connection while idle. Run them under a
+cooperative worker class (``gunicorn -k gevent``) or a threaded one with
+enough threads; ``SSE_MAX_CONNECTIONS`` caps how many a single worker
+accepts (500 by default). ``tests/test_events.py::test_idle_stream_memory``
+measures an idle stream on its own thread at about 21 KB of RSS, 4 KB of it
+in the broker, so a worker at the cap holds roughly 11 MB for its streams
+before the server's per-request and socket buffers.
+
+Outbox ids are assigned at INSERT but become visible at COMMIT, so on a
+server database a transaction can commit after a later id was already
+delivered. The notifier remembers the ids it skipped over and looks for
+them again on each poll for ``SSE_GAP_TIMEOUT`` seconds; ids that never
+show up were rolled back.
+"""
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import Response, request, stream_with_context
+from sqlalchemy import event, inspect
+from app import db
+from app.models import QueueEvent, Prescription, LabTest, Appointment
+
+PHARMACY_CHANNEL = 'pharmacy'
+LABORATORY_CHANNEL = 'laboratory'
+WAITING_ROOM_CHANNEL = 'waiting_room'
+WAITING_ROOM_STATUSES = ('checked_in', 'in_consultation')
+APPOINTMENT_CHANGES = 'appointment_changes'  # session.info key
+MAX_GAPS = 1000  # skipped ids remembered after a single delivered one
+
+
+class Subscription:
+    """A bounded per-connection event queue."""
+
+    def __init__(self, channel, maxsize):
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+
+class EventBroker:
+    """In-process fan-out of outbox events to SSE subscribers."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._listeners = {}
+        self._count = 0
+        self._notifier = None
+        self._last_id = None
+        self._gaps = {}  # skipped outbox id -> monotonic time first missed
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SSE_MAX_CONNECTIONS', 500)
+        app.config.setdefault('SSE_POLL_INTERVAL', 1.0)
+        app.config.setdefault('SSE_HEARTBEAT_INTERVAL', 15)
+        app.config.setdefault('SSE_QUEUE_SIZE', 100)
+        app.config.setdefault('SSE_EVENT_RETENTION', 3600)
+        app.config.setdefault('SSE_GAP_TIMEOUT', 30)
+        self.app = app
+        app.extensions['event_broker'] = self
+
+    @property
+    def connection_count(self):
+        return self._count
+
+    def subscribe(self, channel):
+        """Register a subscriber, or return None when the worker is at its cap."""
+        with self._lock:
+            if self._count >= self.app.config['SSE_MAX_CONNECTIONS']:
+                return None
+            sub = Subscription(channel, self.app.config['SSE_QUEUE_SIZE'])
+            self._subscribers.setdefault(channel, set()).add(sub)
+            self._count += 1
+        self._ensure_notifier()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.channel)
+            if subs and sub in subs:
+                subs.discard(sub)
+                self._count -= 1
+
+    def listen(self, channel, callback, since):
+        """Call ``callback(data)`` in the notifier thread for every event on
+        ``channel`` after outbox id ``since``; events between ``since`` and
+        the notifier's position are replayed now."""
+        with self._lock:
+            self._listeners.setdefault(channel, set()).add(callback)
+            if self._last_id is None:
+                self._last_id = since
+            missed = self._last_id > since
+        if missed:
+            for item in events_since(channel, since, limit=None):
+                callback(item['data'])
+        self._ensure_notifier()
+
+    def publish(self, channel, item):
+        """Deliver an event to every local subscriber of ``channel``."""
+        with self._lock:
+            subs = list(self._subscribers.get(channel, ()))
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(item)
+            except queue.Full:
+                # A client that stopped reading is dropped; it reconnects
+                # with Last-Event-ID and replays from the outbox.
+                sub.overflowed = True
+                self.unsubscribe(sub)
+
+    def stream(self, sub, backlog=()):
+        """Yield the SSE wire format for a subscription until it closes."""
+        heartbeat = self.app.config['SSE_HEARTBEAT_INTERVAL']
+        try:
+            yield 'retry: 3000\n\n'
+            for item in backlog:
+                yield format_sse(item)
+            while not sub.overflowed:
+                try:
+                    item = sub.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield format_sse(item)
+        finally:
+            self.unsubscribe(sub)
+
+    def _ensure_notifier(self):
+        if self._notifier is not None and self._notifier.is_alive():
+            return
+        with self._lock:
+            if self._notifier is not None and self._notifier.is_alive():
+                return
+            self._notifier = threading.Thread(target=self._run_notifier,
+                                              name='queue-event-notifier',
+                                              daemon=True)
+            self._notifier.start()
+
+    def _run_notifier(self):
+        interval = self.app.config['SSE_POLL_INTERVAL']
+        polls = 0
+        with self.app.app_context():
+            if self._last_id is None:
+                self._last_id = db.session.query(
+                    db.func.max(QueueEvent.id)).scalar() or 0
+                db.session.remove()
+            while True:
+                time.sleep(interval)
+                if not self._count and not self._listeners:
+                    continue
+                try:
+                    self._poll()
+                    polls += 1
+                    if polls % 300 == 0:
+                        prune_events(self.app.config['SSE_EVENT_RETENTION'])
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f'Queue event notifier failed: {str(e)}')
+                finally:
+                    db.session.remove()
+
+    def _poll(self):
+        now = time.monotonic()
+        if self._gaps:
+            timeout = self.app.config['SSE_GAP_TIMEOUT']
+            self._gaps = {id: since for id, since in self._gaps.items()
+                          if now - since < timeout}
+        if self._gaps:
+            # Transactions that committed after a later id was delivered
+            for row in QueueEvent.query.filter(QueueEvent.id.in_(list(self._gaps)))\
+                    .order_by(QueueEvent.id):
+                del self._gaps[row.id]
+                self._deliver(row)
+        rows = QueueEvent.query.filter(QueueEvent.id > self._last_id)\
+            .order_by(QueueEvent.id).limit(500).all()
+        for row in rows:
+            # Bounded so a jump in the sequence cannot flood the gap list
+            self._gaps.update(dict.fromkeys(
+                range(max(self._last_id + 1, row.id - MAX_GAPS), row.id), now))
+            self._deliver(row)
+            self._last_id = row.id
+
+    def _deliver(self, row):
+        item = event_to_dict(row)
+        for callback in list(self._listeners.get(row.channel, ())):
+            callback(item['data'])
+        self.publish(row.channel, item)
+
+
+broker = EventBroker()
+
+
+def event_to_dict(row):
+    return {
+        'id': row.id,
+        'event': row.event_type,
+        'data': json.loads(row.payload) if row.payload else {}
+    }
+
+
+def format_sse(item):
+    return f"id: {item['id']}\nevent: {item['event']}\ndata: {json.dumps(item['data'])}\n\n"
+
+
+def events_since(channel, last_id, limit=100):
+    """Return outbox events a reconnecting client missed."""
+    rows = QueueEvent.query.filter(QueueEvent.channel == channel,
+                                   QueueEvent.id > last_id)\
+        .order_by(QueueEvent.id).limit(limit).all()
+    return [event_to_dict(row) for row in rows]
+
+
+def sse_response(channel):
+    """Open an event stream for ``channel`` for the current request."""
+    sub = broker.subscribe(channel)
+    if sub is None:
+        return Response('Too many live connections on this worker.', status=503,
+                        headers={'Retry-After': '30'})
+    backlog = []
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is not None:
+        backlog = events_since(channel, last_id)
+    # Give the connection back to the pool before the stream goes idle
+    db.session.remove()
+    return Response(stream_with_context(broker.stream(sub, backlog)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+def prune_events(retention_seconds):
+    cutoff = datetime.utcnow() - timedelta(seconds=retention_seconds)
+    QueueEvent.query.filter(QueueEvent.created_at < cutoff)\
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def record_status_changes(model, ids):
+    """Write outbox rows for bulk UPDATEs, which bypass the flush hook."""
+    if not ids:
+        return
+    channel = LABORATORY_CHANNEL if model is LabTest else PHARMACY_CHANNEL
+    now = datetime.utcnow()
+    rows = [_outbox_row(channel, 'status_changed', obj, now)
+            for obj in model.query.filter(model.id.in_(ids)).populate_existing()]
+    db.session.execute(QueueEvent.__table__.insert(), rows)
+
+
+def _status_changed(obj):
+    return bool(inspect(obj).attrs.status.history.added)
+
+
+def appointment_change(appointment):
+    """The waiting-room view of an appointment, as sent on its channel."""
+    def iso(value):
+        return value.isoformat() if value else None
+    return {
+        'id': appointment.id,
+        'doctor_id': appointment.doctor_id,
+        'patient_id': appointment.patient_id,
+        'status': appointment.status,
+        'priority': appointment.queue_priority or 0,
+        'appointment_date': iso(appointment.appointment_date),
+        'checked_in_at': iso(appointment.checked_in_at),
+        'updated_at': iso(appointment.updated_at)
+    }
+
+
+def waiting_room_row(change, now):
+    return {
+        'channel': WAITING_ROOM_CHANNEL,
+        'event_type': 'appointment_changed',
+        'payload': json.dumps(change),
+        'created_at': now
+    }
+
+
+def _concerns_waiting_room(obj):
+    history = inspect(obj).attrs.status.history
+    return obj.status in WAITING_ROOM_STATUSES or \
+        any(status in WAITING_ROOM_STATUSES for status in history.deleted)
+
+
+def _collect_queue_events(session, flush_context):
+    rows = []
+    now = datetime.utcnow()
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Appointment) and obj.status in WAITING_ROOM_STATUSES:
+            changes.append(appointment_change(obj))
+        elif isinstance(obj, Prescription):
+            rows.append(_outbox_row(PHARMACY_CHANNEL, 'new_prescription', obj, now))
+        elif isinstance(obj, LabTest):
+            rows.append(_outbox_row(LABORATORY_CHANNEL, 'new_lab_test', obj, now))
+    for obj in session.dirty:
+        if isinstance(obj, Prescription) and _status_changed(obj):
+            rows.append(_outbox_row(PHARMACY_CHANNEL, 'status_changed', obj, now))
+        elif isinstance(obj, LabTest) and _status_changed(obj):
+            rows.append(_outbox_row(LABORATORY_CHANNEL, 'status_changed', obj, now))
+        elif isinstance(obj, Appointment) and session.is_modified(obj) and _concerns_waiting_room(obj):
+            changes.append(appointment_change(obj))
+    for change in changes:
+        rows.append(waiting_room_row(change, now))
+    if changes:
+        session.info.setdefault(APPOINTMENT_CHANGES, []).extend(changes)
+    if rows:
+        session.connection().execute(QueueEvent.__table__.insert(), rows)
+
+
+def _outbox_row(channel, event_type, obj, now):
+    payload = {
+        'id': obj.id,
+        'patient_id': obj.patient_id,
+        'status': obj.status
+    }
+    if isinstance(obj, LabTest):
+        payload['test_type'] = obj.test_type
+    return {
+        'channel': channel,
+        'event_type': event_type,
+        'payload': json.dumps(payload),
+        'created_at': now
+    }
+
+
+event.listen(db.session, 'after_flush', _collect_queue_events)
@@ -0,0 +1,207 @@
+"""Appointment volume forecasts per doctor and department.
+
+``flask forecast run`` (nightly, from cron) reads daily appointment counts
+per doctor for the last ``FORECAST_HISTORY_DAYS`` days in one grouped
+query, into a doctors x days matrix. Every doctor is then fitted at once:
+
+* a day-of-week profile, each weekday's mean over the last
+  ``FORECAST_SEASON_WEEKS`` weeks relative to the weekly mean;
+* a level, the last ``FORECAST_LEVEL_DAYS`` days' volume divided by the
+  profile over the same days (a seasonally adjusted moving average).
+
+The forecast for a day is level x profile[weekday], for the next
+``FORECAST_HORIZON_WEEKS`` weeks. Departments are the sum of their
+doctors. Cancelled appointments are not counted.
+
+The run also backtests the model: it refits at ``FORECAST_BACKTEST_ORIGINS``
+weekly origins before today and compares each forecast with what
+happened, next to a naive "same as last week" forecast. The result is
+written to ``FORECAST_FILE`` and served from there until the next run;
+requests never compute it.
+"""
+import json
+import os
+import threading
+from datetime import date, datetime, timedelta
+import numpy as np
+from flask import current_app
+from app import db
+from app.models import Appointment, User
+from app.utils.archive import combined
+
+
+def daily_volumes(doctor_ids, start, end):
+    """Non-cancelled appointments per doctor per day in [start, end) as a matrix."""
+    appointments = combined(Appointment, 'doctor_id', 'appointment_date', 'status')
+    day = db.func.date(appointments.c.appointment_date)
+    rows = db.session.query(appointments.c.doctor_id, day, db.func.count())\
+        .filter(appointments.c.appointment_date >= start,
+                appointments.c.appointment_date < end,
+                appointments.c.status != 'cancelled')\
+        .group_by(appointments.c.doctor_id, day).all()
+    volumes = np.zeros((len(doctor_ids), (end - start).days))
+    index = {doctor_id: i for i, doctor_id in enumerate(doctor_ids)}
+    rows = [(index[doctor_id], (date.fromisoformat(str(day)[:10]) - start).days, count)
+            for doctor_id, day, count in rows if doctor_id in index]
+    if rows:
+        doctors, days, counts = np.array(rows).T
+        volumes[doctors, days] = counts
+    return volumes
+
+
+def _weekdays(first_day, count, offset=0):
+    return (first_day.weekday() + offset + np.arange(count)) % 7
+
+
+def fit(volumes, first_day, season_weeks, level_days):
+    """Return (level, profile) for every row of a series matrix starting on first_day."""
+    days = volumes.shape[1]
+    season = volumes[:, days - season_weeks * 7:]
+    weekday = _weekdays(first_day, season.shape[1], days - season.shape[1])
+    # Columns of one week in Monday..Sunday order
+    by_weekday = season.reshape(len(volumes), season_weeks, 7)[:, :, np.argsort(weekday[:7])]
+    profile = by_weekday.mean(axis=1)
+    weekly_mean = profile.mean(axis=1, keepdims=True)
+    profile = np.divide(profile, weekly_mean, out=np.zeros_like(profile), where=weekly_mean > 0)
+    recent = _weekdays(first_day, level_days, days - level_days)
+    expected = profile[:, recent].sum(axis=1)
+    level = np.divide(volumes[:, -level_days:].sum(axis=1), expected,
+                      out=np.zeros(len(volumes)), where=expected > 0)
+    return level, profile
+
+
+def predict(level, profile, first_day, horizon):
+    """Forecast matrix for ``horizon`` days starting on first_day."""
+    return level[:, None] * profile[:, _weekdays(first_day, horizon)]
+
+
+def _weekly(series):
+    """Sum the last axis into whole weeks."""
+    weeks = series.shape[-1] // 7
+    return series[..., :weeks * 7].reshape(*series.shape[:-1], weeks, 7).sum(axis=-1)
+
+
+def _wape(forecast, actual):
+    total = actual.sum()
+    return round(float(np.abs(forecast - actual).sum() / total), 4) if total else None
+
+
+def backtest(volumes, first_day, horizon, origins, season_weeks, level_days):
+    """Accuracy of forecasts made at ``origins`` weekly cut-offs before the last day."""
+    days = volumes.shape[1]
+    needed = season_weeks * 7
+    cuts = [days - horizon - 7 * k for k in range(origins)]
+    cuts = [cut for cut in cuts if cut >= max(needed, level_days, 7)]
+    forecasts, naives, actuals = [], [], []
+    for cut in cuts:
+        level, profile = fit(volumes[:, :cut], first_day, season_weeks, level_days)
+        forecasts.append(predict(level, profile, first_day + timedelta(days=cut), horizon))
+        naives.append(np.tile(volumes[:, cut - 7:cut], horizon // 7 + 1)[:, :horizon])
+        actuals.append(volumes[:, cut:cut + horizon])
+    if not cuts:
+        return None
+    forecast, naive, actual = (np.stack(a, axis=1) for a in (forecasts, naives, actuals))
+    return {
+        'origins': len(cuts),
+        'horizon_days': horizon,
+        'daily_wape': _wape(forecast, actual),
+        'weekly_wape': _wape(_weekly(forecast), _weekly(actual)),
+        'naive_daily_wape': _wape(naive, actual),
+        'naive_weekly_wape': _wape(_weekly(naive), _weekly(actual)),
+        'bias': round(float((forecast - actual).sum() / actual.sum()), 4) if actual.sum() else None,
+        'per_row_weekly_wape': [_wape(_weekly(forecast[i]), _weekly(actual[i]))
+                                for i in range(len(volumes))]
+    }
+
+
+def _series(label_fields, forecast, first_day):
+    return dict(label_fields,
+                daily=[{'date': (first_day + timedelta(days=i)).isoformat(), 'expected': round(float(v), 1)}
+                       for i, v in enumerate(forecast)],
+                weekly=[round(float(v), 1) for v in _weekly(forecast)])
+
+
+def run_forecast(today=None):
+    """Fit, forecast and backtest every doctor and department; returns the result."""
+    config = current_app.config
+    today = today or date.today()
+    start = today - timedelta(days=config['FORECAST_HISTORY_DAYS'])
+    horizon = config['FORECAST_HORIZON_WEEKS'] * 7
+    season_weeks, level_days = config['FORECAST_SEASON_WEEKS'], config['FORECAST_LEVEL_DAYS']
+    doctors = User.query.filter_by(role='doctor', is_active=True).order_by(User.id).all()
+    volumes = daily_volumes([doctor.id for doctor in doctors], start, today)
+    departments = sorted({doctor.department or 'Unassigned' for doctor in doctors})
+    membership = np.array([[(doctor.department or 'Unassigned') == department for doctor in doctors]
+                           for department in departments], dtype=float).reshape(len(departments),
+                                                                                 len(doctors))
+    department_volumes = membership @ volumes
+
+    level, profile = fit(volumes, start, season_weeks, level_days)
+    forecast = predict(level, profile, today, horizon)
+    doctor_backtest = backtest(volumes, start, horizon, config['FORECAST_BACKTEST_ORIGINS'],
+                               season_weeks, level_days)
+    department_backtest = backtest(department_volumes, start, horizon,
+                                   config['FORECAST_BACKTEST_ORIGINS'], season_weeks, level_days)
+    doctor_accuracy = doctor_backtest.pop('per_row_weekly_wape') if doctor_backtest else []
+    department_accuracy = department_backtest.pop('per_row_weekly_wape') if department_backtest else []
+    return {
+        'generated_at': datetime.utcnow().isoformat(),
+        'history_start': start.isoformat(),
+        'start': today.isoformat(),
+        'horizon_days': horizon,
+        'doctors': [_series({'doctor_id': doctor.id, 'doctor': doctor.get_full_name(),
+                             'department': doctor.department,
+                             'backtest_weekly_wape': doctor_accuracy[i] if doctor_accuracy else None},
+                            forecast[i], today)
+                    for i, doctor in enumerate(doctors)],
+        'departments': [_series({'department': department,
+                                 'backtest_weekly_wape': department_accuracy[i]
+                                 if department_accuracy else None},
+                                row, today)
+                        for i, (department, row) in enumerate(zip(departments, membership @ forecast))],
+        'backtest': {'doctors': doctor_backtest, 'departments': department_backtest}
+    }
+
+
+def forecast_file():
+    return current_app.config['FORECAST_FILE'] or \
+        os.path.join(current_app.instance_path, 'forecast.json')
+
+
+def save_forecast(result):
+    path = forecast_file()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}'
+    with open(temporary, 'w') as f:
+        json.dump(result, f)
+    os.replace(temporary, path)
+
+
+_lock = threading.Lock()
+_cached = {}
+
+
+def empty_forecast():
+    """Stands in for the forecast until ``flask forecast run`` has written one."""
+    return {'generated_at': None, 'history_start': None, 'start': None,
+            'horizon_days': current_app.config['FORECAST_HORIZON_WEEKS'] * 7,
+            'doctors': [], 'departments': [], 'backtest': {'doctors': None, 'departments': None}}
+
+
+def load_forecast():
+    """The last saved forecast, read once per run.
+
+    Before the first ``flask forecast run`` this is ``empty_forecast()``;
+    the full run is too slow to do inside a request.
+    """
+    path = forecast_file()
+    with _lock:
+        try:
+            stamp = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return empty_forecast()
+        cached = _cached.get(path)
+        if cached is None or cached[0] != stamp:
+            with open(path) as f:
+                cached = _cached[path] = (stamp, json.load(f))
+        return cached[1]
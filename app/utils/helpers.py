@@ -1,12 +1,13 @@
 from flask import current_app
 from flask_mail import Message
 from app import mail
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from app.utils.checkin import checkin_token, qr_png
+from app.utils.storage import save_stream
 from datetime import datetime
-import os
+from io import BytesIO
+
+# reportlab takes ~90 ms to import, so the PDF helpers import it on first
+# use instead of every worker and CLI command paying for it at startup.
 
 def send_email(subject, recipients, body, html=None, attachments=None):
     """Send email using Flask-Mail."""
@@ -33,19 +34,25 @@ def send_appointment_confirmation(appointment):
 
 Your appointment has been scheduled for {appointment.appointment_date.strftime('%B %d, %Y at %I:%M %p')} with Dr. {appointment.doctor.first_name} {appointment.doctor.last_name}.
 
-Please arrive 15 minutes before your scheduled time.
+Please arrive 15 minutes before your scheduled time. To check in, scan the attached QR code at the reception kiosk.
 
 Best regards,
 Hospital Management Team'''
     
-    return send_email(subject, [appointment.patient.email], body)
+    qr = ('check-in.png', 'image/png', qr_png(checkin_token(appointment)))
+    return send_email(subject, [appointment.patient.email], body, attachments=[qr])
 
 def generate_invoice_pdf(bill):
-    """Generate PDF invoice for a bill."""
+    """Generate PDF invoice for a bill and store it; returns the StoredFile."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
     filename = f'invoice_{bill.id}_{datetime.now().strftime("%Y%m%d%H%M%S")}.pdf'
-    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    buffer = BytesIO()
     
-    doc = SimpleDocTemplate(filepath, pagesize=letter)
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
     styles = getSampleStyleSheet()
     elements = []
     
@@ -124,7 +131,54 @@ def generate_invoice_pdf(bill):
     
     # Build PDF
     doc.build(elements)
-    return filename
+    buffer.seek(0)
+    return save_stream(buffer, filename)
+
+def generate_lab_report_pdf(test):
+    """Generate PDF report for a completed lab test and store it; returns the StoredFile."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet
+
+    filename = f'lab_report_{test.id}_{datetime.now().strftime("%Y%m%d%H%M%S")}.pdf'
+    buffer = BytesIO()
+
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    styles = getSampleStyleSheet()
+    elements = []
+
+    elements.append(Paragraph('Hospital Management System', styles['Heading1']))
+    elements.append(Paragraph(f'Laboratory Report #{test.id}', styles['Heading2']))
+    elements.append(Spacer(1, 20))
+
+    # Add patient and test information
+    test_info = [
+        [Paragraph('Patient Name:', styles['Heading4']),
+         Paragraph(f'{test.patient.first_name} {test.patient.last_name}', styles['Normal'])],
+        [Paragraph('Test:', styles['Heading4']),
+         Paragraph(test.test_type.replace('_', ' ').title(), styles['Normal'])],
+        [Paragraph('Date:', styles['Heading4']),
+         Paragraph(test.test_date.strftime('%B %d, %Y'), styles['Normal'])]
+    ]
+    info_table = Table(test_info, colWidths=[100, 400])
+    info_table.setStyle(TableStyle([
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+    ]))
+    elements.append(info_table)
+    elements.append(Spacer(1, 20))
+
+    # Add results
+    elements.append(Paragraph('Results', styles['Heading3']))
+    elements.append(Paragraph(test.results or '', styles['Normal']))
+
+    doc.build(elements)
+    buffer.seek(0)
+    return save_stream(buffer, filename)
 
 def format_currency(amount):
     """Format currency amount."""
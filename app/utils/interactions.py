@@ -0,0 +1,228 @@
+"""Drug-interaction checking.
+
+Interactions are imported from CSV with ``flask interactions import`` into
+``drug_interaction``, one row per unordered pair of medications. Each
+worker loads the table into memory as a dict keyed by the pair packed into
+one integer, plus the set of interacting medications for each medication.
+Checking a prescription is then a set intersection per new medication
+against the patient's active medications, with no query per pair. The
+table is reloaded when its row count or latest ``updated_at`` changes,
+looked at no more than every ``INTERACTION_REFRESH`` seconds.
+
+A medication is active for a patient while it is on a pending or dispensed
+prescription written within ``INTERACTION_ACTIVE_DAYS``; durations are free
+text, so the window stands in for them.
+
+``flask interactions scan`` checks every patient's active medications
+against each other, for an overnight run from cron.
+"""
+import bisect
+import csv
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+from flask import current_app
+from sqlalchemy import delete, func, select
+from app import db
+from app.models import DrugInteraction, Medication, Prescription, PrescriptionMedication
+
+SEVERITIES = ('minor', 'moderate', 'major', 'contraindicated')
+# Prescribing with these needs the doctor's explicit confirmation
+CONFIRM_SEVERITIES = ('major', 'contraindicated')
+ACTIVE_STATUSES = ('pending', 'dispensed')
+
+
+def pair_key(a, b):
+    if a > b:
+        a, b = b, a
+    return a << 32 | b
+
+
+class InteractionTable:
+    """Per-worker copy of the interaction table."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pairs = {}  # pair_key -> (severity rank, description)
+        self._partners = {}  # medication id -> frozenset of interacting ids
+        self._version = None
+        self._checked_at = 0.0
+
+    def load(self, rows):
+        """Replace the table with (medication_id, interacting_id, severity, description) rows."""
+        pairs = {}
+        partners = {}
+        for a, b, severity, description in rows:
+            pairs[pair_key(a, b)] = (SEVERITIES.index(severity), description)
+            partners.setdefault(a, set()).add(b)
+            partners.setdefault(b, set()).add(a)
+        self._pairs = pairs
+        self._partners = {id: frozenset(ids) for id, ids in partners.items()}
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self._version is not None and \
+                now - self._checked_at < current_app.config['INTERACTION_REFRESH']:
+            return
+        with self._lock:
+            version = tuple(db.session.execute(
+                select(func.count(DrugInteraction.id), func.max(DrugInteraction.updated_at))).one())
+            if force or version != self._version:
+                self.load(db.session.execute(select(
+                    DrugInteraction.medication_id, DrugInteraction.interacting_medication_id,
+                    DrugInteraction.severity, DrugInteraction.description)).all())
+                self._version = version
+            self._checked_at = now
+
+    def involves(self, medication_ids):
+        """Whether any of the medications has a known interaction at all."""
+        return any(id in self._partners for id in medication_ids)
+
+    def check(self, medication_ids, active=None):
+        """Interactions among ``medication_ids`` and between them and ``active``.
+
+        ``active`` maps the patient's current medication ids to the
+        prescription they are on. Returns warning dicts, most severe first.
+        """
+        active = active or {}
+        new = list(dict.fromkeys(medication_ids))
+        warnings = []
+        for i, id in enumerate(new):
+            partners = self._partners.get(id)
+            if not partners:
+                continue
+            for other in new[i + 1:]:
+                if other in partners:
+                    warnings.append(self._warning(id, other, None))
+            for other in partners.intersection(active):
+                if other not in new:
+                    warnings.append(self._warning(id, other, active[other]))
+        warnings.sort(key=lambda warning: -SEVERITIES.index(warning['severity']))
+        return warnings
+
+    def _warning(self, id, other, prescription_id):
+        rank, description = self._pairs[pair_key(id, other)]
+        return {'medication_id': id, 'interacting_medication_id': other,
+                'prescription_id': prescription_id, 'severity': SEVERITIES[rank],
+                'description': description}
+
+
+interaction_table = InteractionTable()
+
+
+def _active_lines(since):
+    return select(Prescription.patient_id, PrescriptionMedication.medication_id,
+                  PrescriptionMedication.prescription_id)\
+        .join(Prescription, Prescription.id == PrescriptionMedication.prescription_id)\
+        .where(Prescription.status.in_(ACTIVE_STATUSES), Prescription.prescription_date >= since)
+
+
+def _active_since(now=None):
+    return (now or datetime.utcnow()) - timedelta(days=current_app.config['INTERACTION_ACTIVE_DAYS'])
+
+
+def active_medications(patient_id, exclude_prescription_id=None):
+    """The patient's active medications as {medication_id: prescription_id}."""
+    query = _active_lines(_active_since()).where(Prescription.patient_id == patient_id)
+    if exclude_prescription_id is not None:
+        query = query.where(Prescription.id != exclude_prescription_id)
+    return {row.medication_id: row.prescription_id for row in db.session.execute(query)}
+
+
+def _with_names(warnings):
+    if warnings:
+        ids = {id for warning in warnings
+               for id in (warning['medication_id'], warning['interacting_medication_id'])}
+        names = dict(db.session.execute(
+            select(Medication.id, Medication.name).where(Medication.id.in_(ids))).all())
+        for warning in warnings:
+            warning['medication'] = names.get(warning['medication_id'])
+            warning['interacting_medication'] = names.get(warning['interacting_medication_id'])
+    return warnings
+
+
+def check_prescription(patient_id, medication_ids, exclude_prescription_id=None):
+    """Warnings for prescribing ``medication_ids`` to a patient, with medication names."""
+    interaction_table.refresh()
+    if not interaction_table.involves(medication_ids):
+        return []
+    active = active_medications(patient_id, exclude_prescription_id)
+    return _with_names(interaction_table.check(medication_ids, active))
+
+
+def scan_active_prescriptions(now=None, min_severity='minor'):
+    """Yield (patient_id, warning) for every interaction among active medications."""
+    interaction_table.refresh(force=True)
+    floor = SEVERITIES.index(min_severity)
+    query = _active_lines(_active_since(now)).order_by(Prescription.patient_id)
+    rows = db.session.execute(query.execution_options(yield_per=5000))
+    for patient_id, lines in groupby(rows, key=lambda row: row.patient_id):
+        active = {}
+        for line in lines:
+            active.setdefault(line.medication_id, line.prescription_id)
+        if len(active) < 2:
+            continue
+        for warning in interaction_table.check(active):
+            if SEVERITIES.index(warning['severity']) >= floor:
+                warning['prescription_id'] = active[warning['medication_id']]
+                warning['interacting_prescription_id'] = active[warning['interacting_medication_id']]
+                yield patient_id, warning
+
+
+def _match_names(medications):
+    """Index of (lowercase name, id) for matching CSV names to formulary entries."""
+    return sorted((name.strip().lower(), id) for id, name in medications)
+
+
+def _lookup(names, name):
+    """Ids of medications called ``name`` or ``name`` followed by a strength or form."""
+    name = name.strip().lower()
+    if not name:
+        return []
+    exact = names[bisect.bisect_left(names, (name,)):bisect.bisect_left(names, (name + '\0',))]
+    start = bisect.bisect_left(names, (name + ' ',))
+    end = bisect.bisect_left(names, (name + '!',), start)
+    return [id for _, id in exact] + [id for _, id in names[start:end]]
+
+
+def import_interactions(stream, replace=False):
+    """Load drug_a,drug_b,severity,description rows; returns (pairs, skipped rows).
+
+    A drug name matches medications of that name and ones that extend it
+    with a strength or form ("Warfarin" matches "Warfarin 5mg tablet").
+    Pairs already in the table are updated.
+    """
+    names = _match_names(db.session.execute(select(Medication.id, Medication.name)).all())
+    pairs = {}
+    skipped = []
+    for line, row in enumerate(csv.DictReader(stream), start=2):
+        severity = (row.get('severity') or '').strip().lower()
+        first = _lookup(names, row.get('drug_a') or '')
+        second = _lookup(names, row.get('drug_b') or '')
+        if severity not in SEVERITIES or not first or not second:
+            skipped.append(line)
+            continue
+        for a in first:
+            for b in second:
+                if a != b:
+                    pairs[(min(a, b), max(a, b))] = (severity, (row.get('description') or '').strip())
+    if replace:
+        db.session.execute(delete(DrugInteraction))
+        existing = {}
+    else:
+        existing = {(i.medication_id, i.interacting_medication_id): i
+                    for i in DrugInteraction.query.all()}
+    new = []
+    for (a, b), (severity, description) in pairs.items():
+        interaction = existing.get((a, b))
+        if interaction is None:
+            new.append({'medication_id': a, 'interacting_medication_id': b,
+                        'severity': severity, 'description': description})
+        elif (interaction.severity, interaction.description) != (severity, description):
+            interaction.severity = severity
+            interaction.description = description
+    if new:
+        db.session.execute(DrugInteraction.__table__.insert(), new)
+    db.session.commit()
+    return len(pairs), skipped
@@ -0,0 +1,260 @@
+"""Structured numeric lab results.
+
+Besides its free-text ``results``, a lab test can carry numeric values, one
+``lab_result`` row per analyte with its unit and reference range. Rows take
+the test's ``test_date`` as their time, and the patient id is copied in, so
+the two queries that matter are a single index range each:
+
+* a patient's trend for an analyte, on ``(patient_id, analyte, observed_at)``;
+* a cohort, e.g. every potassium above 6 today, on
+  ``(analyte, observed_at, value)``, which answers the value filter from
+  the index and pages newest first with a keyset cursor.
+
+Neither query depends on the size of the table. Values of archived tests
+move to ``archive_lab_result`` with their test; both queries read the two
+tables the same way and merge them, as the patient timeline does.
+
+When a test's values are saved, the missing units and reference ranges come
+from ``ANALYTES``. Every value is then flagged against its range and the
+analyte's critical limits in one vectorised pass: ``LL`` and ``HH`` are
+critical, ``L`` and ``H`` abnormal, ``N`` normal. Saving replaces the
+test's previous values.
+"""
+import base64
+import heapq
+import math
+from datetime import datetime
+import numpy as np
+from sqlalchemy import delete, select
+from app import db
+from app.models import LabResult, ArchivedLabResult, Patient
+
+# code: (name, unit, reference low, reference high, critical low, critical high)
+ANALYTES = {
+    'sodium': ('Sodium', 'mmol/L', 135, 145, 120, 160),
+    'potassium': ('Potassium', 'mmol/L', 3.5, 5.1, 2.5, 6.5),
+    'chloride': ('Chloride', 'mmol/L', 98, 107, None, None),
+    'bicarbonate': ('Bicarbonate', 'mmol/L', 22, 29, 10, 40),
+    'urea': ('Urea', 'mmol/L', 2.5, 7.8, None, 35),
+    'creatinine': ('Creatinine', 'umol/L', 60, 110, None, 500),
+    'glucose': ('Glucose', 'mmol/L', 3.9, 7.8, 2.5, 25),
+    'hba1c': ('HbA1c', '%', 4.0, 5.6, None, None),
+    'calcium': ('Calcium', 'mmol/L', 2.2, 2.6, 1.6, 3.2),
+    'magnesium': ('Magnesium', 'mmol/L', 0.7, 1.0, 0.4, 2.0),
+    'alt': ('ALT', 'U/L', 7, 56, None, 1000),
+    'ast': ('AST', 'U/L', 10, 40, None, 1000),
+    'bilirubin': ('Bilirubin', 'umol/L', 3, 21, None, 300),
+    'albumin': ('Albumin', 'g/L', 35, 50, None, None),
+    'crp': ('CRP', 'mg/L', 0, 5, None, None),
+    'cholesterol': ('Total cholesterol', 'mmol/L', 0, 5.2, None, None),
+    'ldl': ('LDL cholesterol', 'mmol/L', 0, 3.0, None, None),
+    'hdl': ('HDL cholesterol', 'mmol/L', 1.0, None, None, None),
+    'triglycerides': ('Triglycerides', 'mmol/L', 0, 1.7, None, None),
+    'tsh': ('TSH', 'mIU/L', 0.4, 4.0, None, None),
+    'haemoglobin': ('Haemoglobin', 'g/dL', 12, 17.5, 7, 20),
+    'wbc': ('White cell count', '10^9/L', 4, 11, 2, 30),
+    'platelets': ('Platelets', '10^9/L', 150, 400, 50, 1000),
+    'inr': ('INR', None, 0.8, 1.2, None, 5),
+    'troponin': ('Troponin I', 'ng/L', 0, 34, None, None),
+}
+
+FLAG_LABELS = {'LL': 'critically low', 'L': 'low', 'N': 'normal', 'H': 'high', 'HH': 'critically high'}
+ABNORMAL_FLAGS = ('LL', 'L', 'H', 'HH')
+CRITICAL_FLAGS = ('LL', 'HH')
+MAX_TREND_POINTS = 1000
+MAX_COHORT_PAGE = 500
+RESULT_TABLES = (LabResult, ArchivedLabResult)
+
+
+class InvalidResult(ValueError):
+    """A result row has no analyte or a non-numeric or non-finite value."""
+
+
+def analyte_code(name):
+    return '_'.join((name or '').lower().split())[:32]
+
+
+def _number(value):
+    if value is None or value == '':
+        return None
+    number = float(value)
+    # float() accepts 'nan' and 'inf'; NaN would pass every range check as normal
+    if not math.isfinite(number):
+        raise ValueError(f'{value!r} is not a finite number')
+    return number
+
+
+def _column(values):
+    return np.array([np.nan if value is None else value for value in values], dtype=float)
+
+
+def flag_values(values, low, high, critical_low, critical_high):
+    """Flags for arrays of values and limits; NaN limits are not applied."""
+    flags = np.select(
+        [values < critical_low, values > critical_high, values < low, values > high],
+        ['LL', 'HH', 'L', 'H'], default='N').astype(object)
+    flags[np.isnan(low) & np.isnan(high) & np.isnan(critical_low) & np.isnan(critical_high)] = None
+    return flags
+
+
+def prepare(rows):
+    """Normalise submitted rows and flag them; returns dicts ready to insert.
+
+    Each row has ``analyte`` and ``value``, and optionally ``unit``,
+    ``reference_low`` and ``reference_high``.
+    """
+    prepared = []
+    for number, row in enumerate(rows, start=1):
+        code = analyte_code(row.get('analyte'))
+        try:
+            value = _number(row.get('value'))
+            low, high = _number(row.get('reference_low')), _number(row.get('reference_high'))
+        except (TypeError, ValueError):
+            raise InvalidResult(f'Row {number}: values and reference limits must be finite numbers.')
+        if not code or value is None:
+            raise InvalidResult(f'Row {number}: an analyte and a value are required.')
+        _, unit, default_low, default_high, critical_low, critical_high = \
+            ANALYTES.get(code, (None, None, None, None, None, None))
+        if low is None and high is None:
+            low, high = default_low, default_high
+        prepared.append({'analyte': code, 'value': value, 'unit': row.get('unit') or unit,
+                         'reference_low': low, 'reference_high': high,
+                         'critical_low': critical_low, 'critical_high': critical_high})
+    if prepared:
+        flags = flag_values(*(_column([row[key] for row in prepared])
+                              for key in ('value', 'reference_low', 'reference_high',
+                                          'critical_low', 'critical_high')))
+        for row, flag in zip(prepared, flags):
+            row['flag'] = flag
+            del row['critical_low'], row['critical_high']
+    return prepared
+
+
+def store(lab_test_id, patient_id, observed_at, prepared):
+    """Replace a test's values with rows from ``prepare``; the caller commits."""
+    db.session.execute(delete(LabResult).where(LabResult.lab_test_id == lab_test_id))
+    if prepared:
+        db.session.execute(LabResult.__table__.insert(),
+                           [dict(row, lab_test_id=lab_test_id, patient_id=patient_id,
+                                 observed_at=observed_at) for row in prepared])
+    return prepared
+
+
+def save_results(lab_test_id, patient_id, observed_at, rows):
+    """Replace a test's values with ``rows``; returns them with their flags.
+
+    The caller commits.
+    """
+    return store(lab_test_id, patient_id, observed_at, prepare(rows))
+
+
+def summary(rows):
+    """Plain-text summary of result rows, for the free-text results field."""
+    lines = []
+    for row in rows:
+        name = ANALYTES.get(row['analyte'], (row['analyte'],))[0]
+        flag = f' ({FLAG_LABELS[row["flag"]]})' if row['flag'] not in (None, 'N') else ''
+        lines.append(f'{name}: {row["value"]:g} {row["unit"] or ""}'.rstrip() + flag)
+    return '\n'.join(lines)
+
+
+def critical(rows):
+    return [row for row in rows if row['flag'] in CRITICAL_FLAGS]
+
+
+# Queries
+
+def _row_to_dict(row):
+    return {'id': row.id,
+            'lab_test_id': row.lab_test_id,
+            'patient_id': row.patient_id,
+            'analyte': row.analyte,
+            'value': row.value,
+            'unit': row.unit,
+            'reference_low': row.reference_low,
+            'reference_high': row.reference_high,
+            'flag': row.flag,
+            'time': row.observed_at.isoformat(),
+            'archived': isinstance(row, ArchivedLabResult)}
+
+
+def _newest(build, limit):
+    """The newest ``limit`` rows of ``build(model)`` over the hot and archive tables.
+
+    A test's values are in exactly one of the two, so ids never collide.
+    """
+    streams = [db.session.execute(build(model).order_by(model.observed_at.desc(), model.id.desc())
+                                  .limit(limit)).scalars().all()
+               for model in RESULT_TABLES]
+    merged = heapq.merge(*streams, key=lambda row: (row.observed_at, row.id), reverse=True)
+    return list(merged)[:limit]
+
+
+def for_test(lab_test_id):
+    """A test's values in entry order, hot or archived."""
+    rows = [row for model in RESULT_TABLES
+            for row in db.session.execute(select(model).where(model.lab_test_id == lab_test_id)
+                                          .order_by(model.id)).scalars()]
+    return [_row_to_dict(row) for row in rows]
+
+
+def trend(patient_id, analyte, start=None, end=None, limit=MAX_TREND_POINTS):
+    """A patient's values of one analyte in time order, the latest ``limit`` of them."""
+    def build(model):
+        query = select(model).where(model.patient_id == patient_id,
+                                    model.analyte == analyte_code(analyte))
+        if start is not None:
+            query = query.where(model.observed_at >= start)
+        if end is not None:
+            query = query.where(model.observed_at < end)
+        return query
+    return [_row_to_dict(row) for row in reversed(_newest(build, limit))]
+
+
+def encode_cursor(observed_at, id):
+    return base64.urlsafe_b64encode(f'{observed_at.isoformat()}|{id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        observed_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(observed_at), int(id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def cohort(analyte, start, end, above=None, below=None, flags=None, cursor=None, limit=100):
+    """One page of results of an analyte in [start, end), newest first.
+
+    ``above`` and ``below`` are exclusive value bounds, ``flags`` a list of
+    flags to keep. The result has ``results``, with the patient's name, and
+    ``next_cursor``, which is None on the last page.
+    """
+    position = decode_cursor(cursor) if cursor else None
+
+    def build(model):
+        query = select(model).where(model.analyte == analyte_code(analyte),
+                                    model.observed_at >= start, model.observed_at < end)
+        if above is not None:
+            query = query.where(model.value > above)
+        if below is not None:
+            query = query.where(model.value < below)
+        if flags:
+            query = query.where(model.flag.in_(flags))
+        if position is not None:
+            observed_at, id = position
+            query = query.where(db.or_(model.observed_at < observed_at,
+                                       db.and_(model.observed_at == observed_at, model.id < id)))
+        return query
+
+    limit = min(limit, MAX_COHORT_PAGE)
+    rows = _newest(build, limit + 1)
+    next_cursor = encode_cursor(rows[limit - 1].observed_at, rows[limit - 1].id) \
+        if len(rows) > limit else None
+    rows = rows[:limit]
+    names = dict(db.session.execute(
+        select(Patient.id, Patient.first_name + ' ' + Patient.last_name)
+        .where(Patient.id.in_({row.patient_id for row in rows}))).all()) if rows else {}
+    return {'results': [dict(_row_to_dict(row), patient=names.get(row.patient_id))
+                        for row in rows],
+            'next_cursor': next_cursor}
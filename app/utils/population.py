@@ -0,0 +1,152 @@
+"""Population reports over the analytics snapshot.
+
+Every report is a few vectorized passes (``bincount``, ``searchsorted``,
+sorts of small key arrays) over the memory-mapped columns in
+``app.utils.snapshot``, so none of them queries the database. Appointments
+and bills are stored in date order, so a report over a date range only
+reads that slice. Figures are as of the snapshot's ``built_at``.
+"""
+import numpy as np
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def to_day(value):
+    return int((np.datetime64(value, 'D') - EPOCH).astype(np.int64))
+
+
+def to_month(value):
+    return int(np.datetime64(value, 'M').astype(np.int64))
+
+
+def month_label(month):
+    return str(np.datetime64(int(month), 'M'))
+
+
+def month_start_day(month):
+    return int((np.datetime64(int(month), 'M').astype('datetime64[D]') - EPOCH).astype(np.int64))
+
+
+def _band_labels(bands):
+    labels = [f'{low}-{high - 1}' for low, high in zip(bands, bands[1:])]
+    return labels + [f'{bands[-1]}+']
+
+
+def _distinct_counts(groups, members, size):
+    """Distinct members per group, for int group codes < size."""
+    keys = np.sort(groups.astype(np.int64) << 32 | members.astype(np.int64))
+    first = np.ones(len(keys), dtype=bool)
+    np.not_equal(keys[1:], keys[:-1], out=first[1:])
+    return np.bincount(keys[first] >> 32, minlength=size)
+
+
+def demographics(snapshot, as_of=None, bands=(0, 18, 35, 50, 65)):
+    """Registered patients by age band and gender, and by blood group."""
+    patients = snapshot['patients']
+    as_of = to_day(as_of or snapshot.built_at.date())
+    registered = patients['registered'] <= as_of
+    ages = (as_of - patients['birth'][registered]) * 4 // 1461  # whole years
+    band = np.searchsorted(np.asarray(bands[1:]), ages, side='right')
+    genders = snapshot.labels('patients', 'gender')
+    gender = patients['gender'][registered]
+    grid = np.bincount(band * len(genders) + gender,
+                       minlength=len(bands) * len(genders)).reshape(len(bands), len(genders))
+    blood_groups = snapshot.labels('patients', 'blood_group')
+    blood = np.bincount(patients['blood_group'][registered], minlength=len(blood_groups))
+    return {
+        'as_of': str(np.datetime64(as_of, 'D')),
+        'total': int(registered.sum()),
+        'age_bands': [{'band': label, 'total': int(row.sum()),
+                       'by_gender': {g: int(n) for g, n in zip(genders, row)}}
+                      for label, row in zip(_band_labels(bands), grid)],
+        'blood_groups': {str(group or 'unknown'): int(n) for group, n in zip(blood_groups, blood)}
+    }
+
+
+def cohort_retention(snapshot, start, end, months=12):
+    """Share of each first-visit cohort seen again in each following month.
+
+    A patient's cohort is the month of their first appointment that was not
+    cancelled; cohorts for months in [start, end) are reported.
+    """
+    appointments = snapshot['appointments']
+    first_visit = appointments['first_visit']
+    start_month, end_month = to_month(start), to_month(end)
+    if end_month <= start_month or not len(first_visit):
+        return {'months': months, 'cohorts': []}
+    rows = snapshot.between('appointments', month_start_day(start_month),
+                            month_start_day(end_month + months))
+    kept = appointments['status'][rows] != snapshot.code('appointments', 'status', 'cancelled')
+    patient = appointments['patient_id'][rows][kept]
+    cohort = first_visit[patient]
+    offset = appointments['month'][rows][kept] - cohort
+    within = (cohort >= start_month) & (cohort < end_month) & (offset < months)
+    # A patient counts once per month however many visits they had
+    seen = np.zeros(len(first_visit) * months, dtype=bool)
+    seen[patient[within].astype(np.int64) * months + offset[within]] = True
+    hits = np.flatnonzero(seen)
+    cohorts = end_month - start_month
+    counts = np.bincount((first_visit[hits // months] - start_month) * months + hits % months,
+                         minlength=cohorts * months).reshape(cohorts, months)
+    return {
+        'months': months,
+        'cohorts': [{'cohort': month_label(start_month + i), 'patients': int(row[0]),
+                     'retention': [round(int(n) / int(row[0]), 4) if row[0] else 0.0
+                                   for n in row]}
+                    for i, row in enumerate(counts)]
+    }
+
+
+def doctor_throughput(snapshot, start, end):
+    """Appointments per doctor in [start, end): by status, distinct patients and by month."""
+    appointments = snapshot['appointments']
+    rows = snapshot.between('appointments', to_day(start), to_day(end))
+    doctor = appointments['doctor'][rows].astype(np.int64)
+    status = appointments['status'][rows]
+    doctors = snapshot.labels('appointments', 'doctor')
+    statuses = snapshot.labels('appointments', 'status')
+    by_status = np.bincount(doctor * len(statuses) + status,
+                            minlength=len(doctors) * len(statuses)).reshape(len(doctors), len(statuses))
+    patients = _distinct_counts(doctor, appointments['patient_id'][rows], len(doctors))
+    completed = status == snapshot.code('appointments', 'status', 'completed')
+    month = appointments['month'][rows][completed]
+    first_month = int(month[0]) if len(month) else 0
+    span = int(month[-1]) - first_month + 1 if len(month) else 0
+    monthly = np.bincount(doctor[completed] * span + (month - first_month),
+                          minlength=len(doctors) * span).reshape(len(doctors), span)
+    report = []
+    for code, doctor_id in enumerate(doctors):
+        total = int(by_status[code].sum())
+        if not total:
+            continue
+        report.append({
+            'doctor_id': doctor_id,
+            'doctor': snapshot.doctors.get(str(doctor_id), f'#{doctor_id}'),
+            'appointments': total,
+            'by_status': {s: int(n) for s, n in zip(statuses, by_status[code]) if n},
+            'patients': int(patients[code]),
+            'completed_by_month': {month_label(first_month + i): int(n)
+                                   for i, n in enumerate(monthly[code]) if n}
+        })
+    report.sort(key=lambda row: -row['appointments'])
+    return {'start': str(start), 'end': str(end), 'doctors': report}
+
+
+def revenue_by_month(snapshot, start, end):
+    """Paid bills per month in [start, end)."""
+    bills = snapshot['bills']
+    rows = snapshot.between('bills', to_day(start), to_day(end))
+    paid = bills['status'][rows] == snapshot.code('bills', 'status', 'paid')
+    month = bills['month'][rows][paid]
+    if not len(month):
+        return {'total': 0.0, 'bills': 0, 'monthly': []}
+    first_month = int(month[0])
+    index = month - first_month
+    amounts = np.bincount(index, weights=bills['amount'][rows][paid])
+    counts = np.bincount(index)
+    return {
+        'total': round(float(amounts.sum()), 2),
+        'bills': int(counts.sum()),
+        'monthly': [{'month': month_label(first_month + i), 'amount': round(float(a), 2),
+                     'bills': int(n)} for i, (a, n) in enumerate(zip(amounts, counts)) if n]
+    }
@@ -0,0 +1,176 @@
+"""Thumbnails and web-size previews of stored lab files.
+
+Derivatives are JPEGs written next to the original blob as
+``<sha256>.<size>.jpg``, so they are shared by every record pointing at the
+same content and never go stale. Rendering happens in a per-worker process
+pool (Pillow is CPU-bound and holds the GIL): uploads schedule all sizes in
+the background. A request for a missing derivative queues it and gets a
+``202`` placeholder image at once, so no request thread waits on a render.
+
+A derivative is rendered at most once. Within a worker, concurrent requests
+share one future; across workers, the renderer takes an exclusive lock on
+``<target>.lock`` and skips the work if the file appeared meanwhile. The
+lock file is removed once the render is done; a renderer still waiting on
+the old inode finds the target there and returns.
+
+Images are opened with Pillow. For PDFs the first page is rasterised with
+``pdftoppm`` (poppler) when it is installed; otherwise the largest image
+embedded in the first page is used, which covers scanned documents.
+Files that cannot be previewed get no derivative.
+"""
+import fcntl
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from flask import Response, abort, current_app, send_file
+from app.utils.storage import blob_path
+
+IMAGE_TYPES = ('image/',)
+PDF_TYPE = 'application/pdf'
+PLACEHOLDER = ('<svg xmlns="http://www.w3.org/2000/svg" width="240" height="240">'
+               '<rect width="100%" height="100%" fill="#e9ecef"/></svg>')
+
+_pool = None
+_pool_lock = threading.Lock()
+_inflight = {}
+_failed = set()  # targets that could not be rendered, not retried by this worker
+
+
+def can_preview(stored):
+    return stored.content_type.startswith(IMAGE_TYPES) or stored.content_type == PDF_TYPE
+
+
+def derivative_path(sha256, size):
+    return f'{blob_path(sha256)}.{size}.jpg'
+
+
+def _first_page_image(source):
+    """Return the first page of a PDF as a PIL image, or None."""
+    from PIL import Image
+    if shutil.which('pdftoppm'):
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, 'page')
+            subprocess.run(['pdftoppm', '-f', '1', '-l', '1', '-r', '100', '-png',
+                            '-singlefile', source, prefix],
+                           check=True, capture_output=True, timeout=60)
+            with Image.open(prefix + '.png') as page:
+                return page.copy()
+    from PyPDF2 import PdfReader
+    reader = PdfReader(source)
+    if not reader.pages:
+        return None
+    images = reader.pages[0].images
+    if not images:
+        return None
+    largest = max(images, key=lambda image: len(image.data))
+    return Image.open(BytesIO(largest.data))
+
+
+def render_derivative(source, content_type, target, max_size, quality=80):
+    """Render ``source`` into ``target``; runs in the pool, without an app context.
+
+    Returns the target path, or None if the file cannot be previewed.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return _render_locked(source, content_type, target, max_size, quality)
+        finally:
+            try:
+                os.remove(target + '.lock')
+            except FileNotFoundError:
+                pass
+
+
+def _render_locked(source, content_type, target, max_size, quality):
+    from PIL import Image, ImageOps
+    if os.path.exists(target):
+        return target
+    if content_type == PDF_TYPE:
+        image = _first_page_image(source)
+    else:
+        image = Image.open(source)
+        # Decode at reduced scale where the format allows (JPEG)
+        image.draft('RGB', tuple(max_size))
+    if image is None:
+        return None
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    image.thumbnail(tuple(max_size), Image.LANCZOS)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.jpg')
+    with os.fdopen(fd, 'wb') as out:
+        image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, target)
+    return target
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a worker that runs the SSE notifier and DB
+            # connections is not safe
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def submit(stored, size):
+    """Schedule one derivative; returns a future, shared with concurrent callers."""
+    config = current_app.config
+    target = derivative_path(stored.sha256, size)
+    pool = _get_pool(config['PREVIEW_WORKERS'])
+    with _pool_lock:
+        future = _inflight.get(target)
+        if future is not None:
+            return future
+        future = pool.submit(render_derivative, blob_path(stored.sha256),
+                             stored.content_type, target,
+                             config['PREVIEW_SIZES'][size], config['PREVIEW_QUALITY'])
+        _inflight[target] = future
+    logger = current_app.logger
+    future.add_done_callback(lambda f: _forget(target, f, logger))
+    return future
+
+
+def _forget(target, future, logger):
+    error = future.exception()
+    if error is not None:
+        logger.warning(f'Preview {os.path.basename(target)} failed: {error}')
+    with _pool_lock:
+        _inflight.pop(target, None)
+        if error is not None or future.result() is None:
+            _failed.add(target)
+
+
+def schedule_previews(stored):
+    """Render every configured size in the background after an upload."""
+    if not can_preview(stored):
+        return
+    for size in current_app.config['PREVIEW_SIZES']:
+        if not os.path.exists(derivative_path(stored.sha256, size)):
+            submit(stored, size)
+
+
+def send_preview(stored, size):
+    """Serve a derivative, a 202 placeholder while it renders, or a 404."""
+    if stored is None or size not in current_app.config['PREVIEW_SIZES'] or not can_preview(stored):
+        abort(404)
+    path = derivative_path(stored.sha256, size)
+    if not os.path.exists(path):
+        if path in _failed:
+            abort(404)
+        submit(stored, size)
+        response = Response(PLACEHOLDER, status=202, mimetype='image/svg+xml')
+        response.headers['Retry-After'] = str(current_app.config['PREVIEW_RETRY_AFTER'])
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    response = send_file(path, mimetype='image/jpeg', conditional=True,
+                         etag=f'{stored.sha256}.{size}')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
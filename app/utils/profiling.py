@@ -0,0 +1,446 @@
+"""Opt-in request profiling, aggregated per endpoint.
+
+With ``PROFILE_ENABLED`` off (the default) ``init_app`` registers nothing,
+so requests pay nothing. With it on, a request is profiled when it carries
+an ``X-Profile-Token`` header issued to an admin (a short-lived signed
+token, checked without the database), or as one in ``PROFILE_SAMPLE_RATE``
+other requests; ``0`` profiles only requests with a token. A request that
+is not picked costs a counter increment and a header lookup.
+
+Two modes, ``PROFILE_MODE``:
+
+* ``sample`` (default): a per-worker thread snapshots the stacks of the
+  threads serving profiled requests every ``PROFILE_INTERVAL`` seconds.
+  Overhead is low and independent of how many functions run, and the
+  result is collapsed stacks ("a;b;c 12" lines) for flame graph tools.
+* ``cprofile``: the request runs under ``cProfile``, giving exact call
+  counts and times as pstats at a several-fold slowdown of that request.
+  One request per worker is profiled at a time.
+
+The sampler reads OS thread stacks, which never match the greenlets of a
+gevent or eventlet worker (the worker class ``events.py`` recommends for
+SSE). When ``threading`` is monkey-patched the profiler falls back to
+``cprofile`` and logs a warning; there a profile also counts the other
+greenlets that ran while the request was waiting.
+
+Only requests profiled through a token get an ``X-Profiled`` response
+header naming the endpoint; sampled requests are not told.
+
+Results are written behind by a flusher thread into hourly windows under
+``PROFILE_FOLDER``. Each window has an ``<endpoint>.requests`` log of
+timings, ``<endpoint>.collapsed`` appended by every worker, and a
+``<endpoint>.<pid>.pstats`` per worker. Windows older than
+``PROFILE_KEEP_HOURS`` are deleted. Readers merge a range of windows.
+"""
+import atexit
+import cProfile
+import hashlib
+import hmac
+import itertools
+import marshal
+import os
+import pstats
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+import jwt
+from flask import current_app, g, request
+
+TOKEN_HEADER = 'X-Profile-Token'
+ALGORITHM = 'HS256'
+WINDOW_FORMAT = '%Y%m%d%H'
+# Frames outside the view's dispatch are the same for every request
+DISPATCH_FRAME = 'full_dispatch_request'
+
+
+class InvalidProfileToken(Exception):
+    """The profile token is forged, malformed or expired."""
+
+
+def _key(config):
+    return hmac.new(config['SECRET_KEY'].encode(), b'request-profile',
+                    hashlib.sha256).hexdigest()
+
+
+def profile_token(user_id):
+    """A token that has requests profiled for ``PROFILE_TOKEN_MAX_AGE`` seconds."""
+    config = current_app.config
+    claims = {'sub': str(user_id), 'exp': int(time.time()) + config['PROFILE_TOKEN_MAX_AGE']}
+    return jwt.encode(claims, _key(config), algorithm=ALGORITHM)
+
+
+def verify_token(token, config):
+    try:
+        return jwt.decode(token, _key(config), algorithms=[ALGORITHM],
+                          options={'require': ['sub', 'exp']})
+    except jwt.InvalidTokenError:
+        raise InvalidProfileToken('Invalid or expired profile token.')
+
+
+def profile_folder(app=None):
+    app = app or current_app
+    return app.config['PROFILE_FOLDER'] or os.path.join(app.instance_path, 'profiles')
+
+
+def endpoint_file(endpoint):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint or 'unmatched')
+
+
+def _frame_label(code):
+    filename = code.co_filename
+    for prefix in sys.path:
+        if prefix and filename.startswith(prefix):
+            filename = filename[len(prefix):].lstrip(os.sep)
+            break
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(';', ',')
+
+
+def green_threads():
+    """Whether gevent or eventlet has monkey-patched ``threading``."""
+    if 'gevent.monkey' in sys.modules and sys.modules['gevent.monkey'].is_module_patched('threading'):
+        return True
+    patcher = sys.modules.get('eventlet.patcher')
+    return patcher is not None and patcher.is_monkey_patched('thread')
+
+
+class ProfiledRequest:
+    __slots__ = ('endpoint', 'via_token', 'started', 'thread', 'samples', 'profile')
+
+    def __init__(self, endpoint, thread, via_token=False):
+        self.endpoint = endpoint
+        self.via_token = via_token
+        self.started = time.perf_counter()
+        self.thread = thread
+        self.samples = Counter()  # stack tuple -> samples
+        self.profile = None
+
+
+class Profiler:
+    """Per-worker request profiler with a stack sampler and a background writer."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sampling = threading.Event()
+        self._active = {}  # thread id -> ProfiledRequest, sampled requests
+        self._cprofile_busy = threading.Lock()
+        self._counter = itertools.count(1)
+        self._pending = []  # finished ProfiledRequests with their status and path
+        self._labels = {}  # code object -> frame label
+        self._sampler = None
+        self._flusher = None
+        self._pruned = None
+        self._mode = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        for name, default in (('PROFILE_ENABLED', False), ('PROFILE_SAMPLE_RATE', 0),
+                              ('PROFILE_MODE', 'sample'), ('PROFILE_INTERVAL', 0.005),
+                              ('PROFILE_FOLDER', None), ('PROFILE_KEEP_HOURS', 48),
+                              ('PROFILE_TOKEN_MAX_AGE', 3600), ('PROFILE_FLUSH_INTERVAL', 5.0)):
+            app.config.setdefault(name, default)
+        if not app.config['PROFILE_ENABLED']:
+            return
+        self.app = app
+        app.extensions['profiler'] = self
+        app.before_request(self._start)
+        app.after_request(self._tag_response)
+        app.teardown_request(self._stop)
+        atexit.register(self.flush)
+        self.mode()
+
+    def mode(self):
+        """The effective ``PROFILE_MODE``, ``cprofile`` under green threads.
+
+        Resolved again on the first profiled request, as a gevent worker
+        may patch ``threading`` only after the app was created.
+        """
+        if self._mode is None or (self._mode == 'sample' and green_threads()):
+            mode = self.app.config['PROFILE_MODE']
+            if mode == 'sample' and green_threads():
+                self.app.logger.warning('Request profiling: threading is monkey-patched, '
+                                        'so the stack sampler cannot see requests; using cprofile.')
+                mode = 'cprofile'
+            self._mode = mode
+        return self._mode
+
+    # Request hooks
+
+    def _picked(self):
+        """``'token'``, ``'sample'`` or None when the request is not profiled."""
+        token = request.headers.get(TOKEN_HEADER)
+        if token:
+            try:
+                verify_token(token, self.app.config)
+                return 'token'
+            except InvalidProfileToken:
+                return None
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if rate > 0 and next(self._counter) % rate == 0:
+            return 'sample'
+        return None
+
+    def _start(self):
+        picked = self._picked()
+        if picked is None:
+            return
+        profiled = ProfiledRequest(request.endpoint, threading.get_ident(),
+                                   via_token=picked == 'token')
+        if self.mode() == 'cprofile':
+            if not self._cprofile_busy.acquire(blocking=False):
+                return
+            profiled.profile = cProfile.Profile()
+            profiled.profile.enable()
+        else:
+            with self._lock:
+                self._active[profiled.thread] = profiled
+            self._sampling.set()
+            self._ensure_thread('_sampler', self._run_sampler, 'request-profiler')
+        g._profiled_request = profiled
+
+    def _tag_response(self, response):
+        profiled = g.get('_profiled_request')
+        if profiled is not None:
+            if profiled.via_token:
+                response.headers['X-Profiled'] = profiled.endpoint or 'unmatched'
+            g._profiled_status = response.status_code
+        return response
+
+    def _stop(self, exc=None):
+        profiled = g.pop('_profiled_request', None)
+        if profiled is None:
+            return
+        duration = time.perf_counter() - profiled.started
+        if profiled.profile is not None:
+            profiled.profile.disable()
+            self._cprofile_busy.release()
+        else:
+            with self._lock:
+                self._active.pop(profiled.thread, None)
+                if not self._active:
+                    self._sampling.clear()
+        status = g.pop('_profiled_status', 500 if exc is not None else None)
+        with self._lock:
+            self._pending.append((profiled, datetime.utcnow(), duration, status,
+                                  request.method, request.path))
+        self._ensure_thread('_flusher', self._run_flusher, 'request-profile-flusher')
+
+    # Sampler
+
+    def _stack(self, frame):
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = _frame_label(code)
+            stack.append(label)
+            if code.co_name == DISPATCH_FRAME:
+                break
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def _run_sampler(self):
+        interval = self.app.config['PROFILE_INTERVAL']
+        while True:
+            self._sampling.wait()
+            time.sleep(interval)
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for profiled in active:
+                frame = frames.get(profiled.thread)
+                if frame is not None:
+                    profiled.samples[self._stack(frame)] += 1
+
+    # Writer
+
+    def flush(self):
+        """Write finished profiles to the current window; returns how many."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+            try:
+                self._write(pending)
+            except Exception as e:
+                self.app.logger.error(f'Profile flush failed: {str(e)}')
+                return 0
+            return len(pending)
+
+    def _write(self, pending):
+        folder = profile_folder(self.app)
+        window = datetime.utcnow().strftime(WINDOW_FORMAT)
+        directory = os.path.join(folder, window)
+        os.makedirs(directory, exist_ok=True)
+        by_endpoint = {}
+        for entry in pending:
+            by_endpoint.setdefault(endpoint_file(entry[0].endpoint), []).append(entry)
+        for name, entries in by_endpoint.items():
+            base = os.path.join(directory, name)
+            with open(f'{base}.requests', 'a') as f:
+                f.write(''.join(f'{when.isoformat()}\t{duration * 1000:.1f}\t{status}\t{method}\t{path}\n'
+                                for _, when, duration, status, method, path in entries))
+            samples = Counter()
+            for profiled, *_ in entries:
+                samples.update(profiled.samples)
+            if samples:
+                with open(f'{base}.collapsed', 'a') as f:
+                    f.write(''.join(f'{";".join(stack)} {count}\n' for stack, count in samples.items()))
+            profiles = [profiled.profile for profiled, *_ in entries if profiled.profile is not None]
+            if profiles:
+                path = f'{base}.{os.getpid()}.pstats'
+                stats = pstats.Stats(*profiles)
+                if os.path.exists(path):
+                    stats.add(path)
+                stats.dump_stats(f'{path}.tmp')
+                os.replace(f'{path}.tmp', path)
+        if self._pruned != window:
+            prune(folder, self.app.config['PROFILE_KEEP_HOURS'])
+            self._pruned = window
+
+    def _ensure_thread(self, attribute, target, name):
+        thread = getattr(self, attribute)
+        if thread is not None and thread.is_alive():
+            return
+        with self._lock:
+            thread = getattr(self, attribute)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            setattr(self, attribute, thread)
+            thread.start()
+
+    def _run_flusher(self):
+        while True:
+            self._wakeup.wait(self.app.config['PROFILE_FLUSH_INTERVAL'])
+            self._wakeup.clear()
+            self.flush()
+
+
+profiler = Profiler()
+
+
+# Reading
+
+def prune(folder, keep_hours):
+    """Delete windows older than ``keep_hours``; returns their names."""
+    oldest = (datetime.utcnow() - timedelta(hours=keep_hours)).strftime(WINDOW_FORMAT)
+    removed = [name for name in windows(folder) if name < oldest]
+    for name in removed:
+        shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+    return removed
+
+
+def windows(folder):
+    """Window directory names, oldest first."""
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder)
+                  if len(name) == 10 and name.isdigit())
+
+
+def _window_dirs(folder, hours):
+    since = (datetime.utcnow() - timedelta(hours=hours - 1)).strftime(WINDOW_FORMAT)
+    return [os.path.join(folder, name) for name in windows(folder) if name >= since]
+
+
+def endpoints(folder, hours):
+    """Per-endpoint request counts and timings over the last ``hours`` windows."""
+    durations = {}
+    for directory in _window_dirs(folder, hours):
+        for filename in os.listdir(directory):
+            if filename.endswith('.requests'):
+                with open(os.path.join(directory, filename)) as f:
+                    durations.setdefault(filename[:-len('.requests')], []).extend(
+                        float(line.split('\t')[1]) for line in f if line.strip())
+    summary = []
+    for name, values in durations.items():
+        values.sort()
+        summary.append({'endpoint': name,
+                        'requests': len(values),
+                        'mean_ms': round(sum(values) / len(values), 1),
+                        'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))],
+                        'max_ms': values[-1]})
+    summary.sort(key=lambda row: -row['mean_ms'] * row['requests'])
+    return summary
+
+
+def requests_log(folder, endpoint, hours, limit=50):
+    """The slowest profiled requests of an endpoint."""
+    rows = []
+    for directory in _window_dirs(folder, hours):
+        path = os.path.join(directory, f'{endpoint_file(endpoint)}.requests')
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    when, duration, status, method, path_ = line.rstrip('\n').split('\t', 4)
+                    rows.append({'time': when, 'duration_ms': float(duration), 'status': status,
+                                 'method': method, 'path': path_})
+    rows.sort(key=lambda row: -row['duration_ms'])
+    return rows[:limit]
+
+
+def collapsed(folder, endpoint, hours):
+    """Merged collapsed stacks of an endpoint: {stack: samples}."""
+    stacks = Counter()
+    for directory in _window_dirs(folder, hours):
+        path = os.path.join(directory, f'{endpoint_file(endpoint)}.collapsed')
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    if stack:
+                        stacks[stack] += int(count)
+    return stacks
+
+
+def hot_functions(stacks, limit=30):
+    """Functions by samples on top of the stack (self) and anywhere on it (total)."""
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    samples = sum(stacks.values()) or 1
+    return [{'function': frame, 'self': own[frame], 'total': count,
+             'self_pct': round(100 * own[frame] / samples, 1),
+             'total_pct': round(100 * count / samples, 1)}
+            for frame, count in sorted(total.items(), key=lambda item: (-own[item[0]], -item[1]))[:limit]]
+
+
+def merged_stats(folder, endpoint, hours):
+    """pstats.Stats of an endpoint over the windows, or None."""
+    paths = [os.path.join(directory, filename)
+             for directory in _window_dirs(folder, hours)
+             for filename in os.listdir(directory)
+             if filename.startswith(f'{endpoint_file(endpoint)}.') and filename.endswith('.pstats')
+             and filename.count('.') == endpoint_file(endpoint).count('.') + 2]
+    return pstats.Stats(*paths) if paths else None
+
+
+def top_calls(stats, limit=30):
+    """The functions of a pstats.Stats by cumulative time."""
+    rows = [{'function': f'{name} ({os.path.basename(filename)}:{line})',
+             'calls': calls, 'own_ms': round(own * 1000, 2), 'total_ms': round(total * 1000, 2)}
+            for (filename, line, name), (_, calls, own, total, _) in stats.stats.items()]
+    rows.sort(key=lambda row: -row['total_ms'])
+    return rows[:limit]
+
+
+def dump_stats(stats):
+    """A pstats.Stats in the format pstats and snakeviz load."""
+    return marshal.dumps(stats.stats)
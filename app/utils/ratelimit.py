@@ -0,0 +1,155 @@
+"""Host-wide token-bucket rate limiting.
+
+Buckets live in a memory-mapped file (``RATELIMIT_STORAGE``) shared by
+every worker process on the host, so a client cannot multiply its
+allowance by landing on different workers. The file is a fixed table of
+``RATELIMIT_SLOTS`` slots, each holding a 64-bit key hash, the token count,
+the last refill time and the time the bucket will be full again. A key hashes to a home slot and probes at most
+``PROBE`` slots after it. A POSIX record lock on that byte range
+serialises processes and a ``threading.Lock`` serialises threads, so a
+check costs two ``fcntl`` calls and a few struct reads and writes. It
+never touches the database.
+
+A slot whose bucket has had time to refill completely holds no state
+worth keeping, so it is reused when the probe window is full; failing
+that, the bucket nearest to refilling is evicted. Each slot
+records when that happens at its own rate, and the rate is part of the
+key, so limits of different rates never judge or share each other's
+buckets.
+
+The client is ``request.remote_addr``. Behind a reverse proxy set
+``PROXY_FIX_X_FOR`` so it is the address the proxy saw, not the proxy's.
+``field`` adds a submitted form value to the key, so a login limit can be
+per address and account without one address's typos locking out everyone
+behind the same NAT.
+
+    @bp.route('/login', methods=['GET', 'POST'])
+    @rate_limit('10/minute', per='ip', methods=('POST',), field='email')
+    def login(): ...
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+SLOT = struct.Struct('=Qddd')  # key hash, tokens, updated, full at (epoch seconds)
+PROBE = 8
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate(rate):
+    """'10/minute' -> (10, 60)."""
+    count, _, period = rate.partition('/')
+    return int(count), PERIODS[period.strip().rstrip('s')]
+
+
+class BucketStore:
+    """Token buckets in a shared memory-mapped file."""
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        size = (self.slots + PROBE) * SLOT.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def take(self, key, capacity, period, cost=1.0, now=None):
+        """Take ``cost`` tokens; returns 0 if allowed, else seconds until it would be."""
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        home = digest % self.slots
+        rate = capacity / period
+        with self._lock:
+            if self._pid != os.getpid():
+                # Mappings and record locks are not shared with a forked parent
+                self._open()
+            start, length = home * SLOT.size, PROBE * SLOT.size
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                now = now or time.time()
+                offset = reusable = None
+                for i in range(PROBE):
+                    position = start + i * SLOT.size
+                    slot_key, tokens, updated, full_at = SLOT.unpack_from(self._map, position)
+                    if slot_key == digest:
+                        offset = position
+                        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+                        break
+                    if slot_key == 0:
+                        full_at = 0.0
+                    if reusable is None or full_at < reusable[0]:
+                        reusable = (full_at, position)
+                if offset is None:
+                    # New key, or its bucket was evicted after refilling. With
+                    # no refilled slot left, evict the one closest to refilling.
+                    offset = reusable[1]
+                    tokens = float(capacity)
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                SLOT.pack_into(self._map, offset, digest, tokens, now,
+                               now + (capacity - tokens) / rate)
+                return 0.0 if allowed else (cost - tokens) / rate
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+
+def _client_key(per, field=None):
+    if per == 'user' and current_user.is_authenticated:
+        key = f'user:{current_user.id}'
+    else:
+        key = f'ip:{request.remote_addr}'
+    if field is not None:
+        key += f'|{field}:{request.form.get(field, "").strip().lower()}'
+    return key
+
+
+def rate_limit(rate, per='ip', methods=None, cost=1.0, field=None):
+    """Limit a view to ``rate`` (e.g. '10/minute') per client and endpoint.
+
+    ``per`` is 'ip' or 'user' (anonymous users fall back to their IP).
+    ``field`` also keys on that submitted form field, e.g. the login email.
+    ``methods`` restricts the limit to those HTTP methods. Over the limit
+    the view is not called and the client gets 429 with Retry-After.
+    Limits of different rates on one view keep separate buckets.
+    """
+    capacity, period = parse_rate(rate)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            store = current_app.extensions.get('rate_limit')
+            if store is not None and (methods is None or request.method in methods):
+                key = f'{request.endpoint}|{rate}|{_client_key(per, field)}'
+                wait = store.take(key, capacity, period, cost)
+                if wait:
+                    raise TooManyRequests(retry_after=math.ceil(wait))
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def init_app(app):
+    if not app.config.get('RATELIMIT_ENABLED', True):
+        return
+    path = app.config.get('RATELIMIT_STORAGE') or \
+        os.path.join(app.instance_path, 'ratelimit.bin')
+    app.extensions['rate_limit'] = BucketStore(path, app.config.get('RATELIMIT_SLOTS', 65536))
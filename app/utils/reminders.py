@@ -0,0 +1,129 @@
+"""Appointment reminders, sent by ``flask reminders send`` from cron.
+
+Each run picks up ``scheduled`` appointments starting tomorrow (a "day"
+reminder) or within the next hour (an "hour" reminder). A single range
+scan over ``ix_appointment_status_date`` covers both windows, and the
+patient and doctor fields come from the same query, so there is no
+per-appointment lookup. Reminders already in ``reminder_log`` are
+anti-joined away, so re-running the job sends nothing twice. The log is
+keyed on the appointment date as well, so a rescheduled visit is reminded
+again.
+
+Messages are rendered from one compiled template and sent over a single
+SMTP connection. Each batch is claimed before it is sent: its log rows are
+inserted and committed first, and the unique ``ix_reminder_log_sent``
+index makes an overlapping run skip the reminders another run claimed.
+A send that fails has its claim deleted, so the next run retries it; a run
+that dies between claiming and sending loses those reminders rather than
+sending them twice.
+"""
+from datetime import datetime, time, timedelta
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from app import db, mail
+from app.models import Appointment, Patient, User, ReminderLog
+
+TEMPLATE = 'email/appointment_reminder.txt'
+SUBJECTS = {
+    'day': 'Appointment Reminder: Tomorrow',
+    'hour': 'Appointment Reminder: Within the Hour',
+}
+
+
+def due_reminders(now=None):
+    """Select unsent reminders as (id, date, kind, patient, email, doctor) rows."""
+    now = now or datetime.now()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), time.min)
+    day_after = tomorrow + timedelta(days=1)
+    next_hour = now + timedelta(hours=1)
+    kind = db.case((Appointment.appointment_date < next_hour, 'hour'), else_='day')
+    return select(
+        Appointment.id,
+        Appointment.appointment_date,
+        kind.label('kind'),
+        Patient.first_name.label('patient_first_name'),
+        Patient.email,
+        User.first_name.label('doctor_first_name'),
+        User.last_name.label('doctor_last_name')
+    ).join(Patient, Patient.id == Appointment.patient_id)\
+     .join(User, User.id == Appointment.doctor_id)\
+     .where(
+        Appointment.status == 'scheduled',
+        Appointment.appointment_date >= now,
+        Appointment.appointment_date < day_after,
+        db.or_(Appointment.appointment_date < next_hour,
+               Appointment.appointment_date >= tomorrow),
+        Patient.email.isnot(None),
+        Patient.email != '',
+        ~select(ReminderLog.id).where(
+            ReminderLog.appointment_id == Appointment.id,
+            ReminderLog.kind == kind,
+            ReminderLog.appointment_date == Appointment.appointment_date
+        ).exists()
+    ).order_by(Appointment.appointment_date)
+
+
+def _build_message(template, row, sender):
+    msg = Message(SUBJECTS[row.kind], sender=sender, recipients=[row.email])
+    msg.body = template.render(
+        patient_first_name=row.patient_first_name,
+        doctor_name=f'{row.doctor_first_name} {row.doctor_last_name}',
+        appointment_date=row.appointment_date,
+        kind=row.kind
+    )
+    return msg
+
+
+def _key(row):
+    return (row.id, row.kind, row.appointment_date)
+
+
+def _claim(rows):
+    """Log ``rows`` as sent and return those no other run had claimed."""
+    while rows:
+        try:
+            db.session.execute(insert(ReminderLog), [
+                {'appointment_id': row.id, 'kind': row.kind, 'appointment_date': row.appointment_date}
+                for row in rows])
+            db.session.commit()
+            return rows
+        except IntegrityError:
+            db.session.rollback()
+            claimed = set(db.session.execute(select(
+                ReminderLog.appointment_id, ReminderLog.kind, ReminderLog.appointment_date
+            ).where(tuple_(ReminderLog.appointment_id, ReminderLog.kind, ReminderLog.appointment_date)
+                    .in_([_key(row) for row in rows]))).all())
+            rows = [row for row in rows if _key(row) not in claimed]
+    return rows
+
+
+def send_reminders(now=None, batch_size=None, dry_run=False):
+    """Send every due reminder; returns (sent, failed) counts."""
+    config = current_app.config
+    batch_size = batch_size or config['REMINDER_BATCH_SIZE']
+    template = current_app.jinja_env.get_template(TEMPLATE)
+    rows = db.session.execute(due_reminders(now)).all()
+    if dry_run:
+        return len(rows), 0
+
+    sent = failed = 0
+    with mail.connect() as connection:
+        for start in range(0, len(rows), batch_size):
+            undelivered = []
+            for row in _claim(rows[start:start + batch_size]):
+                try:
+                    connection.send(_build_message(template, row, config['MAIL_DEFAULT_SENDER']))
+                    sent += 1
+                except Exception as e:
+                    current_app.logger.error(f'Reminder for appointment {row.id} failed: {e}')
+                    undelivered.append(_key(row))
+            if undelivered:
+                # Unclaimed, so the next run retries them
+                ReminderLog.query.filter(
+                    tuple_(ReminderLog.appointment_id, ReminderLog.kind, ReminderLog.appointment_date)
+                    .in_(undelivered)).delete(synchronize_session=False)
+                db.session.commit()
+                failed += len(undelivered)
+    return sent, failed
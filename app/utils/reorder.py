@@ -0,0 +1,161 @@
+"""Consumption-based medication reorder suggestions.
+
+``flask reorder run`` (nightly, from cron) reads the units dispensed per
+medication per day for the last ``REORDER_AVERAGE_DAYS`` days in one
+grouped query, into a medications x days matrix, then works out every
+medication at once:
+
+* demand, the mean daily units over the last ``REORDER_AVERAGE_DAYS`` days,
+  or over the last ``REORDER_RECENT_DAYS`` when that is higher, so a surge
+  is not averaged away;
+* safety stock, ``REORDER_SERVICE_FACTOR`` standard deviations of daily
+  demand over the lead time;
+* days of cover, stock divided by demand.
+
+A medication is due for ordering when its stock will fall below the safety
+stock before an order placed today arrives, i.e. below demand over the
+medication's ``lead_time_days`` (``REORDER_LEAD_TIME_DAYS`` when unset) plus
+the safety stock. The suggested quantity tops it up to cover the lead time
+and the ``REORDER_REVIEW_DAYS`` until the next order. The purchase order is
+written to ``REORDER_FILE`` and served from there until the next run.
+"""
+import json
+import os
+import threading
+from datetime import date, datetime, timedelta
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+from app import db
+from app.models import (Medication, Prescription, PrescriptionMedication, ArchivedPrescription,
+                        ArchivedPrescriptionMedication)
+
+DISPENSING_TABLES = ((Prescription, PrescriptionMedication),
+                     (ArchivedPrescription, ArchivedPrescriptionMedication))
+
+
+def daily_dispensed(medication_ids, start, end):
+    """Units dispensed per medication per day in [start, end) as a matrix.
+
+    ``medication_ids`` must be sorted.
+    """
+    usage = np.zeros((len(medication_ids), (end - start).days))
+    for prescription, line in DISPENSING_TABLES:
+        day = db.func.date(prescription.dispensed_at)
+        query = select(line.medication_id, day, db.func.sum(line.quantity))\
+            .join(prescription, prescription.id == line.prescription_id)\
+            .where(prescription.status == 'dispensed',
+                   prescription.dispensed_at >= start,
+                   prescription.dispensed_at < end)\
+            .group_by(line.medication_id, day)
+        # Up to one row per medication per day: plain tuples, no ORM rows
+        rows = db.session.connection().execute(query).fetchall()
+        if not rows:
+            continue
+        ids, days, units = zip(*rows)
+        ids = np.array(ids)
+        at = np.searchsorted(medication_ids, ids).clip(max=max(len(medication_ids) - 1, 0))
+        known = medication_ids[at] == ids if len(medication_ids) else np.zeros(len(ids), bool)
+        # Parse each distinct day once
+        labels, day_index = np.unique(np.array(days, dtype=str), return_inverse=True)
+        offsets = np.array([(date.fromisoformat(label[:10]) - start).days for label in labels])
+        np.add.at(usage, (at[known], offsets[day_index][known]), np.array(units, dtype=float)[known])
+    return usage
+
+
+def plan(usage, stock, lead_time, recent_days, review_days, service_factor):
+    """Demand, cover and suggested order quantities for every row of a usage matrix."""
+    demand = np.maximum(usage.mean(axis=1), usage[:, -recent_days:].mean(axis=1))
+    safety = service_factor * usage.std(axis=1) * np.sqrt(lead_time)
+    cover = np.divide(stock, demand, out=np.full(len(stock), np.inf), where=demand > 0)
+    reorder_point = demand * lead_time + safety
+    order = np.ceil(np.maximum(reorder_point + demand * review_days - stock, 0))
+    order[stock >= reorder_point] = 0
+    return {'demand': demand, 'safety': safety, 'cover': cover,
+            'reorder_point': reorder_point, 'order': order}
+
+
+def run_reorder(today=None):
+    """Plan every medication's reorder; returns the purchase order."""
+    config = current_app.config
+    today = today or date.today()
+    start = today - timedelta(days=config['REORDER_AVERAGE_DAYS'])
+    medications = db.session.query(Medication.id, Medication.name, Medication.unit,
+                                   Medication.price, Medication.quantity_in_stock,
+                                   Medication.lead_time_days)\
+        .order_by(Medication.id).all()
+    ids = np.array([row.id for row in medications], dtype=np.int64)
+    stock = np.array([max(row.quantity_in_stock or 0, 0) for row in medications], dtype=float)
+    lead_time = np.array([row.lead_time_days or config['REORDER_LEAD_TIME_DAYS']
+                          for row in medications], dtype=float)
+    usage = daily_dispensed(ids, start, today)
+    result = plan(usage, stock, lead_time, config['REORDER_RECENT_DAYS'],
+                  config['REORDER_REVIEW_DAYS'], config['REORDER_SERVICE_FACTOR'])
+    due = np.flatnonzero(result['order'] > 0)
+    due = due[np.argsort(result['cover'][due], kind='stable')]
+    lines = [{'medication_id': int(ids[i]),
+              'name': medications[i].name,
+              'unit': medications[i].unit,
+              'stock': int(stock[i]),
+              'daily_demand': round(float(result['demand'][i]), 2),
+              'days_of_cover': round(float(result['cover'][i]), 1),
+              'runs_out': (today + timedelta(days=int(result['cover'][i]))).isoformat(),
+              'lead_time_days': int(lead_time[i]),
+              'reorder_point': int(np.ceil(result['reorder_point'][i])),
+              'order_quantity': int(result['order'][i]),
+              'estimated_cost': round(float(result['order'][i] * (medications[i].price or 0)), 2)}
+             for i in due]
+    return {
+        'generated_at': datetime.utcnow().isoformat(),
+        'history_start': start.isoformat(),
+        'start': today.isoformat(),
+        'medications': len(medications),
+        'with_demand': int((result['demand'] > 0).sum()),
+        # Will be out of stock before an order placed today can arrive
+        'stockouts_before_delivery': int((result['cover'] < lead_time).sum()),
+        'total_cost': round(sum(line['estimated_cost'] for line in lines), 2),
+        'lines': lines
+    }
+
+
+def reorder_file():
+    return current_app.config['REORDER_FILE'] or \
+        os.path.join(current_app.instance_path, 'reorder.json')
+
+
+def save_reorder(result):
+    path = reorder_file()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}'
+    with open(temporary, 'w') as f:
+        json.dump(result, f)
+    os.replace(temporary, path)
+
+
+_lock = threading.Lock()
+_cached = {}
+
+
+def empty_reorder():
+    """Stands in for the purchase order until ``flask reorder run`` has written one."""
+    return {'generated_at': None, 'history_start': None, 'start': None, 'medications': 0,
+            'with_demand': 0, 'stockouts_before_delivery': 0, 'total_cost': 0, 'lines': []}
+
+
+def load_reorder():
+    """The last saved purchase order, read once per run.
+
+    Before the first ``flask reorder run`` this is ``empty_reorder()``;
+    the full run is too slow to do inside a request.
+    """
+    path = reorder_file()
+    with _lock:
+        try:
+            stamp = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return empty_reorder()
+        cached = _cached.get(path)
+        if cached is None or cached[0] != stamp:
+            with open(path) as f:
+                cached = _cached[path] = (stamp, json.load(f))
+        return cached[1]
@@ -0,0 +1,306 @@
+"""Columnar analytics snapshot of patients, appointments and bills.
+
+``flask analytics snapshot`` exports the facts the population reports need
+into one ``.npy`` file per column under ``ANALYTICS_SNAPSHOT_FOLDER``:
+
+* dates are int64 days since 1970-01-01 (NaT, -2**63, for missing ones);
+* categories (gender, blood group, status, doctor) are int16 codes into
+  dictionaries kept in the manifest. Codes are only ever appended, so they
+  stay stable across refreshes;
+* patients are sorted by id; appointments and bills by date, so a date
+  range is a slice found by binary search. Both include archived rows;
+* derived arrays (month numbers, each patient's first-visit month) are
+  computed here rather than on every report.
+
+Each run writes a new generation directory and then swaps
+``manifest.json`` to point at it, so readers never see a half-written
+snapshot. A refresh reads only rows whose ``updated_at`` moved past the
+last watermark, patches them in place or appends them, and hard-links the
+columns of tables that did not change. ``--full`` rebuilds from scratch,
+which also drops deleted rows.
+
+Readers use ``open_snapshot()``, which memory-maps the current generation
+and reopens it when the manifest changes; no query touches the database.
+"""
+import json
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from flask import current_app
+from sqlalchemy import select, union_all
+from app import db
+from app.models import (Patient, Appointment, Bill, User, ArchivedAppointment, ArchivedBill)
+
+MANIFEST = 'manifest.json'
+CHUNK_ROWS = 100000
+WATERMARK_OVERLAP = 60  # seconds
+KEEP_GENERATIONS = 2
+NO_VISIT = np.iinfo(np.int32).max
+
+
+class Table:
+    """A snapshot table: (column, source attribute, kind) with kind in
+    'int32', 'float64', 'days' or 'category'. Tables with ``sort_by`` are
+    kept in (sort_by, id) order so a date range is a contiguous slice."""
+
+    def __init__(self, name, model, columns, archive=None, sort_by=None):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.archive = archive
+        self.sort_by = sort_by
+
+    def query(self, model, since=None):
+        query = select(*[getattr(model, attribute) for _, attribute, _ in self.columns])
+        if since is not None:
+            query = query.where(model.updated_at >= since)
+        return query
+
+    def full_query(self):
+        if self.archive is None:
+            return self.query(self.model)
+        return union_all(self.query(self.model), self.query(self.archive))
+
+
+TABLES = [
+    Table('patients', Patient, [('id', 'id', 'int32'),
+                                ('birth', 'date_of_birth', 'days'),
+                                ('gender', 'gender', 'category'),
+                                ('blood_group', 'blood_group', 'category'),
+                                ('registered', 'created_at', 'days')]),
+    Table('appointments', Appointment, [('id', 'id', 'int32'),
+                                        ('patient_id', 'patient_id', 'int32'),
+                                        ('doctor', 'doctor_id', 'category'),
+                                        ('day', 'appointment_date', 'days'),
+                                        ('status', 'status', 'category')],
+          archive=ArchivedAppointment, sort_by='day'),
+    Table('bills', Bill, [('id', 'id', 'int32'),
+                          ('patient_id', 'patient_id', 'int32'),
+                          ('day', 'bill_date', 'days'),
+                          ('amount', 'total_amount', 'float64'),
+                          ('status', 'payment_status', 'category')],
+          archive=ArchivedBill, sort_by='day'),
+]
+
+
+def to_days(values):
+    return np.array(values, dtype='datetime64[D]').astype(np.int64)
+
+
+def to_months(days):
+    """Days since the epoch -> months since January 1970."""
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int32)
+
+
+class Dictionary:
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def _add(self, value):
+        self.codes[value] = len(self.values)
+        self.values.append(value)
+        return self.codes[value]
+
+    def encode(self, values):
+        codes = self.codes
+        return np.fromiter((codes[value] if value in codes else self._add(value)
+                            for value in values), dtype=np.int16, count=len(values))
+
+
+def _convert(table, rows, dictionaries):
+    """Turn a list of result rows into {column: array}."""
+    values = list(zip(*rows)) if rows else [()] * len(table.columns)
+    arrays = {}
+    for (column, _, kind), column_values in zip(table.columns, values):
+        if kind == 'days':
+            arrays[column] = to_days(column_values)
+        elif kind == 'category':
+            dictionary = dictionaries.setdefault(f'{table.name}.{column}', Dictionary())
+            arrays[column] = dictionary.encode(column_values)
+        else:
+            arrays[column] = np.array(column_values, dtype=kind)
+    return arrays
+
+
+def _ordered(table, arrays):
+    if table.sort_by:
+        order = np.lexsort((arrays['id'], arrays[table.sort_by]))
+    else:
+        order = np.argsort(arrays['id'], kind='stable')
+    return {column: array[order] for column, array in arrays.items()}
+
+
+def _fetch(table, query, dictionaries):
+    chunks = []
+    result = db.session.execute(query.execution_options(yield_per=CHUNK_ROWS))
+    for rows in result.partitions():
+        chunks.append(_convert(table, rows, dictionaries))
+    if not chunks:
+        return _convert(table, [], dictionaries)
+    return _ordered(table, {column: np.concatenate([chunk[column] for chunk in chunks])
+                            for column, _, _ in table.columns})
+
+
+def _merge(table, arrays, changes):
+    """Patch rows whose id exists and append the rest."""
+    ids, new_ids = arrays['id'], changes['id']
+    by_id = np.argsort(ids, kind='stable') if table.sort_by else np.arange(len(ids))
+    sorted_ids = ids[by_id]
+    position = np.searchsorted(sorted_ids, new_ids)
+    found = position < len(ids)
+    found[found] = sorted_ids[position[found]] == new_ids[found]
+    rows = by_id[position[found]]
+    merged = {}
+    for column, _, _ in table.columns:
+        array = np.array(arrays[column])  # writable copy of the mapped column
+        array[rows] = changes[column][found]
+        merged[column] = np.concatenate([array, changes[column][~found]])
+    return _ordered(table, merged)
+
+
+def _derive(table, arrays, dictionaries):
+    """Extra arrays the reports would otherwise recompute on every call."""
+    if 'day' not in arrays:
+        return {}
+    derived = {'month': to_months(arrays['day'])}
+    if table.name == 'appointments':
+        # Month of each patient's first appointment that was not cancelled,
+        # indexed by patient id
+        statuses = dictionaries.get('appointments.status', Dictionary()).codes
+        kept = arrays['status'] != statuses.get('cancelled', -1)
+        first = np.full(int(arrays['patient_id'].max(initial=0)) + 1, NO_VISIT, dtype=np.int32)
+        np.minimum.at(first, arrays['patient_id'][kept], derived['month'][kept])
+        derived['first_visit'] = first
+    return derived
+
+
+def snapshot_folder():
+    return current_app.config['ANALYTICS_SNAPSHOT_FOLDER'] or \
+        os.path.join(current_app.instance_path, 'analytics')
+
+
+def read_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def build_snapshot(full=False):
+    """Build or refresh the snapshot; returns the new manifest."""
+    folder = snapshot_folder()
+    previous = None if full else read_manifest(folder)
+    started = datetime.utcnow()
+    dictionaries = {name: Dictionary(values)
+                    for name, values in (previous or {}).get('dictionaries', {}).items()}
+    generation = f'g{started:%Y%m%d%H%M%S%f}'
+    target = os.path.join(folder, generation)
+    os.makedirs(target)
+    tables = {}
+    for table in TABLES:
+        os.makedirs(os.path.join(target, table.name))
+        state = previous and previous['tables'].get(table.name)
+        if state is None:
+            arrays = _fetch(table, table.full_query(), dictionaries)
+            changed = len(arrays['id'])
+        else:
+            since = datetime.fromisoformat(state['watermark'])
+            changes = _fetch(table, table.query(table.model, since), dictionaries)
+            changed = len(changes['id'])
+            source = os.path.join(folder, previous['generation'], table.name)
+            if changed:
+                arrays = _merge(table, {column: np.load(os.path.join(source, f'{column}.npy'),
+                                                        mmap_mode='r')
+                                        for column, _, _ in table.columns}, changes)
+            else:
+                # Unchanged: share the previous generation's files
+                for name in os.listdir(source):
+                    os.link(os.path.join(source, name), os.path.join(target, table.name, name))
+                tables[table.name] = dict(state, changed=0, watermark=_watermark(started))
+                continue
+        arrays.update(_derive(table, arrays, dictionaries))
+        for column, array in arrays.items():
+            np.save(os.path.join(target, table.name, f'{column}.npy'), array)
+        tables[table.name] = {'rows': int(len(arrays['id'])), 'changed': int(changed),
+                              'watermark': _watermark(started)}
+    doctors = {str(id): f'Dr. {first_name or ""} {last_name or ""}'.strip()
+               for id, first_name, last_name in db.session.execute(
+                   select(User.id, User.first_name, User.last_name).where(User.role == 'doctor'))}
+    manifest = {'generation': generation, 'built_at': started.isoformat(), 'tables': tables,
+                'dictionaries': {name: d.values for name, d in dictionaries.items()},
+                'doctors': doctors}
+    temporary = os.path.join(folder, f'{MANIFEST}.{os.getpid()}')
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temporary, os.path.join(folder, MANIFEST))
+    _remove_old_generations(folder, generation)
+    return manifest
+
+
+def _watermark(started):
+    # Overlap so rows committed while we were reading are picked up next time
+    return (started - timedelta(seconds=WATERMARK_OVERLAP)).isoformat()
+
+
+def _remove_old_generations(folder, current):
+    generations = sorted(name for name in os.listdir(folder)
+                         if name.startswith('g') and os.path.isdir(os.path.join(folder, name)))
+    for name in generations[:-KEEP_GENERATIONS]:
+        if name != current:
+            # Readers that still map these files keep them until they reopen
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+
+
+class Snapshot:
+    """Memory-mapped columns of one snapshot generation."""
+
+    def __init__(self, folder, manifest):
+        self.manifest = manifest
+        self.built_at = datetime.fromisoformat(manifest['built_at'])
+        self.dictionaries = manifest['dictionaries']
+        self.doctors = manifest['doctors']
+        root = os.path.join(folder, manifest['generation'])
+        self.tables = {}
+        for table in TABLES:
+            folder = os.path.join(root, table.name)
+            self.tables[table.name] = {
+                name[:-len('.npy')]: np.load(os.path.join(folder, name), mmap_mode='r')
+                for name in os.listdir(folder) if name.endswith('.npy')
+            }
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def labels(self, table, column):
+        return self.dictionaries.get(f'{table}.{column}', [])
+
+    def code(self, table, column, value):
+        labels = self.labels(table, column)
+        return labels.index(value) if value in labels else -1
+
+    def between(self, table, start_day, end_day):
+        """The slice of a date-sorted table with start_day <= day < end_day."""
+        day = self.tables[table]['day']
+        return slice(int(np.searchsorted(day, start_day)), int(np.searchsorted(day, end_day)))
+
+
+_lock = threading.Lock()
+_current = {}
+
+
+def open_snapshot():
+    """The current snapshot, or None if none has been built."""
+    folder = snapshot_folder()
+    try:
+        stamp = os.stat(os.path.join(folder, MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _lock:
+        cached = _current.get(folder)
+        if cached is None or cached[0] != stamp:
+            cached = _current[folder] = (stamp, Snapshot(folder, read_manifest(folder)))
+        return cached[1]
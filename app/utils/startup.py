@@ -0,0 +1,70 @@
+"""Startup-time budget for the app factory.
+
+``tests/test_startup.py`` enforces the budget with the test suite; run
+``python -m app.utils.startup`` from the project root to see where the time
+goes. It boots ``create_app()`` in fresh
+interpreters under ``-X importtime``, prints the slowest imports, and exits
+non-zero when the best run exceeds ``STARTUP_BUDGET_MS`` or when a module
+that must load lazily shows up at startup.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Heavy optional dependencies that must only be imported on first use
+LAZY_MODULES = ('reportlab', 'openpyxl', 'qrcode', 'PIL', 'numpy')
+
+BOOT = ('import time; t = time.perf_counter(); '
+        'from app import create_app; create_app(); '
+        'print((time.perf_counter() - t) * 1000)')
+
+
+def measure(python=sys.executable, cwd=None):
+    """Boot the app once; returns (wall ms, {module: cumulative import us})."""
+    result = subprocess.run([python, '-X', 'importtime', '-c', BOOT],
+                            capture_output=True, text=True, cwd=cwd, check=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace('import time:', '|').split('|')]
+        imports[name] = int(cumulative_us)
+    return float(result.stdout.strip().splitlines()[-1]), imports
+
+
+def check(budget_ms, runs=3, cwd=None):
+    """Return a list of budget violations; empty means the budget holds."""
+    best_ms, imports = min((measure(cwd=cwd) for _ in range(runs)), key=lambda run: run[0])
+    print(f'create_app() import + construction: {best_ms:.0f} ms (budget {budget_ms} ms)')
+    top_level = sorted(((us, name) for name, us in imports.items() if '.' not in name), reverse=True)
+    for us, name in top_level[:10]:
+        print(f'  {us / 1000:8.1f} ms  {name}')
+
+    problems = []
+    if best_ms > budget_ms:
+        problems.append(f'startup took {best_ms:.0f} ms, over the {budget_ms} ms budget')
+    for name in LAZY_MODULES:
+        if name in imports:
+            problems.append(f'{name} is imported at startup; import it where it is used')
+    return problems
+
+
+def main(argv=None):
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.insert(0, root)
+    from config import Config
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=int, default=Config.STARTUP_BUDGET_MS)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    problems = check(args.budget_ms, args.runs, cwd=root)
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
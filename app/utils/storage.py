@@ -0,0 +1,132 @@
+"""Content-addressed file storage for lab reports, scans and invoices.
+
+Uploads are streamed to a temporary file in fixed-size chunks while being
+hashed, then moved to ``<root>/<aa>/<bb>/<sha256>``. Identical files end up
+at the same path, so each blob is stored once no matter how often it is
+uploaded. The two-level sharding keeps directories small.
+
+Downloads go through ``send_stored_file``: the SHA-256 is a strong ETag, so
+``If-None-Match`` and ``Range`` requests are answered by Werkzeug without
+rereading the file. With ``USE_X_SENDFILE`` or
+``BLOB_ACCEL_REDIRECT_PREFIX`` set, the front-end server sends the bytes
+and Python only writes headers.
+
+The content type is sniffed from the file's first bytes, never taken from
+the client. Only the formats in ``SIGNATURES`` are served inline; anything
+else, including HTML and SVG, is an ``application/octet-stream`` download,
+and every response carries ``X-Content-Type-Options: nosniff``.
+"""
+import hashlib
+import os
+import tempfile
+from flask import current_app, send_file, make_response
+from app import db
+from app.models import StoredFile
+
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes -> content type of the formats served inline
+SIGNATURES = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+INLINE_TYPES = frozenset(content_type for _, content_type in SIGNATURES)
+DOWNLOAD_TYPE = 'application/octet-stream'
+
+
+def sniff_content_type(head):
+    """The content type of a file from its first bytes, or DOWNLOAD_TYPE."""
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return DOWNLOAD_TYPE
+
+
+def blob_root():
+    return current_app.config['BLOB_STORE_FOLDER']
+
+
+def blob_path(sha256):
+    return os.path.join(blob_root(), sha256[:2], sha256[2:4], sha256)
+
+
+def relative_blob_path(sha256):
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+def save_stream(stream, filename, uploaded_by=None):
+    """Store a file-like object and return its (unsaved) StoredFile record."""
+    tmp_dir = os.path.join(blob_root(), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if len(head) < 16:
+                    head += chunk[:16 - len(head)]
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        target = blob_path(sha256)
+        if os.path.exists(target):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    stored = StoredFile(sha256=sha256, size=size, filename=filename,
+                        content_type=sniff_content_type(head),
+                        uploaded_by=uploaded_by)
+    db.session.add(stored)
+    return stored
+
+
+def save_upload(file_storage, uploaded_by=None):
+    """Store a Werkzeug FileStorage from ``request.files``."""
+    from werkzeug.utils import secure_filename
+    return save_stream(file_storage.stream, secure_filename(file_storage.filename or 'upload'),
+                       uploaded_by)
+
+
+def send_stored_file(stored, as_attachment=False, download_name=None):
+    """Serve a stored file with Range/ETag support or hand it to the web server."""
+    download_name = download_name or stored.filename
+    content_type = stored.content_type
+    # Records stored before sniffing may carry a client-supplied type
+    if content_type not in INLINE_TYPES:
+        content_type, as_attachment = DOWNLOAD_TYPE, True
+    prefix = current_app.config.get('BLOB_ACCEL_REDIRECT_PREFIX')
+    if prefix:
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + relative_blob_path(stored.sha256)
+        response.headers['Content-Type'] = content_type
+        disposition = 'attachment' if as_attachment else 'inline'
+        response.headers.set('Content-Disposition', disposition, filename=download_name)
+        response.set_etag(stored.sha256)
+    else:
+        response = send_file(blob_path(stored.sha256),
+                             mimetype=content_type,
+                             as_attachment=as_attachment,
+                             download_name=download_name,
+                             conditional=True,
+                             etag=stored.sha256)
+    # A record can point at a new blob later, so revalidate with the ETag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if content_type != 'application/pdf':
+        # Browsers refuse to show PDFs in a sandbox; they run no page scripts anyway
+        response.headers['Content-Security-Policy'] = 'sandbox'
+    return response
@@ -0,0 +1,102 @@
+"""Template compile and fragment caching.
+
+Compiled templates are kept in a filesystem bytecode cache, so workers
+started after the first one load bytecode instead of recompiling
+``base.html`` and friends. Jinja checks each entry against the template
+source, so a deployment that changes a template recompiles just that one.
+
+``{% cache 'name' %}...{% endcache %}`` stores a rendered fragment per
+worker, keyed by the fragment name, the user's role, the locale and the
+template version, plus any extra arguments given to the tag. Use it for
+markup that only depends on those, such as the role navigation.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from flask import current_app
+from flask_babel import get_locale
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """A small thread-safe LRU of rendered fragments."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def fragment_key(name, extra):
+    user = current_user._get_current_object()
+    role = user.role if user.is_authenticated else None
+    locale = get_locale()
+    return (name, role, str(locale) if locale else None,
+            current_app.config['TEMPLATE_VERSION']) + tuple(extra)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_render_cached', [nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, args, caller):
+        cache = current_app.extensions['fragment_cache']
+        key = fragment_key(args[0], args[1:])
+        rv = cache.get(key)
+        if rv is None:
+            rv = Markup(caller())
+            cache.set(key, rv)
+        return rv
+
+
+def template_version(template_folder):
+    """Fingerprint the template tree from file names, sizes and mtimes."""
+    digest = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(template_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, filename))
+            digest.update(f'{dirpath}/{filename}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:12]
+
+
+def init_app(app):
+    cache_dir = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    if not app.config.get('TEMPLATE_VERSION'):
+        app.config['TEMPLATE_VERSION'] = template_version(
+            os.path.join(app.root_path, app.template_folder))
+    app.extensions['fragment_cache'] = FragmentCache(app.config.get('FRAGMENT_CACHE_SIZE', 256))
+    app.jinja_env.add_extension(FragmentCacheExtension)
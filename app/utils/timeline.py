@@ -0,0 +1,150 @@
+"""Time-ordered patient timeline across appointments, prescriptions, lab tests and bills.
+
+Each source is read newest first through its ``(patient_id, <time>)`` index,
+limited to one page past a keyset cursor, and the sources are k-way merged
+in Python. A page therefore costs one short range scan per source no matter
+how long the patient's history is. Archived rows are read the same way
+from the ``archive_*`` tables; a row lives in exactly one of the two, so
+hot and archive rows of a kind share a rank and never collide.
+"""
+import base64
+import heapq
+import itertools
+from datetime import datetime
+from sqlalchemy.orm import selectinload
+from app import db
+from app.models import (Appointment, Prescription, PrescriptionMedication, LabTest, Bill,
+                        ArchivedAppointment, ArchivedPrescription, ArchivedPrescriptionMedication,
+                        ArchivedLabTest, ArchivedBill)
+
+
+def _appointment_entry(appointment):
+    return {
+        'title': 'Appointment',
+        'status': appointment.status,
+        'doctor_id': appointment.doctor_id,
+        'notes': appointment.notes
+    }
+
+
+def _prescription_entry(prescription):
+    return {
+        'title': 'Prescription',
+        'status': prescription.status,
+        'doctor_id': prescription.doctor_id,
+        'diagnosis': prescription.diagnosis,
+        'medications': [{
+            'medication_id': line.medication_id,
+            'name': line.medication.name if line.medication else None,
+            'dosage': line.dosage,
+            'frequency': line.frequency,
+            'duration': line.duration
+        } for line in prescription.medications]
+    }
+
+
+def _lab_test_entry(test):
+    return {
+        'title': 'Lab Test',
+        'status': test.status,
+        'doctor_id': test.doctor_id,
+        'test_type': test.test_type,
+        'priority': test.priority,
+        'results': test.results
+    }
+
+
+def _bill_entry(bill):
+    return {
+        'title': 'Bill',
+        'status': bill.payment_status,
+        'total_amount': bill.total_amount
+    }
+
+
+# (kind, model, time column, query options, entry builder); the position in
+# this list breaks ties between rows of different kinds with the same time.
+SOURCES = [
+    ('appointment', Appointment, Appointment.appointment_date, (), _appointment_entry),
+    ('prescription', Prescription, Prescription.prescription_date,
+     (selectinload(Prescription.medications).joinedload(PrescriptionMedication.medication),),
+     _prescription_entry),
+    ('lab_test', LabTest, LabTest.test_date, (), _lab_test_entry),
+    ('bill', Bill, Bill.bill_date, (), _bill_entry),
+]
+
+ARCHIVE_SOURCES = [
+    ('appointment', ArchivedAppointment, ArchivedAppointment.appointment_date, (),
+     _appointment_entry),
+    ('prescription', ArchivedPrescription, ArchivedPrescription.prescription_date,
+     (selectinload(ArchivedPrescription.medications)
+      .joinedload(ArchivedPrescriptionMedication.medication),),
+     _prescription_entry),
+    ('lab_test', ArchivedLabTest, ArchivedLabTest.test_date, (), _lab_test_entry),
+    ('bill', ArchivedBill, ArchivedBill.bill_date, (), _bill_entry),
+]
+
+KINDS = tuple(source[0] for source in SOURCES)
+ARCHIVED_MODELS = tuple(source[1] for source in ARCHIVE_SOURCES)
+
+
+def encode_cursor(time, rank, id):
+    raw = f'{time.isoformat()}|{rank}|{id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return ``(time, rank, id)`` for a cursor, or None if it is malformed."""
+    try:
+        time, rank, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(time), int(rank), int(id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def _before_cursor(model, column, rank, cursor):
+    time, cursor_rank, cursor_id = cursor
+    if rank < cursor_rank:
+        return column <= time
+    if rank > cursor_rank:
+        return column < time
+    return db.or_(column < time, db.and_(column == time, model.id < cursor_id))
+
+
+def _source_rows(rank, source, patient_id, cursor, limit, where=None):
+    kind, model, column, options, build = source
+    query = model.query.filter(model.patient_id == patient_id, column.isnot(None))
+    if where is not None:
+        query = query.filter(where(model))
+    if cursor is not None:
+        query = query.filter(_before_cursor(model, column, rank, cursor))
+    rows = query.options(*options).order_by(column.desc(), model.id.desc()).limit(limit).all()
+    return [((getattr(row, column.key), rank, row.id), kind, row, build) for row in rows]
+
+
+def patient_timeline(patient_id, kinds=None, cursor=None, limit=20, filters=None):
+    """Return one page of a patient's timeline, newest first.
+
+    ``kinds`` restricts the sources, ``cursor`` is the ``next_cursor`` of the
+    previous page. ``filters`` maps a kind to a function that takes the hot
+    or archive model and returns an extra filter for its rows. The result
+    has ``entries`` and ``next_cursor``, which is None on the last page.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    filters = filters or {}
+    streams = [
+        _source_rows(KINDS.index(source[0]), source, patient_id, position, limit + 1,
+                     filters.get(source[0]))
+        for source in SOURCES + ARCHIVE_SOURCES
+        if kinds is None or source[0] in kinds
+    ]
+    merged = heapq.merge(*streams, key=lambda item: item[0], reverse=True)
+    page = list(itertools.islice(merged, limit + 1))
+    next_cursor = encode_cursor(*page[limit - 1][0]) if len(page) > limit else None
+    entries = []
+    for key, kind, row, build in page[:limit]:
+        entry = build(row)
+        entry.update({'kind': kind, 'id': row.id, 'time': key[0].isoformat(),
+                      'archived': isinstance(row, ARCHIVED_MODELS)})
+        entries.append(entry)
+    return {'entries': entries, 'next_cursor': next_cursor}
@@ -0,0 +1,283 @@
+"""In-memory medication typeahead index.
+
+Each worker keeps the formulary in memory, built on first use:
+
+* sorted lists of normalised full names and of name words, searched by
+  prefix with ``bisect``;
+* a trigram index over names for infix matches;
+* description words mapped to ids kept in rank order, so a common word
+  like "infection" yields its top ten without ranking thousands of ids.
+
+Results are ranked by match tier, then by how often the medication has
+been prescribed, then by name. The tiers are: the name starts with the
+query, a word of the name does, the name contains it, a word of the
+description starts with it. Top-ten lists are cached per query until the
+next change, since prescribers type the same few prefixes over and over;
+the cache holds at most ``CACHE_SIZE`` queries.
+
+The index is updated in place: ``refresh`` applies medications whose
+``updated_at`` moved past the last watermark, so the worker that saved a
+change sees it at once and other workers within
+``MEDICATION_INDEX_REFRESH`` seconds. Prescribing counts are reloaded every
+``MEDICATION_INDEX_FREQUENCY_TTL`` seconds.
+"""
+import bisect
+import heapq
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select
+from app import db
+from app.models import Medication, PrescriptionMedication
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+DESCRIPTION_CHARS = 200  # only the start of a description is indexed
+WATERMARK_OVERLAP = 5  # seconds
+REBUILD_THRESHOLD = 500  # changed rows above which the index is rebuilt
+CACHE_SIZE = 10000  # cached queries
+INDEXED_COLUMNS = (Medication.id, Medication.name, Medication.description, Medication.unit)
+
+
+def normalise(text):
+    return ' '.join(WORD_RE.findall((text or '').lower()))
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class Entry:
+    __slots__ = ('id', 'name', 'unit', 'key', 'words', 'description_words', 'grams')
+
+    def __init__(self, medication):
+        self.id = medication.id
+        self.name = medication.name
+        self.unit = medication.unit
+        self.key = normalise(medication.name)
+        self.words = set(self.key.split())
+        self.description_words = set(
+            normalise((medication.description or '')[:DESCRIPTION_CHARS]).split()) - self.words
+        self.grams = trigrams(self.key)
+
+
+class MedicationIndex:
+    """Prefix and trigram index over the formulary for one worker."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._names = []
+        self._words = []
+        self._description_vocab = []
+        self._description_postings = {}
+        self._grams = {}
+        self._frequency = {}
+        self._cache = {}
+        self._order = None
+        self._watermark = None
+        self._checked_at = 0.0
+        self._counted_at = 0.0
+
+    # Maintenance
+
+    def _add(self, entry):
+        self._entries[entry.id] = entry
+        bisect.insort(self._names, (entry.key, entry.id))
+        for word in entry.words:
+            bisect.insort(self._words, (word, entry.id))
+        for word in entry.description_words:
+            postings = self._description_postings.get(word)
+            if postings is None:
+                postings = self._description_postings[word] = []
+                bisect.insort(self._description_vocab, word)
+            # Appended out of order; _ranks() re-sorts before the next search
+            postings.append(entry.id)
+        for gram in entry.grams:
+            self._grams.setdefault(gram, set()).add(entry.id)
+
+    def _remove(self, id):
+        entry = self._entries.pop(id, None)
+        if entry is None:
+            return
+        del self._names[bisect.bisect_left(self._names, (entry.key, id))]
+        for word in entry.words:
+            del self._words[bisect.bisect_left(self._words, (word, id))]
+        for word in entry.description_words:
+            postings = self._description_postings[word]
+            postings.remove(id)
+            if not postings:
+                del self._description_postings[word]
+                del self._description_vocab[bisect.bisect_left(self._description_vocab, word)]
+        for gram in entry.grams:
+            postings = self._grams.get(gram)
+            postings.discard(id)
+            if not postings:
+                del self._grams[gram]
+
+    def _rebuild(self, medications):
+        entries = {medication.id: Entry(medication) for medication in medications}
+        grams = {}
+        for entry in entries.values():
+            for gram in entry.grams:
+                grams.setdefault(gram, set()).add(entry.id)
+        self._entries = entries
+        self._names = sorted((entry.key, entry.id) for entry in entries.values())
+        self._words = sorted((word, entry.id) for entry in entries.values()
+                             for word in entry.words)
+        self._description_postings = {}
+        for entry in entries.values():
+            for word in entry.description_words:
+                self._description_postings.setdefault(word, []).append(entry.id)
+        self._description_vocab = sorted(self._description_postings)
+        self._grams = grams
+
+    def _differs(self, row):
+        entry = self._entries.get(row.id)
+        if entry is None:
+            return True
+        fresh = Entry(row)
+        return (entry.name, entry.unit, entry.description_words) != \
+            (fresh.name, fresh.unit, fresh.description_words)
+
+    def _count_prescriptions(self):
+        rows = db.session.query(PrescriptionMedication.medication_id, db.func.count())\
+            .group_by(PrescriptionMedication.medication_id).all()
+        self._frequency = dict(rows)
+        self._counted_at = time.monotonic()
+        self._changed()
+
+    def _changed(self):
+        self._cache.clear()
+        self._order = None
+
+    def _ranks(self):
+        """Position of each id in (-prescriptions, name) order, so ranking is an int lookup."""
+        if self._order is None:
+            frequency, entries = self._frequency, self._entries
+            ordered = sorted(entries, key=lambda id: (-frequency.get(id, 0), entries[id].key))
+            self._order = {id: position for position, id in enumerate(ordered)}
+            for postings in self._description_postings.values():
+                postings.sort(key=self._order.__getitem__)
+        return self._order
+
+    def refresh(self, force=False):
+        """Apply medications changed since the last refresh."""
+        config = current_app.config
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._watermark is not None and \
+                    now - self._checked_at < config['MEDICATION_INDEX_REFRESH']:
+                return
+            query = select(*INDEXED_COLUMNS)
+            if self._watermark is not None:
+                query = query.where(Medication.updated_at >= self._watermark)
+            started = datetime.utcnow()
+            rows = db.session.execute(query).all()
+            if self._watermark is None:
+                self._rebuild(rows)
+                changed = rows
+            else:
+                # The overlap re-reads recent rows; skip the ones already indexed
+                changed = [row for row in rows if self._differs(row)]
+                if len(changed) > REBUILD_THRESHOLD:
+                    # A bulk import: sorting once beats inserting one by one
+                    self._rebuild(db.session.execute(select(*INDEXED_COLUMNS)).all())
+                else:
+                    for row in changed:
+                        self._remove(row.id)
+                        self._add(Entry(row))
+            if changed:
+                self._changed()
+            # Overlap so rows committed while we were reading are seen next time
+            self._watermark = started - timedelta(seconds=WATERMARK_OVERLAP)
+            self._checked_at = now
+            if now - self._counted_at >= config['MEDICATION_INDEX_FREQUENCY_TTL']:
+                self._count_prescriptions()
+            self._ranks()
+
+    def upsert(self, medication):
+        """Index a just-committed medication in this worker."""
+        with self._lock:
+            self._remove(medication.id)
+            self._add(Entry(medication))
+            self._changed()
+
+    # Queries
+
+    def _prefix_ids(self, keys, prefix):
+        start = bisect.bisect_left(keys, (prefix,))
+        end = bisect.bisect_left(keys, (prefix + '\uffff',), start)
+        return (id for _, id in keys[start:end])
+
+    def _rank(self, ids, limit, seen):
+        candidates = [id for id in ids if id not in seen]
+        return heapq.nsmallest(limit, candidates, key=self._ranks().__getitem__)
+
+    def _description_ids(self, prefix):
+        """Ids whose description has a word starting with ``prefix``, best first."""
+        order = self._ranks()
+        vocab = self._description_vocab
+        start = bisect.bisect_left(vocab, prefix)
+        end = bisect.bisect_left(vocab, prefix + '\uffff', start)
+        postings = [self._description_postings[word] for word in vocab[start:end]]
+        if len(postings) == 1:
+            return iter(postings[0])
+        return heapq.merge(*postings, key=order.__getitem__)
+
+    def _take(self, ranked_ids, limit, seen):
+        taken = []
+        for id in ranked_ids:
+            if id not in seen and id not in taken:
+                taken.append(id)
+                if len(taken) == limit:
+                    break
+        return taken
+
+    def _infix_ids(self, query):
+        grams = trigrams(query)
+        postings = sorted((self._grams.get(gram, set()) for gram in grams), key=len)
+        if not postings or not postings[0]:
+            return set()
+        return set.intersection(*postings)
+
+    def search(self, text, limit=10):
+        query = normalise(text)
+        if not query:
+            return []
+        self.refresh()
+        with self._lock:
+            if limit > 10:
+                return self._search(query, limit)
+            cached = self._cache.get(query)
+            if cached is None:
+                if len(self._cache) >= CACHE_SIZE:
+                    self._cache.clear()
+                cached = self._cache[query] = self._search(query, 10)
+            return cached[:limit]
+
+    def _search(self, query, limit):
+        seen = set()
+        results = []
+        rank = self._rank
+        tiers = [(rank, lambda: self._prefix_ids(self._names, query)),
+                 (rank, lambda: self._prefix_ids(self._words, query))]
+        if len(query) >= 3:
+            tiers.append((rank, lambda: (id for id in self._infix_ids(query)
+                                         if query in self._entries[id].key)))
+        tiers.append((self._take, lambda: self._description_ids(query)))
+        for select_top, tier in tiers:
+            ranked = select_top(tier(), limit - len(results), seen)
+            results.extend(ranked)
+            seen.update(ranked)
+            if len(results) >= limit:
+                break
+        return [self._to_dict(self._entries[id]) for id in results]
+
+    def _to_dict(self, entry):
+        return {'id': entry.id, 'name': entry.name, 'unit': entry.unit,
+                'prescribed': self._frequency.get(entry.id, 0)}
+
+
+medication_index = MedicationIndex()
@@ -0,0 +1,252 @@
+"""Per-doctor waiting-room queues.
+
+An appointment joins its doctor's queue when it is checked in, at the kiosk
+or the front desk, and leaves it when the doctor calls it in
+(``in_consultation``), completes or cancels it. Patients wait in order of
+``queue_priority`` (staff raise it to reorder), then appointment time, then
+arrival.
+
+Each worker keeps every doctor's queue in memory as a binary heap with lazy
+deletion: checking in, reordering and calling the next patient are O(log n)
+heap operations, and an entry that moved or left stays in the heap as stale
+until it surfaces. Queues are built from the database on first use and at
+the start of each day, then kept current by appointment commits: this
+worker's own are applied after commit, other workers' arrive on the
+``waiting_room`` outbox channel polled by the event broker. A change older
+than the one a worker already holds for an appointment, by ``updated_at``,
+is ignored, so the two routes can deliver the same change in any order.
+
+Reads, for the doctor dashboard and the waiting-room display, never query
+the appointments table. Patient and doctor names are cached per worker.
+"""
+import heapq
+import threading
+from datetime import date, datetime
+from sqlalchemy import event, func, select
+from app import db
+from app.models import Appointment, Patient, QueueEvent, User
+from app.utils.events import (APPOINTMENT_CHANGES, WAITING_ROOM_CHANNEL, WAITING_ROOM_STATUSES,
+                              appointment_change, broker)
+
+
+def _parse(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+class Entry:
+    __slots__ = ('id', 'doctor_id', 'patient_id', 'status', 'priority', 'appointment_date',
+                 'checked_in_at', 'key')
+
+    def __init__(self, change):
+        self.id = change['id']
+        self.doctor_id = change['doctor_id']
+        self.patient_id = change['patient_id']
+        self.status = change['status']
+        self.priority = change['priority']
+        self.appointment_date = _parse(change['appointment_date'])
+        self.checked_in_at = _parse(change['checked_in_at'])
+        self.key = (-self.priority, self.appointment_date,
+                    self.checked_in_at or self.appointment_date, self.id)
+
+
+class DoctorQueue:
+    """Checked-in patients for one doctor, plus whoever is in consultation."""
+
+    def __init__(self):
+        self._heap = []  # (key, id), including stale entries
+        self.waiting = {}  # id -> Entry
+        self.consulting = {}  # id -> Entry
+        self._ordered = None
+
+    def add(self, entry):
+        if entry.status == 'checked_in':
+            self.waiting[entry.id] = entry
+            heapq.heappush(self._heap, (entry.key, entry.id))
+        else:
+            self.consulting[entry.id] = entry
+        self._ordered = None
+
+    def discard(self, id):
+        self.waiting.pop(id, None)
+        self.consulting.pop(id, None)
+        self._ordered = None
+        if len(self._heap) > 2 * len(self.waiting) + 16:
+            self._heap = [(entry.key, entry.id) for entry in self.waiting.values()]
+            heapq.heapify(self._heap)
+
+    def first(self):
+        """The next patient to call, dropping stale entries off the top."""
+        heap = self._heap
+        while heap:
+            key, id = heap[0]
+            entry = self.waiting.get(id)
+            if entry is not None and entry.key == key:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    def ordered(self):
+        if self._ordered is None:
+            self._ordered = sorted(self.waiting.values(), key=lambda entry: entry.key)
+        return self._ordered
+
+
+class WaitingRoom:
+    """Every doctor's queue for today, for one worker."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._queues = {}  # doctor id -> DoctorQueue
+        self._doctor_of = {}  # appointment id -> doctor id, for queued appointments
+        self._versions = {}  # appointment id -> updated_at of the last change applied
+        self._patients = {}
+        self._doctors = {}
+        self._day = None
+
+    def _current(self):
+        today = date.today()
+        if self._day != today:
+            self.rebuild(today)
+
+    def rebuild(self, day=None):
+        """Reload today's queues; changes committed meanwhile are replayed."""
+        day = day or date.today()
+        last_event = db.session.query(func.max(QueueEvent.id)).scalar() or 0
+        rows = db.session.execute(
+            select(Appointment.id, Appointment.doctor_id, Appointment.patient_id,
+                   Appointment.status, Appointment.queue_priority, Appointment.appointment_date,
+                   Appointment.checked_in_at, Appointment.updated_at,
+                   Patient.first_name, Patient.last_name)
+            .join(Patient, Patient.id == Appointment.patient_id)
+            .where(Appointment.status.in_(WAITING_ROOM_STATUSES),
+                   Appointment.appointment_date >= datetime(day.year, day.month, day.day))).all()
+        with self._lock:
+            self._queues = {}
+            self._doctor_of = {}
+            self._versions = {}
+            self._patients = {}
+            self._day = day
+            for row in rows:
+                self._patients[row.patient_id] = (row.first_name, row.last_name)
+                self._apply(appointment_change(row))
+        broker.listen(WAITING_ROOM_CHANNEL, self.apply, since=last_event)
+
+    def apply(self, change):
+        with self._lock:
+            if self._day is not None:
+                self._apply(change)
+
+    def apply_all(self, changes):
+        with self._lock:
+            if self._day is not None:
+                for change in changes:
+                    self._apply(change)
+
+    def _apply(self, change):
+        id = change['id']
+        updated_at = _parse(change['updated_at']) or datetime.min
+        if id in self._versions and self._versions[id] >= updated_at:
+            return
+        self._versions[id] = updated_at
+        doctor_id = self._doctor_of.pop(id, None)
+        if doctor_id is not None:
+            self._queues[doctor_id].discard(id)
+        entry = Entry(change)
+        if entry.status in WAITING_ROOM_STATUSES and entry.appointment_date.date() >= self._day:
+            self._queues.setdefault(entry.doctor_id, DoctorQueue()).add(entry)
+            self._doctor_of[id] = entry.doctor_id
+
+    # Reads
+
+    def next_appointment_id(self, doctor_id):
+        """The appointment the doctor should call in next, or None."""
+        self._current()
+        with self._lock:
+            queue = self._queues.get(doctor_id)
+            entry = queue.first() if queue else None
+            return entry.id if entry else None
+
+    def queue(self, doctor_id):
+        """The doctor's waiting patients in order, and who is in consultation."""
+        self._current()
+        with self._lock:
+            queue = self._queues.get(doctor_id) or DoctorQueue()
+            waiting = list(queue.ordered())
+            consulting = list(queue.consulting.values())
+        names = self._patient_names({entry.patient_id for entry in waiting + consulting})
+        return {
+            'waiting': [self._to_dict(entry, names, position)
+                        for position, entry in enumerate(waiting, start=1)],
+            'in_consultation': [self._to_dict(entry, names, None) for entry in consulting]
+        }
+
+    def display(self, doctor_ids=None):
+        """Every queue for a waiting-room screen: first names and initials only."""
+        self._current()
+        with self._lock:
+            queues = {doctor_id: (list(queue.ordered()), list(queue.consulting.values()))
+                      for doctor_id, queue in self._queues.items()
+                      if doctor_ids is None or doctor_id in doctor_ids}
+        names = self._patient_names({entry.patient_id for waiting, consulting in queues.values()
+                                     for entry in waiting + consulting})
+        doctors = self._doctor_names(set(queues))
+
+        def short(entry):
+            first_name, last_name = names.get(entry.patient_id, ('', ''))
+            return f'{first_name} {last_name[:1]}.'.strip() if last_name else first_name
+        return [{'doctor_id': doctor_id,
+                 'doctor': doctors.get(doctor_id, ''),
+                 'in_consultation': [short(entry) for entry in consulting],
+                 'waiting': [{'position': position, 'patient': short(entry),
+                              'appointment_time': entry.appointment_date.strftime('%H:%M')}
+                             for position, entry in enumerate(waiting, start=1)]}
+                for doctor_id, (waiting, consulting) in sorted(queues.items())
+                if waiting or consulting]
+
+    def _to_dict(self, entry, names, position):
+        first_name, last_name = names.get(entry.patient_id, ('', ''))
+        return {'position': position,
+                'appointment_id': entry.id,
+                'patient_id': entry.patient_id,
+                'patient': f'{first_name} {last_name}'.strip(),
+                'priority': entry.priority,
+                'appointment_time': entry.appointment_date.strftime('%H:%M'),
+                'status': entry.status,
+                # checked_in_at is UTC, appointment times are local
+                'waiting_minutes': max(0, int((datetime.utcnow() - entry.checked_in_at)
+                                              .total_seconds() // 60))
+                if entry.checked_in_at else None}
+
+    def _patient_names(self, ids):
+        return self._names(self._patients, ids, Patient, lambda row: (row.first_name, row.last_name))
+
+    def _doctor_names(self, ids):
+        return self._names(self._doctors, ids, User,
+                           lambda row: f'Dr. {row.first_name or ""} {row.last_name or ""}'.strip())
+
+    def _names(self, cache, ids, model, name):
+        missing = [id for id in ids if id not in cache]
+        if missing:
+            rows = db.session.execute(select(model.id, model.first_name, model.last_name)
+                                      .where(model.id.in_(missing))).all()
+            with self._lock:
+                for row in rows:
+                    cache[row.id] = name(row)
+        return {id: cache[id] for id in ids if id in cache}
+
+
+waiting_room = WaitingRoom()
+
+
+def _apply_committed(session):
+    changes = session.info.pop(APPOINTMENT_CHANGES, None)
+    if changes:
+        waiting_room.apply_all(changes)
+
+
+def _discard_uncommitted(session):
+    session.info.pop(APPOINTMENT_CHANGES, None)
+
+
+event.listen(db.session, 'after_commit', _apply_committed)
+event.listen(db.session, 'after_rollback', _discard_uncommitted)
@@ -21,6 +21,128 @@ class Config:
     # Upload configuration
     UPLOAD_FOLDER = os.path.join(basedir, 'app', 'static', 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    BLOB_STORE_FOLDER = os.environ.get('BLOB_STORE_FOLDER') or \
+        os.path.join(basedir, 'instance', 'blobs')
+    # Let the web server send stored files: X-Sendfile (Apache, lighttpd) or
+    # an nginx internal location aliased to BLOB_STORE_FOLDER
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '0') == '1'
+    BLOB_ACCEL_REDIRECT_PREFIX = os.environ.get('BLOB_ACCEL_REDIRECT_PREFIX')
+    
+    # Lab file previews
+    PREVIEW_SIZES = {'thumb': (240, 240), 'preview': (1280, 1280)}
+    PREVIEW_QUALITY = 80
+    PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS') or 2)
+    PREVIEW_RETRY_AFTER = 2  # seconds a client is told to wait for an on-demand render
+
+    # Live work-queue events (Server-Sent Events)
+    SSE_MAX_CONNECTIONS = int(os.environ.get('SSE_MAX_CONNECTIONS') or 500)  # per worker
+    SSE_POLL_INTERVAL = 1.0  # seconds between outbox polls
+    SSE_HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments
+    SSE_GAP_TIMEOUT = 30  # seconds an outbox id skipped by a late commit is looked for
+
+    # Lab work queue
+    LAB_QUEUE_LEASE_SECONDS = 15 * 60
+    LAB_QUEUE_MAX_CLAIM = 20
+
+    # Appointment reminders
+    REMINDER_BATCH_SIZE = 500  # messages sent per log commit
+
+    # Archival of closed clinical records
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 730)
+    ARCHIVE_MIN_IDLE_DAYS = 30  # rows updated (or restored) more recently stay hot
+    ARCHIVE_BATCH_SIZE = 500
+    ARCHIVE_BATCH_PAUSE = 0.05  # seconds between batches
+
+    # Rate limiting (token buckets shared by all workers on the host)
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE')  # default: instance/ratelimit.bin
+    RATELIMIT_SLOTS = 65536
+
+    # Reverse proxy: how many proxies (e.g. the nginx front end) set X-Forwarded-*
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or 0)  # 0: not behind a proxy
+
+    # Audit log of record access
+    AUDIT_FLUSH_SIZE = 200  # events buffered before an early flush
+    AUDIT_FLUSH_INTERVAL = 2.0  # seconds
+    AUDIT_RETENTION_DAYS = 6 * 365
+
+    # Analytics snapshot for population reports
+    ANALYTICS_SNAPSHOT_FOLDER = os.environ.get('ANALYTICS_SNAPSHOT_FOLDER')  # default: instance/analytics
+    ANALYTICS_AGE_BANDS = (0, 18, 35, 50, 65)
+    ANALYTICS_RETENTION_MONTHS = 12
+
+    # Appointment volume forecasts (flask forecast run, nightly)
+    FORECAST_FILE = os.environ.get('FORECAST_FILE')  # default: instance/forecast.json
+    FORECAST_HISTORY_DAYS = 364
+    FORECAST_SEASON_WEEKS = 8  # weeks behind the day-of-week profile
+    FORECAST_LEVEL_DAYS = 28  # moving-average window for the level
+    FORECAST_HORIZON_WEEKS = 8
+    FORECAST_BACKTEST_ORIGINS = 8  # weekly cut-offs the backtest refits at
+
+    # Appointment check-in (signed QR tokens scanned at the kiosk)
+    CHECKIN_SECRET_KEY = os.environ.get('CHECKIN_SECRET_KEY')  # default: derived from SECRET_KEY
+    CHECKIN_KIOSK_KEY = os.environ.get('CHECKIN_KIOSK_KEY')  # kiosks send it as X-Kiosk-Key; unset: staff only
+    CHECKIN_OPENS_BEFORE = 2 * 60 * 60  # seconds before the appointment a token is accepted
+    CHECKIN_CLOSES_AFTER = 60 * 60  # seconds after the appointment
+    CHECKIN_FLUSH_SIZE = 200  # check-ins buffered before an early flush
+    CHECKIN_FLUSH_INTERVAL = 1.0  # seconds
+    CHECKIN_QR_FOLDER = os.environ.get('CHECKIN_QR_FOLDER')  # default: instance/checkin-qr
+
+    # Dashboard queries: run in parallel on server databases (None: all but SQLite)
+    DASHBOARD_PARALLEL = {'1': True, '0': False}.get(os.environ.get('DASHBOARD_PARALLEL'))
+    DASHBOARD_WORKERS = 4  # threads, and so extra pooled connections, per worker
+
+    # Duplicate patients
+    DEDUP_MIN_SCORE = 0.85  # pairs scoring below this are not reported
+    DEDUP_MAX_BLOCK = 50  # larger blocks (shared switchboard numbers) are skipped
+
+    # Pharmacy
+    MEDICATION_INDEX_REFRESH = 5  # seconds before a worker looks for other workers' edits
+    MEDICATION_INDEX_FREQUENCY_TTL = 600  # seconds between prescribing-count reloads
+    PHARMACY_MAX_BATCH_DISPENSE = 100
+    REORDER_FILE = os.environ.get('REORDER_FILE')  # default: instance/reorder.json
+    REORDER_AVERAGE_DAYS = 28  # moving-average window for daily demand
+    REORDER_RECENT_DAYS = 7  # short window; used when its demand is higher
+    REORDER_LEAD_TIME_DAYS = 7  # for medications without their own lead time
+    REORDER_REVIEW_DAYS = 7  # days between orders; each order covers them
+    REORDER_SERVICE_FACTOR = 1.65  # safety stock in standard deviations (about 95%)
+    INTERACTION_REFRESH = 30  # seconds between checks for a changed interaction table
+    INTERACTION_ACTIVE_DAYS = 90  # a prescription's medications count as current this long
+
+    # Billing
+    BILLING_CONSULTATION_FEE = 50.0
+    BILLING_LAB_TEST_TARIFF = {
+        'blood_test': 25.0,
+        'urine_test': 15.0,
+        'x_ray': 60.0,
+        'ultrasound': 90.0,
+        'ct_scan': 300.0,
+        'mri': 450.0,
+        'ecg': 35.0,
+        'endoscopy': 250.0,
+        'biopsy': 200.0
+    }
+    BILLING_LAB_TEST_DEFAULT_FEE = 40.0
+    BILLING_WATERMARK_OVERLAP = 300  # seconds re-scanned to catch late commits
+
+    # Templates
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR') or \
+        os.path.join(basedir, 'instance', 'jinja_cache')
+    TEMPLATE_VERSION = os.environ.get('TEMPLATE_VERSION')  # derived from the templates when unset
+    FRAGMENT_CACHE_SIZE = 256
+
+    # Startup budget for create_app(), checked by `python -m app.utils.startup`
+    STARTUP_BUDGET_MS = int(os.environ.get('STARTUP_BUDGET_MS') or 1500)
+
+    # Request profiling, off unless PROFILE_ENABLED=1 (results under /admin/profiles)
+    PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', '0') == '1'
+    PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE') or 0)  # 1 in N requests; 0: X-Profile-Token only
+    PROFILE_MODE = os.environ.get('PROFILE_MODE') or 'sample'  # 'sample' (stack sampler) or 'cprofile'; gevent/eventlet: cprofile
+    PROFILE_INTERVAL = 0.005  # seconds between stack samples
+    PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER')  # default: instance/profiles
+    PROFILE_KEEP_HOURS = 48  # hourly windows kept
+    PROFILE_TOKEN_MAX_AGE = 60 * 60
+    PROFILE_FLUSH_INTERVAL = 5.0  # seconds
 
     # Pagination
     POSTS_PER_PAGE = 10
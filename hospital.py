@@ -1,10 +1,10 @@
 from app import create_app, db
-from app.models import User, Patient, Appointment, Prescription, Medication, LabTest
 
 app = create_app()
 
 @app.shell_context_processor
 def make_shell_context():
+    from app.models import User, Patient, Appointment, Prescription, Medication, LabTest
     return {
         'db': db,
         'User': User,
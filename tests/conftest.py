@@ -0,0 +1,47 @@
+import pytest
+from config import Config
+from app import create_app, db
+from app.models import User
+
+
+@pytest.fixture
+def app(tmp_path):
+    class TestConfig(Config):
+        TESTING = True
+        WTF_CSRF_ENABLED = False
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'test.db')
+        RATELIMIT_STORAGE = str(tmp_path / 'ratelimit.bin')
+        BLOB_STORE_FOLDER = str(tmp_path / 'blobs')
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def make_user(app):
+    def make_user(role, email=None):
+        with app.app_context():
+            user = User(email=email or f'{role}@example.com', first_name=role.title(),
+                        last_name='User', role=role)
+            user.set_password('password')
+            db.session.add(user)
+            db.session.commit()
+            return user.id
+    return make_user
+
+
+@pytest.fixture
+def login(app):
+    """A test client logged in as the user with the given id."""
+    def login(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        return client
+    return login
@@ -0,0 +1,87 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import select
+from app import db
+from app.models import (Appointment, Bill, BillItem, LabResult, LabTest, Medication, Patient,
+                        Prescription, PrescriptionMedication, ReminderLog)
+from app.utils.archive import ARCHIVES, SPECS, restore, run_archive
+
+OLD = datetime(2015, 6, 1, 10, 30)
+IDLE = datetime.utcnow() - timedelta(days=400)
+
+
+def add_records(doctor_id, updated_at=IDLE):
+    """One closed, old record of every kind with its child rows."""
+    patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                      gender='F', phone='5550100')
+    medication = Medication(name='Amoxicillin', price=1.5, quantity_in_stock=10)
+    db.session.add_all([patient, medication])
+    db.session.flush()
+    appointment = Appointment(patient_id=patient.id, doctor_id=doctor_id, appointment_date=OLD,
+                              status='completed', notes='follow-up', checked_in_at=OLD,
+                              queue_priority=2, created_at=OLD, updated_at=updated_at)
+    prescription = Prescription(patient_id=patient.id, doctor_id=doctor_id, diagnosis='otitis',
+                                prescription_date=OLD, status='dispensed', dispensed_by=doctor_id,
+                                dispensed_at=OLD, dispensing_notes='with food', updated_at=updated_at)
+    test = LabTest(patient_id=patient.id, doctor_id=doctor_id, test_type='blood_test', test_date=OLD,
+                   status='completed', priority='urgent', results='K 6.8', created_at=OLD,
+                   updated_at=updated_at)
+    bill = Bill(patient_id=patient.id, bill_date=OLD, total_amount=53.0, payment_status='paid',
+                payment_method='cash', updated_at=updated_at)
+    db.session.add_all([appointment, prescription, test, bill])
+    db.session.flush()
+    db.session.add_all([
+        PrescriptionMedication(prescription_id=prescription.id, medication_id=medication.id,
+                               dosage='500 mg', frequency='tid', duration='7 days', quantity=2),
+        LabResult(lab_test_id=test.id, patient_id=patient.id, analyte='potassium', value=6.8,
+                  unit='mmol/L', reference_low=3.5, reference_high=5.1, flag='HH', observed_at=OLD),
+        BillItem(bill_id=bill.id, item_type='consultation', item_id=appointment.id,
+                 description='Consultation', quantity=1, unit_price=50.0, total_price=50.0),
+        ReminderLog(appointment_id=appointment.id, kind='day', appointment_date=OLD),
+    ])
+    db.session.commit()
+
+
+def hot_tables():
+    models = [spec.model for spec in SPECS] + [child for spec in SPECS for child, _, _ in spec.children]
+    return {model.__tablename__: [dict(row) for row in db.session.execute(
+        select(model.__table__).order_by(model.__table__.c.id)).mappings()] for model in models}
+
+
+def test_archive_then_restore_round_trips_every_column_and_child(app, make_user):
+    app.config['ARCHIVE_BATCH_SIZE'] = 1
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        add_records(doctor_id)
+        add_records(doctor_id)
+        before = hot_tables()
+        assert run_archive() == {'appointment': 2, 'prescription': 2, 'lab_test': 2, 'bill': 2}
+        assert all(rows == [] for rows in hot_tables().values())
+        assert ReminderLog.query.count() == 0
+        for model, archive in ARCHIVES.items():
+            assert db.session.query(archive).count() == 2
+        for spec in SPECS:
+            assert len(restore(spec.kind)) == 2
+        after = hot_tables()
+        for model, archive in ARCHIVES.items():
+            assert db.session.query(archive).count() == 0
+        for table, rows in before.items():
+            if 'updated_at' in db.Model.metadata.tables[table].c:
+                # Restoring keeps the rows hot for ARCHIVE_MIN_IDLE_DAYS
+                assert all(row['updated_at'] > IDLE for row in after[table])
+                rows = [dict(row, updated_at=None) for row in rows]
+                after[table] = [dict(row, updated_at=None) for row in after[table]]
+            assert after[table] == rows, table
+        assert run_archive() == {'appointment': 0, 'prescription': 0, 'lab_test': 0, 'bill': 0}
+
+
+def test_recently_touched_and_open_rows_stay_hot(app, make_user):
+    doctor_id = make_user('doctor')
+    idle_days = app.config['ARCHIVE_MIN_IDLE_DAYS']
+    with app.app_context():
+        add_records(doctor_id, updated_at=datetime.utcnow() - timedelta(days=idle_days - 1))
+        add_records(doctor_id)
+        Prescription.query.filter_by(id=2).update({'status': 'pending', 'updated_at': IDLE})
+        db.session.commit()
+        assert run_archive() == {'appointment': 1, 'prescription': 0, 'lab_test': 1, 'bill': 1}
+        assert [row.id for row in Appointment.query] == [1]
+        assert [row.lab_test_id for row in LabResult.query] == [1]
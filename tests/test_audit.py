@@ -0,0 +1,101 @@
+import json
+import time
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from app import db
+from app.utils.audit import (AuditLog, check_append_only, partition_name, query_access_log)
+
+
+@pytest.fixture
+def audit(app, tmp_path):
+    app.config['AUDIT_SPILL_FILE'] = str(tmp_path / 'audit-spill.jsonl')
+    return AuditLog(app)
+
+
+def event(object_id, accessed_at=None):
+    return {'accessed_at': accessed_at or datetime.utcnow(), 'user_id': 1, 'action': 'view',
+            'object_type': 'patient', 'object_id': object_id, 'patient_id': object_id,
+            'endpoint': 'main.view_patient', 'ip_address': '10.0.0.1'}
+
+
+def logged(app):
+    with app.app_context():
+        page = query_access_log(datetime.utcnow() - timedelta(days=400),
+                                datetime.utcnow() + timedelta(days=1), limit=1000)
+    return sorted(entry['object_id'] for entry in page['entries'])
+
+
+def test_events_are_buffered_until_a_flush(app, audit):
+    app.config['AUDIT_FLUSH_SIZE'] = 1000
+    audit.record(event(1))
+    audit.record(event(2, datetime.utcnow() - timedelta(days=62)))
+    assert logged(app) == []
+    assert audit.flush() == 2
+    assert logged(app) == [1, 2]
+    assert audit.flush() == 0
+
+
+def test_a_full_buffer_wakes_the_flusher(app, audit):
+    app.config['AUDIT_FLUSH_SIZE'] = 3
+    app.config['AUDIT_FLUSH_INTERVAL'] = 60
+    for id in range(3):
+        audit.record(event(id))
+    for _ in range(200):
+        if logged(app):
+            break
+        time.sleep(0.01)
+    assert logged(app) == [0, 1, 2]
+
+
+def test_a_failed_flush_at_exit_spills_and_the_next_flush_loads_it(app, audit, monkeypatch):
+    write = audit._write
+
+    def unreachable(events):
+        raise OperationalError('INSERT', {}, Exception('database is unreachable'))
+    monkeypatch.setattr(audit, '_write', unreachable)
+    audit.record(event(1))
+    assert audit.flush() == 0
+    assert audit._buffer[0]['object_id'] == 1
+    audit._exiting = True
+    audit.record(event(2))
+    assert audit.flush() == 0
+    with open(app.config['AUDIT_SPILL_FILE']) as f:
+        assert [json.loads(line)['object_id'] for line in f] == [1, 2]
+    assert audit._buffer == []
+    monkeypatch.setattr(audit, '_write', write)
+    audit._exiting = False
+    assert audit.flush() == 2
+    assert logged(app) == [1, 2]
+
+
+def test_an_unreachable_database_keeps_the_buffer_bounded(app, audit, monkeypatch):
+    app.config['AUDIT_FLUSH_SIZE'] = 1000
+    app.config['AUDIT_MAX_BUFFER'] = 2
+    monkeypatch.setattr(audit, '_write', lambda events: 1 / 0)
+    for id in range(5):
+        audit.record(event(id))
+    audit.flush()
+    assert [item['object_id'] for item in audit._buffer] == [3, 4]
+    with open(app.config['AUDIT_SPILL_FILE']) as f:
+        assert [json.loads(line)['object_id'] for line in f] == [0, 1, 2]
+
+
+def test_partitions_reject_update_and_delete(app, audit):
+    audit.record(event(1))
+    audit.flush()
+    name = partition_name(datetime.utcnow())
+    with app.app_context():
+        for statement in (f'UPDATE {name} SET user_id = 2', f'DELETE FROM {name}'):
+            with pytest.raises(IntegrityError, match='append-only'):
+                with db.engine.begin() as conn:
+                    conn.execute(text(statement))
+    assert logged(app) == [1]
+
+
+def test_unsupported_databases_are_refused():
+    check_append_only('postgresql+psycopg2://localhost/hospital')
+    check_append_only('mysql+pymysql://localhost/hospital')
+    with pytest.raises(RuntimeError, match='append-only'):
+        check_append_only('mssql+pyodbc://localhost/hospital')
@@ -0,0 +1,96 @@
+import time
+from datetime import date, datetime, timedelta
+import pytest
+from sqlalchemy import literal
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Appointment, Bill, BillItem, LabTest, Patient
+from app.utils import billing
+from app.utils.billing import run_billing
+
+
+def add_encounters(patients, appointments_per_patient, updated_at=None):
+    """Completed appointments and lab tests; returns the patient ids."""
+    db.session.execute(Patient.__table__.insert(), [
+        dict(first_name='Ann', last_name=f'Lee{i}', date_of_birth=date(1970, 1, 1), gender='F',
+             phone='5550100') for i in range(patients)])
+    ids = [id for (id,) in db.session.query(Patient.id).order_by(Patient.id.desc()).limit(patients)]
+    updated_at = updated_at or datetime.utcnow() - timedelta(minutes=1)
+    db.session.execute(Appointment.__table__.insert(), [
+        dict(patient_id=id, doctor_id=1, appointment_date=updated_at, status='completed',
+             updated_at=updated_at)
+        for id in ids for _ in range(appointments_per_patient)])
+    db.session.execute(LabTest.__table__.insert(), [
+        dict(patient_id=id, doctor_id=1, test_type='blood_test', test_date=updated_at,
+             status='completed', updated_at=updated_at) for id in ids])
+    db.session.commit()
+    return ids
+
+
+def test_a_second_run_bills_nothing(app):
+    with app.app_context():
+        add_encounters(3, 2)
+        run = run_billing()
+        assert (run.bills_created, run.items_created) == (3, 9)
+        fees = app.config['BILLING_CONSULTATION_FEE'] * 2 + app.config['BILLING_LAB_TEST_TARIFF']['blood_test']
+        assert {bill.total_amount for bill in Bill.query} == {fees}
+        again = run_billing()
+        assert (again.bills_created, again.items_created) == (0, 0)
+        assert run_billing(full=True).items_created == 0
+
+
+def test_late_commits_inside_the_overlap_are_billed(app):
+    overlap = app.config['BILLING_WATERMARK_OVERLAP']
+    with app.app_context():
+        add_encounters(1, 1)
+        first = run_billing()
+        # Committed after the first run, but stamped before its watermark
+        add_encounters(1, 1, updated_at=first.watermark - timedelta(seconds=overlap // 2))
+        add_encounters(1, 1, updated_at=first.watermark - timedelta(seconds=overlap * 2))
+        assert run_billing().bills_created == 1
+        assert run_billing(full=True).bills_created == 1
+        assert BillItem.query.count() == 6
+
+
+def test_an_overlapping_run_skips_what_the_other_billed(app, monkeypatch):
+    with app.app_context():
+        add_encounters(2, 1)
+        run_billing()
+        add_encounters(1, 1)
+        # The second run planned before the first run's items were visible
+        calls = []
+        real = billing._not_billed
+
+        def not_billed(item_type, item_id):
+            calls.append(item_type)
+            return literal(True) if len(calls) <= 3 else real(item_type, item_id)
+        monkeypatch.setattr(billing, '_not_billed', not_billed)
+        run = run_billing()
+        assert len(calls) == 6
+        assert (run.bills_created, run.items_created) == (1, 2)
+        assert BillItem.query.count() == 6
+
+
+def test_a_run_keeps_losing_the_race_and_gives_up(app, monkeypatch):
+    with app.app_context():
+        add_encounters(1, 1)
+        run_billing()
+        monkeypatch.setattr(billing, '_not_billed', lambda item_type, item_id: literal(True))
+        with pytest.raises(IntegrityError):
+            run_billing()
+
+
+def test_billing_benchmark(app):
+    """100,000 encounters over 20,000 patients, then an idle re-run."""
+    with app.app_context():
+        add_encounters(20000, 4)
+        started = time.perf_counter()
+        run = run_billing()
+        elapsed = time.perf_counter() - started
+        started = time.perf_counter()
+        again = run_billing()
+        rerun = time.perf_counter() - started
+        print(f'\nbilling: {run.items_created} encounters, {run.bills_created} bills in {elapsed:.2f} s; '
+              f're-run {rerun:.2f} s')
+        assert (run.bills_created, run.items_created, again.items_created) == (20000, 100000, 0)
+        assert elapsed < 20 and rerun < 5
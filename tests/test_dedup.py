@@ -0,0 +1,46 @@
+from datetime import date, datetime, timedelta
+from app import db
+from app.models import Appointment, Patient
+from app.utils.dedup import find_matches, merge_patients
+
+
+def add_patient(app, first_name, last_name, phone, date_of_birth=date(1980, 5, 17)):
+    with app.app_context():
+        patient = Patient(first_name=first_name, last_name=last_name, date_of_birth=date_of_birth,
+                          gender='female', phone=phone)
+        db.session.add(patient)
+        db.session.commit()
+        return patient.id
+
+
+def test_finds_a_misspelt_duplicate(app):
+    id = add_patient(app, 'Catherine', 'Smith', '+44 7700 900123')
+    with app.app_context():
+        matches = find_matches('Katherine', 'Smyth', date(1980, 5, 17), '07700 900123')
+        assert [patient.id for _, patient in matches] == [id]
+
+
+def test_merge_moves_records_and_marks_them_changed(app, make_user):
+    doctor_id = make_user('doctor')
+    keep_id = add_patient(app, 'Catherine', 'Smith', '07700900123')
+    duplicate_id = add_patient(app, 'Katherine', 'Smith', '07700900123')
+    long_ago = datetime.utcnow() - timedelta(days=30)
+    with app.app_context():
+        appointment = Appointment(patient_id=duplicate_id, doctor_id=doctor_id,
+                                  appointment_date=datetime.utcnow(), updated_at=long_ago)
+        db.session.add(appointment)
+        db.session.commit()
+        appointment_id = appointment.id
+        merge_patients(keep_id, duplicate_id)
+        moved = db.session.get(Appointment, appointment_id)
+        assert moved.patient_id == keep_id
+        assert moved.updated_at > long_ago
+        assert db.session.get(Patient, duplicate_id) is None
+
+
+def test_duplicate_check_is_for_reception_and_admin(app, make_user, login):
+    add_patient(app, 'Catherine', 'Smith', '07700900123')
+    query = '/patients/duplicates?first_name=Catherine&last_name=Smith&date_of_birth=1980-05-17&phone=07700900123'
+    response = login(make_user('receptionist')).get(query)
+    assert response.status_code == 200 and len(response.json) == 1
+    assert login(make_user('doctor')).get(query).status_code == 302
@@ -0,0 +1,61 @@
+from datetime import date
+from app import db
+from app.models import Medication, Patient, Prescription, PrescriptionMedication
+from app.pharmacy.dispensing import dispense
+
+
+def add_prescriptions(app, doctor_id, lines_per_prescription, stock=10):
+    with app.app_context():
+        patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                          gender='F', phone='5550100')
+        medication = Medication(name='Amoxicillin', price=1.0, quantity_in_stock=stock)
+        db.session.add_all([patient, medication])
+        db.session.flush()
+        ids = []
+        for lines in lines_per_prescription:
+            prescription = Prescription(patient_id=patient.id, doctor_id=doctor_id, diagnosis='x')
+            db.session.add(prescription)
+            db.session.flush()
+            db.session.add_all(PrescriptionMedication(prescription_id=prescription.id,
+                                                      medication_id=medication.id, dosage='1',
+                                                      frequency='1', duration='1', quantity=4)
+                               for _ in range(lines))
+            ids.append(prescription.id)
+        db.session.commit()
+        return ids
+
+
+def test_batch_allocates_in_order_and_clears_empty_prescriptions(app, make_user):
+    first, second, empty = add_prescriptions(app, make_user('doctor'), [2, 1, 0])
+    with app.app_context():
+        result = dispense([first, second, empty, first], user_id=1)
+        assert result['dispensed'] == [first, empty]
+        assert list(result['shortages']) == [second]
+        assert db.session.get(Prescription, empty).status == 'dispensed'
+        assert db.session.get(Medication, 1).quantity_in_stock == 2
+        assert dispense([first], user_id=1)['skipped'] == [first]
+
+
+def test_dispensing_a_cancelled_prescription_is_reported(app, make_user, login):
+    (id,) = add_prescriptions(app, make_user('doctor'), [1])
+    client = login(make_user('pharmacist'))
+    with app.app_context():
+        db.session.get(Prescription, id).status = 'cancelled'
+        db.session.commit()
+    response = client.post(f'/pharmacy/prescription/{id}/dispense', data={'notes': ''})
+    with client.session_transaction() as session:
+        messages = [message for _, message in session['_flashes']]
+    assert response.status_code == 302
+    assert messages == [f'Prescription #{id} is no longer pending and was not dispensed.']
+
+
+def test_batch_json_must_be_an_object_with_a_list_of_ids(app, make_user, login):
+    (id,) = add_prescriptions(app, make_user('doctor'), [1])
+    client = login(make_user('pharmacist'))
+    for body in ([id], 5, {'prescription_ids': 5}, {'prescription_ids': ['x']}, {'prescription_ids': [True]}):
+        response = client.post('/pharmacy/prescriptions/dispense', json=body)
+        assert response.status_code == 400, body
+    response = client.post('/pharmacy/prescriptions/dispense', data='{', content_type='application/json')
+    assert response.status_code == 400
+    response = client.post('/pharmacy/prescriptions/dispense', json={'prescription_ids': [id]})
+    assert response.json['dispensed'] == [id]
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import tracemalloc
+from datetime import date, datetime
+import pytest
+from app import db
+from app.models import Appointment, Patient, Prescription, QueueEvent
+from app.utils.events import (EventBroker, LABORATORY_CHANNEL, PHARMACY_CHANNEL,
+                              WAITING_ROOM_CHANNEL)
+
+
+@pytest.fixture
+def broker(app):
+    broker = EventBroker(app)
+    broker._ensure_notifier = lambda: None
+    return broker
+
+
+def add_patient():
+    patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                      gender='F', phone='5550100')
+    db.session.add(patient)
+    db.session.flush()
+    return patient
+
+
+def add_event(id, channel=PHARMACY_CHANNEL):
+    db.session.execute(QueueEvent.__table__.insert(), [dict(
+        id=id, channel=channel, event_type='status_changed',
+        payload=json.dumps({'id': id}), created_at=datetime.utcnow())])
+    db.session.commit()
+
+
+def outbox():
+    return [(row.channel, row.event_type, json.loads(row.payload)['status'])
+            for row in QueueEvent.query.order_by(QueueEvent.id)]
+
+
+def test_commits_write_outbox_rows(app, make_user):
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        patient = add_patient()
+        prescription = Prescription(patient_id=patient.id, doctor_id=doctor_id, diagnosis='x')
+        appointment = Appointment(patient_id=patient.id, doctor_id=doctor_id,
+                                  appointment_date=datetime.now(), status='scheduled')
+        db.session.add_all([prescription, appointment])
+        db.session.commit()
+        prescription.status = 'dispensed'
+        appointment.status = 'checked_in'
+        db.session.commit()
+        appointment.notes = 'late'
+        db.session.commit()
+        assert outbox() == [(PHARMACY_CHANNEL, 'new_prescription', 'pending'),
+                            (PHARMACY_CHANNEL, 'status_changed', 'dispensed'),
+                            (WAITING_ROOM_CHANNEL, 'appointment_changed', 'checked_in'),
+                            (WAITING_ROOM_CHANNEL, 'appointment_changed', 'checked_in')]
+
+
+def test_listen_replays_events_the_notifier_is_past(app, broker):
+    with app.app_context():
+        for id in range(1, 5):
+            add_event(id, PHARMACY_CHANNEL if id % 2 else LABORATORY_CHANNEL)
+        broker._last_id = 4
+        received = []
+        broker.listen(PHARMACY_CHANNEL, received.append, since=1)
+        assert received == [{'id': 3}]
+        add_event(5)
+        broker._poll()
+        assert received == [{'id': 3}, {'id': 5}]
+
+
+def test_a_late_commit_with_a_lower_id_is_delivered(app, broker):
+    with app.app_context():
+        broker._last_id = 0
+        sub = broker.subscribe(PHARMACY_CHANNEL)
+        add_event(3)
+        broker._poll()
+        assert broker._last_id == 3 and set(broker._gaps) == {1, 2}
+        add_event(1)
+        broker._poll()
+        broker._poll()
+        assert [sub.queue.get_nowait()['id'] for _ in range(sub.queue.qsize())] == [3, 1]
+        assert set(broker._gaps) == {2}
+
+
+def test_gaps_are_given_up_after_the_timeout(app, broker):
+    app.config['SSE_GAP_TIMEOUT'] = 0
+    with app.app_context():
+        broker._last_id = 0
+        add_event(2)
+        broker._poll()
+        broker._poll()
+        assert broker._gaps == {}
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason='needs /proc')
+def test_idle_stream_memory(app, broker):
+    """Idle streams on a threaded server: broker share and whole-process RSS."""
+    connections = 200
+    app.config['SSE_MAX_CONNECTIONS'] = connections
+    threads, started = [], threading.Barrier(connections + 1)
+
+    def serve(sub):
+        stream = broker.stream(sub)
+        next(stream)
+        started.wait()
+        for _ in stream:
+            pass
+
+    before = rss()
+    tracemalloc.start()
+    subs = [broker.subscribe(PHARMACY_CHANNEL) for _ in range(connections)]
+    broker_bytes = tracemalloc.get_traced_memory()[0] / connections
+    tracemalloc.stop()
+    for sub in subs:
+        threads.append(threading.Thread(target=serve, args=(sub,), daemon=True))
+        threads[-1].start()
+    started.wait()
+    per_connection = (rss() - before) / connections
+    print(f'\nidle stream: {broker_bytes / 1024:.1f} KB in the broker, '
+          f'{per_connection / 1024:.1f} KB of RSS')
+    for sub in subs:
+        sub.overflowed = True
+        sub.queue.put_nowait({'id': 0, 'event': 'close', 'data': {}})
+    for thread in threads:
+        thread.join()
+    assert broker.connection_count == 0
+    assert broker_bytes < 8 * 1024
+    assert per_connection < 256 * 1024
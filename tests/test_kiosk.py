@@ -0,0 +1,69 @@
+import json
+
+
+def test_waiting_room_is_closed_without_a_kiosk_key(app, make_user, login):
+    app.config['CHECKIN_KIOSK_KEY'] = None
+    client = app.test_client()
+    assert client.get('/waiting-room').status_code == 403
+    assert client.post('/kiosk/checkin', json={'token': 'x'}).status_code == 403
+    assert login(make_user('receptionist')).get('/waiting-room').status_code == 200
+
+
+def test_kiosk_key_opens_the_display_and_check_in(app):
+    app.config['CHECKIN_KIOSK_KEY'] = 'kiosk-secret'
+    client = app.test_client()
+    assert client.get('/waiting-room', headers={'X-Kiosk-Key': 'wrong'}).status_code == 403
+    assert client.get('/waiting-room', headers={'X-Kiosk-Key': 'kiosk-secret'}).status_code == 200
+    response = client.post('/kiosk/checkin', json={'token': 'x'}, headers={'X-Kiosk-Key': 'kiosk-secret'})
+    assert response.status_code == 400
+
+
+def test_check_in_needs_a_json_object_or_a_form(app):
+    app.config['CHECKIN_KIOSK_KEY'] = 'kiosk-secret'
+    client = app.test_client()
+    headers = {'X-Kiosk-Key': 'kiosk-secret'}
+    for body in (['x'], 'x', 5, None):
+        response = client.post('/kiosk/checkin', json=body, headers=headers)
+        assert response.status_code == 400 and 'error' in response.json, body
+    response = client.post('/kiosk/checkin', data='[', content_type='application/json', headers=headers)
+    assert response.status_code == 400
+    response = client.post('/kiosk/checkin', data={'token': 'x'}, headers=headers)
+    assert response.json == {'error': 'This code is not a valid check-in code.'}
+
+
+def test_only_appointments_the_flush_moved_get_events(app, make_user):
+    from datetime import date, datetime
+    from sqlalchemy import event
+    from app import db
+    from app.models import Appointment, Patient, QueueEvent
+    from app.utils.checkin import CheckInQueue
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                          gender='F', phone='5550100')
+        db.session.add(patient)
+        db.session.flush()
+        db.session.add_all([Appointment(patient_id=patient.id, doctor_id=doctor_id,
+                                        appointment_date=datetime.now(), status='scheduled')
+                            for _ in range(3)])
+        db.session.commit()
+        engine = db.engine
+    queue = CheckInQueue(app)
+    for id in (1, 2, 3):
+        queue.record(id)
+    raced = []
+
+    def other_worker(conn, cursor, statement, parameters, context, executemany):
+        # Another worker checks appointment 1 in after this flush selected it
+        if statement.startswith('UPDATE appointment') and not raced:
+            raced.append(True)
+            with engine.begin() as other:
+                other.exec_driver_sql("UPDATE appointment SET status = 'checked_in' WHERE id = 1")
+    event.listen(engine, 'before_cursor_execute', other_worker)
+    try:
+        assert queue.flush() == 2
+    finally:
+        event.remove(engine, 'before_cursor_execute', other_worker)
+    with app.app_context():
+        changed = [json.loads(row.payload)['id'] for row in QueueEvent.query.order_by(QueueEvent.id)]
+    assert changed == [2, 3]
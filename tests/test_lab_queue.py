@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from app import db
+from app.laboratory import queue
+from app.models import LabTest, Patient
+
+TECHNICIANS = 20
+
+
+def add_tests(app, count, priorities=('routine', 'urgent', 'emergency')):
+    with app.app_context():
+        patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=datetime(1970, 1, 1).date(),
+                          gender='F', phone='5550100')
+        db.session.add(patient)
+        db.session.flush()
+        now = datetime.utcnow()
+        db.session.execute(LabTest.__table__.insert(), [
+            dict(patient_id=patient.id, doctor_id=1, test_type='blood_test', test_date=now,
+                 status='pending', priority=priorities[i % len(priorities)],
+                 created_at=now + timedelta(seconds=i))
+            for i in range(count)])
+        db.session.commit()
+
+
+def poll(app, user_id, count, claimed, errors):
+    with app.app_context():
+        while True:
+            try:
+                tests, _ = queue.claim_next(user_id, count)
+            except Exception as e:
+                db.session.rollback()
+                errors.append(repr(e))
+                continue
+            if not tests:
+                return
+            claimed.extend(test.id for test in tests)
+
+
+def run_pollers(app, count=5):
+    claimed, errors = [], []
+    threads = [threading.Thread(target=poll, args=(app, user_id, count, claimed, errors))
+               for user_id in range(1, TECHNICIANS + 1)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return claimed, errors, time.perf_counter() - started
+
+
+def test_claims_in_priority_then_age_order(app):
+    add_tests(app, 6)
+    with app.app_context():
+        tests, _ = queue.claim_next(1, 6)
+        assert [test.priority for test in tests] == ['emergency'] * 2 + ['urgent'] * 2 + ['routine'] * 2
+        assert [test.id for test in tests[:2]] == [3, 6]
+
+
+def test_expired_lease_goes_back_to_the_queue(app):
+    add_tests(app, 1)
+    app.config['LAB_QUEUE_LEASE_SECONDS'] = -1
+    with app.app_context():
+        (test,), token = queue.claim_next(1)
+        assert queue.renew(1, token) == 0
+        (again,), _ = queue.claim_next(2)
+        assert again.id == test.id and again.claimed_by == 2
+        assert queue.complete(test.id, 1, 'late') is None
+        assert queue.complete(test.id, 2, 'done') == []
+
+
+def test_concurrent_pollers_never_share_a_test(app):
+    add_tests(app, 1000)
+    claimed, errors, _ = run_pollers(app)
+    duplicates = [id for id, times in Counter(claimed).items() if times > 1]
+    assert duplicates == []
+    assert len(claimed) == 1000
+    assert errors == []
+
+
+def test_claims_per_second(app):
+    """Benchmark: 20 technicians draining the queue five tests at a time."""
+    add_tests(app, 2000)
+    claimed, _, elapsed = run_pollers(app)
+    rate = len(claimed) / elapsed
+    print(f'\n{TECHNICIANS} pollers: {len(claimed)} claims in {elapsed:.2f}s, {rate:.0f} claims/s')
+    assert len(claimed) == 2000
+    assert rate > 200
+
+
+def test_claim_rejects_a_non_numeric_count(app, make_user, login):
+    client = login(make_user('lab_technician'))
+    response = client.post('/laboratory/queue/claim', json={'count': 'five'})
+    assert response.status_code == 400
@@ -0,0 +1,92 @@
+from datetime import date, datetime, timedelta
+import pytest
+from app import db
+from app.models import ArchivedLabResult, LabResult, LabTest, Patient
+from app.utils.archive import run_archive
+from app.utils.dedup import merge_patients
+from app.utils.lab_results import InvalidResult, cohort, prepare, trend
+
+
+def add_test(app, doctor_id, test_date=None, patient_id=None):
+    with app.app_context():
+        if patient_id is None:
+            patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                              gender='female', phone='5550100')
+            db.session.add(patient)
+            db.session.flush()
+            patient_id = patient.id
+        test = LabTest(patient_id=patient_id, doctor_id=doctor_id, test_type='blood_test',
+                       test_date=test_date or datetime.now(), status='pending', priority='urgent')
+        db.session.add(test)
+        db.session.commit()
+        return test.id, patient_id
+
+
+def test_values_are_flagged_against_reference_and_critical_limits():
+    rows = prepare([{'analyte': 'Potassium', 'value': '6.8'}, {'analyte': 'sodium', 'value': 140},
+                    {'analyte': 'x', 'value': 5, 'reference_low': 1, 'reference_high': 4}])
+    assert [(row['analyte'], row['flag']) for row in rows] == [('potassium', 'HH'), ('sodium', 'N'), ('x', 'H')]
+
+
+@pytest.mark.parametrize('value', ['nan', 'inf', '-Infinity', float('nan')])
+def test_non_finite_values_are_rejected(value):
+    with pytest.raises(InvalidResult):
+        prepare([{'analyte': 'potassium', 'value': value}])
+
+
+def test_queue_api_rejects_nan(app, make_user, login):
+    test_id, _ = add_test(app, make_user('doctor'))
+    client = login(make_user('lab_technician'))
+    client.post('/laboratory/queue/claim', json={'count': 1})
+    response = client.post(f'/laboratory/queue/{test_id}/complete',
+                           json={'values': [{'analyte': 'potassium', 'value': 'nan'}]})
+    assert response.status_code == 400
+
+
+def test_saving_the_form_without_value_rows_keeps_the_values(app, make_user, login):
+    test_id, _ = add_test(app, make_user('doctor'))
+    client = login(make_user('lab_technician'))
+    client.post('/laboratory/queue/claim', json={'count': 1})
+    response = client.post(f'/laboratory/queue/{test_id}/complete',
+                           json={'values': [{'analyte': 'potassium', 'value': 6.8}]})
+    assert response.json['critical'][0]['flag'] == 'HH'
+    assert client.post(f'/laboratory/test/{test_id}', data={'results': 'corrected note'}).status_code == 302
+    with app.app_context():
+        assert LabResult.query.filter_by(lab_test_id=test_id).count() == 1
+        assert db.session.get(LabTest, test_id).results == 'corrected note'
+    client.post(f'/laboratory/test/{test_id}', data={'results': 'repeat', 'analyte[]': 'potassium',
+                                                     'value[]': '4.2', 'unit[]': '',
+                                                     'reference_low[]': '', 'reference_high[]': ''})
+    with app.app_context():
+        assert [row.value for row in LabResult.query.filter_by(lab_test_id=test_id)] == [4.2]
+
+
+def test_values_follow_their_test_into_the_archive_and_a_merge(app, make_user, login):
+    doctor_id = make_user('doctor')
+    old = datetime.now() - timedelta(days=800)
+    test_id, patient_id = add_test(app, doctor_id, test_date=old)
+    recent_id, _ = add_test(app, doctor_id, patient_id=patient_id)
+    client = login(make_user('lab_technician'))
+    client.post('/laboratory/queue/claim', json={'count': 2})
+    for id, value in ((test_id, 6.8), (recent_id, 5.0)):
+        client.post(f'/laboratory/queue/{id}/complete', json={'values': [{'analyte': 'potassium', 'value': value}]})
+    app.config['ARCHIVE_MIN_IDLE_DAYS'] = -1
+    with app.app_context():
+        assert run_archive(['lab_test']) == {'lab_test': 1}
+        assert LabResult.query.filter_by(lab_test_id=test_id).count() == 0
+        assert ArchivedLabResult.query.filter_by(lab_test_id=test_id).count() == 1
+        points = trend(patient_id, 'potassium')
+        assert [(point['value'], point['archived']) for point in points] == [(6.8, True), (5.0, False)]
+        page = cohort('potassium', old - timedelta(days=1), datetime.now() + timedelta(days=1), limit=1)
+        assert page['results'][0]['value'] == 5.0
+        page = cohort('potassium', old - timedelta(days=1), datetime.now() + timedelta(days=1),
+                      cursor=page['next_cursor'])
+        assert [row['value'] for row in page['results']] == [6.8] and page['next_cursor'] is None
+
+        duplicate = Patient(first_name='Anne', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                            gender='female', phone='5550100')
+        db.session.add(duplicate)
+        db.session.commit()
+        merge_patients(duplicate.id, patient_id)
+        assert {row.patient_id for row in LabResult.query} == {duplicate.id}
+        assert {row.patient_id for row in ArchivedLabResult.query} == {duplicate.id}
@@ -0,0 +1,64 @@
+import os
+import time
+from io import BytesIO
+import pytest
+from PIL import Image
+from app.utils import previews
+from app.utils.previews import derivative_path, render_derivative, send_preview, submit
+from app.utils.storage import blob_path, save_stream
+
+
+def png(width=800, height=600):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), 'red').save(buffer, 'PNG')
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def stored(app):
+    with app.test_request_context():
+        yield save_stream(png(), 'scan.png')
+
+
+def test_render_leaves_no_lock_file(app, stored):
+    with app.app_context():
+        source, target = blob_path(stored.sha256), derivative_path(stored.sha256, 'thumb')
+    assert render_derivative(source, stored.content_type, target, (240, 240)) == target
+    assert render_derivative(source, stored.content_type, target, (240, 240)) == target
+    assert Image.open(target).size == (240, 180)
+    assert sorted(os.listdir(os.path.dirname(target))) == [stored.sha256, os.path.basename(target)]
+
+
+def test_a_missing_preview_is_queued_not_awaited(app, stored, monkeypatch):
+    queued = []
+    monkeypatch.setattr(previews, 'submit', lambda stored, size: queued.append(size))
+    with app.test_request_context():
+        response = send_preview(stored, 'thumb')
+        assert (response.status_code, response.mimetype) == (202, 'image/svg+xml')
+        assert response.headers['Retry-After'] == str(app.config['PREVIEW_RETRY_AFTER'])
+        assert queued == ['thumb']
+        target = derivative_path(stored.sha256, 'thumb')
+        render_derivative(blob_path(stored.sha256), stored.content_type, target, (240, 240))
+        response = send_preview(stored, 'thumb')
+        assert (response.status_code, response.mimetype) == (200, 'image/jpeg')
+        response.close()
+
+
+def test_a_file_that_cannot_be_rendered_gets_a_404(app):
+    with app.test_request_context():
+        broken = save_stream(BytesIO(b'\x89PNG\r\n\x1a\n' + b'\0' * 64), 'broken.png')
+        future = submit(broken, 'thumb')
+        with pytest.raises(Exception):
+            future.result(timeout=60)
+        target = derivative_path(broken.sha256, 'thumb')
+        # Done callbacks run just after waiters are woken
+        for _ in range(100):
+            if target in previews._failed:
+                break
+            time.sleep(0.01)
+        assert target in previews._failed
+        with pytest.raises(Exception) as error:
+            send_preview(broken, 'thumb')
+        assert error.value.code == 404
+        assert not os.path.exists(target + '.lock')
@@ -0,0 +1,42 @@
+import sys
+import types
+from flask import Flask
+from app.utils.profiling import TOKEN_HEADER, Profiler, profile_token
+
+
+def make_app(tmp_path, **config):
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY='test', PROFILE_ENABLED=True, PROFILE_FOLDER=str(tmp_path),
+                      PROFILE_FLUSH_INTERVAL=60, **config)
+    app.add_url_rule('/ping', 'ping', lambda: 'pong')
+    return app, Profiler(app)
+
+
+def test_only_token_requests_are_told_the_endpoint(tmp_path):
+    app, profiler = make_app(tmp_path, PROFILE_SAMPLE_RATE=1)
+    with app.app_context():
+        token = profile_token(1)
+    client = app.test_client()
+    assert 'X-Profiled' not in client.get('/ping').headers
+    assert client.get('/ping', headers={TOKEN_HEADER: token}).headers['X-Profiled'] == 'ping'
+    assert profiler.flush() == 2
+
+
+def test_green_threads_fall_back_to_cprofile(tmp_path, monkeypatch):
+    monkey = types.ModuleType('gevent.monkey')
+    monkey.is_module_patched = lambda name: name == 'threading'
+    monkeypatch.setitem(sys.modules, 'gevent.monkey', monkey)
+    app, profiler = make_app(tmp_path, PROFILE_SAMPLE_RATE=1, PROFILE_MODE='sample')
+    assert profiler.mode() == 'cprofile'
+    app.test_client().get('/ping')
+    assert profiler.flush() == 1
+    assert list(tmp_path.glob('*/ping.*.pstats'))
+
+
+def test_patching_after_app_creation_is_detected(tmp_path, monkeypatch):
+    app, profiler = make_app(tmp_path, PROFILE_MODE='sample')
+    assert profiler.mode() == 'sample'
+    monkey = types.ModuleType('gevent.monkey')
+    monkey.is_module_patched = lambda name: True
+    monkeypatch.setitem(sys.modules, 'gevent.monkey', monkey)
+    assert profiler.mode() == 'cprofile'
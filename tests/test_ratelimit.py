@@ -0,0 +1,53 @@
+import time
+from app.utils.ratelimit import BucketStore, PROBE
+
+
+def test_bucket_refills_at_its_rate(tmp_path):
+    store = BucketStore(str(tmp_path / 'buckets.bin'), slots=64)
+    assert [store.take('a', 2, 60, now=1000.0) for _ in range(3)] == [0, 0, 30.0]
+    assert store.take('a', 2, 60, now=1030.0) == 0
+
+
+def test_slow_bucket_is_not_evicted_by_a_faster_limit(tmp_path):
+    # One slot per home, so every key below probes the same window
+    store = BucketStore(str(tmp_path / 'buckets.bin'), slots=1)
+    store.take('slow', 1, 3600, now=1000.0)
+    # Fast buckets refill within a second; they must not take the slow one's slot
+    for i in range(PROBE + 4):
+        store.take(f'fast{i}', 100, 1, now=1001.0)
+    assert store.take('slow', 1, 3600, now=1002.0) > 0
+
+
+def test_login_limit_is_per_address_and_email(app):
+    client = app.test_client()
+    for _ in range(10):
+        client.post('/login', data={'email': 'stuck@example.com', 'password': 'wrong-password'})
+    assert client.post('/login', data={'email': 'stuck@example.com', 'password': 'wrong-password'}).status_code == 429
+    assert client.post('/login', data={'email': 'nurse@example.com', 'password': 'wrong-password'}).status_code != 429
+
+
+def test_proxy_address_is_used_when_trusted(app):
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+    client = app.test_client()
+    for _ in range(10):
+        client.post('/login', data={'email': 'a@example.com', 'password': 'wrong-password'}, headers={'X-Forwarded-For': '10.0.0.1'})
+    assert client.post('/login', data={'email': 'a@example.com', 'password': 'wrong-password'},
+                       headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 429
+    assert client.post('/login', data={'email': 'a@example.com', 'password': 'wrong-password'},
+                       headers={'X-Forwarded-For': '10.0.0.2'}).status_code != 429
+
+
+def test_check_overhead(tmp_path):
+    """Benchmark: one check is a few microseconds, not a database round trip."""
+    store = BucketStore(str(tmp_path / 'buckets.bin'), slots=65536)
+    keys = [f'auth.login|10/minute|ip:10.0.{i // 256}.{i % 256}' for i in range(1000)]
+    for key in keys:
+        store.take(key, 1e9, 1)
+    checks = 50000
+    started = time.perf_counter()
+    for i in range(checks):
+        store.take(keys[i % len(keys)], 1e9, 1)
+    per_check = (time.perf_counter() - started) / checks * 1e6
+    print(f'\nrate limit check: {per_check:.1f} us')
+    assert per_check < 100
@@ -0,0 +1,103 @@
+import time
+from datetime import date, datetime, timedelta
+import pytest
+from app import db, mail
+from app.models import Appointment, Patient, ReminderLog
+from app.utils import reminders
+from app.utils.reminders import send_reminders
+from flask_mail import email_dispatched
+
+NOW = datetime(2024, 3, 1, 9, 0)
+
+
+@pytest.fixture
+def app(app):
+    app.config['MAIL_DEFAULT_SENDER'] = 'clinic@example.com'
+    return app
+
+
+def add_appointments(doctor_id, count, when):
+    db.session.execute(Patient.__table__.insert(), [
+        dict(first_name='Ann', last_name=f'Lee{i}', date_of_birth=date(1970, 1, 1), gender='F',
+             phone='5550100', email=f'ann{i}@example.com') for i in range(count)])
+    ids = [id for (id,) in db.session.query(Patient.id).order_by(Patient.id.desc()).limit(count)]
+    db.session.execute(Appointment.__table__.insert(), [
+        dict(patient_id=id, doctor_id=doctor_id, appointment_date=when, status='scheduled')
+        for id in ids])
+    db.session.commit()
+
+
+def test_a_repeated_run_sends_nothing_twice(app, make_user):
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        add_appointments(doctor_id, 3, NOW + timedelta(days=1, hours=2))
+        add_appointments(doctor_id, 2, NOW + timedelta(minutes=30))
+        with mail.record_messages() as outbox:
+            assert send_reminders(NOW, batch_size=2) == (5, 0)
+            assert send_reminders(NOW) == (0, 0)
+        assert sorted(message.subject for message in outbox) == \
+            ['Appointment Reminder: Tomorrow'] * 3 + ['Appointment Reminder: Within the Hour'] * 2
+        assert ReminderLog.query.count() == 5
+
+
+def test_an_overlapping_run_skips_what_the_other_claimed(app, make_user, monkeypatch):
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        add_appointments(doctor_id, 4, NOW + timedelta(days=1))
+        real_claim = reminders._claim
+        overlapped = []
+
+        def claim(rows):
+            # The other run starts after this one selected its rows
+            if not overlapped:
+                overlapped.append(True)
+                monkeypatch.setattr(reminders, '_claim', real_claim)
+                assert send_reminders(NOW, batch_size=3) == (4, 0)
+            return real_claim(rows)
+        monkeypatch.setattr(reminders, '_claim', claim)
+        with mail.record_messages() as outbox:
+            assert send_reminders(NOW, batch_size=3) == (0, 0)
+        # Only the other run's four messages
+        assert sorted(message.recipients[0] for message in outbox) == \
+            [f'ann{i}@example.com' for i in range(4)]
+        assert ReminderLog.query.count() == 4
+
+
+def test_a_failed_send_is_retried_by_the_next_run(app, make_user, monkeypatch):
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        add_appointments(doctor_id, 2, NOW + timedelta(days=1))
+        build = reminders._build_message
+
+        def failing(template, row, sender):
+            if row.email == 'ann1@example.com':
+                raise RuntimeError('mailbox unavailable')
+            return build(template, row, sender)
+        monkeypatch.setattr(reminders, '_build_message', failing)
+        assert send_reminders(NOW) == (1, 1)
+        monkeypatch.setattr(reminders, '_build_message', build)
+        assert send_reminders(NOW) == (1, 0)
+
+
+def test_reminder_benchmark(app, make_user):
+    """5,000 due reminders among 25,000 appointments, MIME built as for SMTP."""
+    doctor_id = make_user('doctor')
+
+    def serialize(message, app):
+        message.as_bytes()
+    with app.app_context():
+        add_appointments(doctor_id, 5000, NOW + timedelta(days=1, hours=1))
+        add_appointments(doctor_id, 20000, NOW + timedelta(days=5))
+        email_dispatched.connect(serialize)
+        try:
+            started = time.perf_counter()
+            sent, failed = send_reminders(NOW)
+            elapsed = time.perf_counter() - started
+        finally:
+            email_dispatched.disconnect(serialize)
+        started = time.perf_counter()
+        assert send_reminders(NOW) == (0, 0)
+        rerun = time.perf_counter() - started
+        print(f'\nreminders: {sent} sent in {elapsed:.2f} s ({sent / elapsed:.0f}/s); re-run {rerun:.2f} s')
+        assert (sent, failed) == (5000, 0)
+        assert sent / elapsed > 200 and rerun < 2
@@ -0,0 +1,45 @@
+from datetime import date, datetime, timedelta
+from app import db
+from app.models import Medication, Patient, Prescription, PrescriptionMedication
+from app.utils.forecast import load_forecast
+from app.utils.reorder import load_reorder, run_reorder, save_reorder
+
+
+def test_nothing_is_computed_inside_a_request_before_the_nightly_run(app, make_user, login):
+    app.config['REORDER_FILE'] = app.instance_path + '/missing-reorder.json'
+    app.config['FORECAST_FILE'] = app.instance_path + '/missing-forecast.json'
+    with app.app_context():
+        assert load_reorder()['generated_at'] is None
+        assert load_forecast()['doctors'] == []
+    response = login(make_user('pharmacist')).get('/pharmacy/reorder')
+    assert response.status_code == 200 and response.json['lines'] == []
+    response = login(make_user('admin')).get('/admin/forecast')
+    assert response.status_code == 200 and response.json['generated_at'] is None
+
+
+def test_fast_moving_medication_is_reordered(app, make_user, tmp_path):
+    app.config['REORDER_FILE'] = str(tmp_path / 'reorder.json')
+    doctor_id = make_user('doctor')
+    today = date.today()
+    with app.app_context():
+        patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                          gender='female', phone='5550100')
+        fast = Medication(name='Paracetamol', price=0.5, quantity_in_stock=50)
+        idle = Medication(name='Rare drug', price=9.0, quantity_in_stock=50)
+        db.session.add_all([patient, fast, idle])
+        db.session.flush()
+        for day in range(1, 29):
+            prescription = Prescription(patient_id=patient.id, doctor_id=doctor_id, diagnosis='x',
+                                        status='dispensed',
+                                        dispensed_at=datetime.combine(today - timedelta(days=day),
+                                                                      datetime.min.time()))
+            db.session.add(prescription)
+            db.session.flush()
+            db.session.add(PrescriptionMedication(prescription_id=prescription.id, medication_id=fast.id,
+                                                  dosage='1', frequency='1', duration='1', quantity=10))
+        db.session.commit()
+        result = run_reorder(today)
+        assert [line['name'] for line in result['lines']] == ['Paracetamol']
+        assert result['lines'][0]['daily_demand'] == 10
+        save_reorder(result)
+        assert load_reorder()['generated_at'] == result['generated_at']
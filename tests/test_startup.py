@@ -0,0 +1,15 @@
+import os
+from config import Config
+from app.utils.startup import LAZY_MODULES, check, measure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_create_app_stays_within_the_startup_budget():
+    assert check(Config.STARTUP_BUDGET_MS, cwd=ROOT) == []
+
+
+def test_lazy_modules_are_not_imported_at_startup():
+    _, imports = measure(cwd=ROOT)
+    assert imports
+    assert [name for name in LAZY_MODULES if name in imports] == []
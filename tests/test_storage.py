@@ -0,0 +1,53 @@
+from datetime import datetime
+from io import BytesIO
+from app import db
+from app.models import LabTest, Patient, StoredFile
+from app.utils.storage import save_stream, send_stored_file
+
+HTML = b'<html><script>alert(document.cookie)</script></html>'
+PDF = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+
+
+def add_test(app, doctor_id):
+    with app.app_context():
+        patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=datetime(1970, 1, 1).date(),
+                          gender='F', phone='5550100')
+        db.session.add(patient)
+        db.session.flush()
+        test = LabTest(patient_id=patient.id, doctor_id=doctor_id, test_type='blood_test',
+                       test_date=datetime.now(), status='completed')
+        db.session.add(test)
+        db.session.commit()
+        return test.id
+
+
+def test_uploaded_html_is_not_served_inline(app, make_user, login):
+    test_id = add_test(app, make_user('doctor'))
+    client = login(make_user('lab_technician'))
+    client.post(f'/laboratory/test/{test_id}/report/upload',
+                data={'file': (BytesIO(HTML), 'report.html', 'text/html')})
+    client.post(f'/laboratory/test/{test_id}/report/upload', data=HTML,
+                headers={'Content-Type': 'image/svg+xml', 'X-Filename': 'report.svg'})
+    with app.app_context():
+        assert [row.content_type for row in StoredFile.query] == ['application/octet-stream'] * 2
+    response = client.get(f'/laboratory/test/{test_id}/report/file')
+    assert response.mimetype == 'application/octet-stream'
+    assert response.headers['Content-Disposition'].startswith('attachment')
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+    assert response.headers['Content-Security-Policy'] == 'sandbox'
+
+
+def test_sniffed_pdfs_are_inline_and_old_records_are_not_trusted(app):
+    with app.test_request_context():
+        stored = save_stream(BytesIO(PDF), 'report.pdf')
+        response = send_stored_file(stored)
+        assert (stored.content_type, response.mimetype) == ('application/pdf', 'application/pdf')
+        assert response.headers['Content-Disposition'].startswith('inline')
+        assert response.headers['X-Content-Type-Options'] == 'nosniff'
+        response.close()
+        legacy = save_stream(BytesIO(HTML), 'old.html')
+        legacy.content_type = 'text/html'
+        response = send_stored_file(legacy)
+        assert response.mimetype == 'application/octet-stream'
+        assert response.headers['Content-Disposition'].startswith('attachment')
+        response.close()
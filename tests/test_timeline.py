@@ -0,0 +1,75 @@
+from datetime import date, datetime, timedelta
+from app import db
+from app.models import Appointment, ArchivedAppointment, Bill, Patient, Prescription
+from app.utils.timeline import decode_cursor, encode_cursor, patient_timeline
+
+NOON = datetime(2024, 3, 1, 12, 0)
+
+
+def add_patient():
+    patient = Patient(first_name='Ann', last_name='Lee', date_of_birth=date(1970, 1, 1),
+                      gender='F', phone='5550100')
+    db.session.add(patient)
+    db.session.flush()
+    return patient.id
+
+
+def add_history(patient_id, doctor_id):
+    """Rows of every kind, with several sharing a timestamp."""
+    db.session.add_all([
+        Appointment(patient_id=patient_id, doctor_id=doctor_id, appointment_date=NOON, status='completed'),
+        Appointment(patient_id=patient_id, doctor_id=doctor_id, appointment_date=NOON, status='cancelled'),
+        Appointment(patient_id=patient_id, doctor_id=doctor_id, appointment_date=NOON + timedelta(days=1),
+                    status='scheduled'),
+        Prescription(patient_id=patient_id, doctor_id=doctor_id, diagnosis='x', prescription_date=NOON),
+        Bill(patient_id=patient_id, total_amount=10, bill_date=NOON),
+        Bill(patient_id=patient_id, total_amount=20, bill_date=NOON - timedelta(days=1)),
+    ])
+    db.session.flush()
+    db.session.execute(ArchivedAppointment.__table__.insert(), [dict(
+        id=100, patient_id=patient_id, doctor_id=doctor_id, appointment_date=NOON,
+        status='completed', archived_at=NOON)])
+    db.session.commit()
+
+
+def walk(patient_id, limit, **kwargs):
+    entries, cursor = [], None
+    while True:
+        page = patient_timeline(patient_id, cursor=cursor, limit=limit, **kwargs)
+        assert len(page['entries']) <= limit
+        entries.extend((entry['kind'], entry['id']) for entry in page['entries'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return entries
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(NOON, 2, 17)) == (NOON, 2, 17)
+    assert decode_cursor('not a cursor') is None
+    assert decode_cursor(encode_cursor(NOON, 2, 17)[:-4]) is None
+
+
+def test_pages_cover_every_row_once_across_ties_and_kinds(app, make_user):
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        patient_id = add_patient()
+        add_history(patient_id, doctor_id)
+        # Equal times: later kinds first, then higher ids
+        expected = [('appointment', 3), ('bill', 1), ('prescription', 1), ('appointment', 100),
+                    ('appointment', 2), ('appointment', 1), ('bill', 2)]
+        assert walk(patient_id, limit=100) == expected
+        for limit in (1, 2, 3):
+            assert walk(patient_id, limit=limit) == expected
+        assert walk(patient_id, limit=1, kinds=('bill',)) == [('bill', 1), ('bill', 2)]
+        assert patient_timeline(patient_id, limit=7)['next_cursor'] is None
+
+
+def test_doctor_history_lists_earlier_completed_appointments(app, make_user, login):
+    doctor_id = make_user('doctor')
+    with app.app_context():
+        patient_id = add_patient()
+        add_history(patient_id, doctor_id)
+    response = login(doctor_id).get('/doctor/appointment/1',
+                                    headers={'X-Requested-With': 'XMLHttpRequest'})
+    assert [(entry['kind'], entry['id']) for entry in response.json['entries']] == [
+        ('prescription', 1), ('appointment', 100)]